@@ -0,0 +1,266 @@
+#build pix2pix training pairs from organized scenes
+#
+#the USGS Burned Area BP rasters (scene_BP folders written by
+#organize_C2_tar_download_BP.py) are joined with the ARD inputs (normalized
+#NBR and/or SR bands in the <tile>_<date> scene folders) on sensor, tile and
+#acquisition date.  aligned patches are cut with a configurable size and
+#stride, patches with too much nodata are dropped (and whole scenes above a
+#cloud cover limit: scene-level CLOUD_COVER from the BA metadata .xml, there is
+#no per-pixel QA cloud masking), and the patches are written in parallel to compressed
+#NPZ shards that a training input pipeline can stream sequentially.
+#
+#every shard holds:
+#  inputs   (N, channels, size, size) in the inputs' common dtype (float32 if they differ)
+#  targets  (N, size, size) in the BP dtype
+#  scene, row, col  where each patch comes from
+#and index.json lists the shards, channels and patch counts.
+#
+# python build_training_pairs.py --bp-root BA_downloads --input-root ARD_downloads -o training_pairs
+# python build_training_pairs.py --bp-root BA_downloads --input-root ARD_downloads -o pairs \
+#     --inputs SR_B5 SR_B7 SR_NBR_norm --stride 128 --max-nodata 0.01 --max-cloud 20 -w 16
+
+import os
+import re
+import glob
+import json
+import argparse
+import xml.etree.ElementTree as ET
+import numpy as np
+import rasterio
+from rasterio.windows import Window
+from concurrent.futures import ProcessPoolExecutor, as_completed
+
+import raster_io
+
+PATCH_SIZE = 256
+SHARD_SIZE = 512  # patches per shard
+
+# sensor, tile (hhhvvv) and acquisition date of a product ID
+SCENE_KEY = re.compile(r'(L[CETMO]0\d)_CU_(\d{6})_(\d{8})_')
+
+
+def scene_key(filename):
+    """(sensor, tile, acquisition date) of a scene file, or None"""
+    match = SCENE_KEY.match(os.path.basename(filename))
+    return match.groups() if match else None
+
+
+def find_targets(bp_root):
+    """{scene key: BP file} for every scene_BP raster under bp_root"""
+    targets = {}
+    for path in sorted(glob.glob(os.path.join(bp_root, '*', 'scene_BP', '*_BP.TIF'))):
+        key = scene_key(path)
+        if key:
+            targets[key] = path
+    return targets
+
+
+def find_inputs(input_root, kinds):
+    """{scene key: [file per kind]} for the scenes under input_root that have every input kind"""
+    found = {}
+    for kind in kinds:
+        for path in glob.glob(os.path.join(input_root, '*', '*', '*_{}.TIF'.format(kind))):
+            key = scene_key(path)
+            if key:
+                found.setdefault(key, {})[kind] = path
+    return {key: [files[kind] for kind in kinds]
+            for key, files in found.items() if len(files) == len(kinds)}
+
+
+def metadata_files(tile_dir):
+    """{scene key: [.xml files]} of a tile's metadata folder"""
+    found = {}
+    for path in sorted(glob.glob(os.path.join(tile_dir, 'metadata', '*.xml'))):
+        key = scene_key(path)
+        if key:
+            found.setdefault(key, []).append(path)
+    return found
+
+
+def read_cloud_cover(xml):
+    """the first CLOUD_COVER in an .xml (namespaces ignored), or None"""
+    for event, element in ET.iterparse(xml, events=('end',)):
+        if element.tag.rsplit('}', 1)[-1] == 'CLOUD_COVER':
+            return float(element.text)
+        element.clear()
+    return None
+
+
+def scene_cloud_cover(bp_file, metadata=None):
+    """
+    CLOUD_COVER of a BP scene from the .xml files with its sensor, tile and
+    date in the tile's metadata folder (metadata: metadata_files of the
+    tile, looked up if not given), or None
+    """
+    if metadata is None:
+        metadata = metadata_files(os.path.dirname(os.path.dirname(bp_file)))
+    for xml in metadata.get(scene_key(bp_file), []):
+        try:
+            cloud_cover = read_cloud_cover(xml)
+        except (OSError, ET.ParseError, TypeError, ValueError):
+            continue
+        if cloud_cover is not None:
+            return cloud_cover
+    return None
+
+
+def pair_scenes(bp_root, input_root, kinds, max_cloud=None):
+    """(scene key, BP file, input files) for every scene found on both sides"""
+    targets = find_targets(bp_root)
+    inputs = find_inputs(input_root, kinds)
+    pairs = []
+    metadata = {}
+    unknown = 0
+    for key in sorted(set(targets) & set(inputs)):
+        if max_cloud is not None:
+            tile_dir = os.path.dirname(os.path.dirname(targets[key]))
+            if tile_dir not in metadata:
+                metadata[tile_dir] = metadata_files(tile_dir)
+            cloud_cover = scene_cloud_cover(targets[key], metadata[tile_dir])
+            if cloud_cover is None:
+                print('WARNING: no cloud cover found for', os.path.basename(targets[key]), '- keeping it')
+                unknown += 1
+            elif cloud_cover > max_cloud:
+                print('Skipping cloudy scene', os.path.basename(targets[key]), cloud_cover)
+                continue
+        pairs.append((key, targets[key], inputs[key]))
+    if unknown:
+        print('WARNING: {} scenes kept without a cloud cover (no metadata .xml with CLOUD_COVER)'.format(unknown))
+    return pairs
+
+
+def _invalid(block, nodata):
+    invalid = np.zeros(block.shape, dtype=bool)
+    if nodata is not None:
+        invalid |= block == nodata
+    if block.dtype.kind == 'f':
+        invalid |= ~np.isfinite(block)
+    return invalid
+
+
+def cut_patches(bp_file, input_files, size=PATCH_SIZE, stride=PATCH_SIZE, max_nodata=0.0):
+    """
+    yield (row, col, inputs, target) for the aligned patches of one scene,
+    reading one band of rows at a time (through the raster_io block cache).
+    patches where the fraction of nodata pixels (in the target or any input)
+    exceeds max_nodata are skipped.
+    """
+    sources = [rasterio.open(path) for path in [bp_file] + list(input_files)]
+    try:
+        target = sources[0]
+        for src in sources[1:]:
+            if (src.width, src.height, src.transform, src.crs) != \
+                    (target.width, target.height, target.transform, target.crs):
+                raise ValueError('{} is not on the grid of {}'.format(src.name, bp_file))
+        dtypes = set(src.dtypes[0] for src in sources[1:])
+        input_dtype = dtypes.pop() if len(dtypes) == 1 else 'float32'
+
+        for row in range(0, target.height - size + 1, stride):
+            window = Window(0, row, target.width, size)
+            blocks = [raster_io.read_window(src, 1, window) for src in sources]
+            invalid = np.zeros(blocks[0].shape, dtype=bool)
+            for src, block in zip(sources, blocks):
+                invalid |= _invalid(block, src.nodata)
+            for col in range(0, target.width - size + 1, stride):
+                if invalid[:, col:col + size].mean() > max_nodata:
+                    continue
+                inputs = np.stack([block[:, col:col + size] for block in blocks[1:]]).astype(input_dtype, copy=False)
+                yield row, col, inputs, blocks[0][:, col:col + size].copy()
+    finally:
+        for src in sources:
+            src.close()
+
+
+def write_shard(path, patches):
+    """write a list of (scene, row, col, inputs, target) as one compressed NPZ shard"""
+    tmp = path + '.part'
+    with open(tmp, 'wb') as f:
+        np.savez_compressed(f,
+                            inputs=np.stack([p[3] for p in patches]),
+                            targets=np.stack([p[4] for p in patches]),
+                            scene=np.array([p[0] for p in patches]),
+                            row=np.array([p[1] for p in patches], dtype=np.int32),
+                            col=np.array([p[2] for p in patches], dtype=np.int32))
+    os.replace(tmp, path)
+
+
+def build_shards(task, pairs, out_dir, size=PATCH_SIZE, stride=PATCH_SIZE, max_nodata=0.0,
+                 shard_size=SHARD_SIZE):
+    """cut the patches of a group of scene pairs into shards shard-<task>-<n>.npz, returns the shard list"""
+    shards = []
+    patches = []
+
+    def flush():
+        path = os.path.join(out_dir, 'shard-{:05d}-{:04d}.npz'.format(task, len(shards)))
+        write_shard(path, patches)
+        shards.append(dict(path=os.path.basename(path), patches=len(patches)))
+        del patches[:]
+
+    for key, bp_file, input_files in pairs:
+        scene = os.path.basename(bp_file)[:-len('_BP.TIF')]
+        print('Cutting patches from', scene)
+        try:
+            for row, col, inputs, target in cut_patches(bp_file, input_files, size, stride, max_nodata):
+                patches.append((scene, row, col, inputs, target))
+                if len(patches) == shard_size:
+                    flush()
+        except (rasterio.errors.RasterioError, ValueError) as e:
+            print('ERROR cutting patches from', scene, '-', e)
+    if patches:
+        flush()
+    return shards
+
+
+def build_dataset(pairs, out_dir, kinds, size=PATCH_SIZE, stride=PATCH_SIZE, max_nodata=0.0,
+                  shard_size=SHARD_SIZE, workers=None):
+    """spread the scene pairs over a process pool, write index.json and return it"""
+    os.makedirs(out_dir, exist_ok=True)
+    workers = workers or os.cpu_count()
+    groups = [pairs[i::workers] for i in range(workers) if pairs[i::workers]]
+    shards = []
+    with ProcessPoolExecutor(max_workers=workers, initializer=raster_io.configure,
+                             initargs=raster_io.settings()) as executor:
+        futures = [executor.submit(build_shards, task, group, out_dir, size, stride, max_nodata, shard_size)
+                   for task, group in enumerate(groups)]
+        for future in as_completed(futures):
+            shards.extend(future.result())
+
+    index = dict(channels=list(kinds), target='BP', patch_size=size, stride=stride,
+                 max_nodata=max_nodata, scenes=len(pairs),
+                 patches=sum(s['patches'] for s in shards),
+                 shards=sorted(shards, key=lambda s: s['path']))
+    with open(os.path.join(out_dir, 'index.json'), 'w') as f:
+        json.dump(index, f, indent=2)
+    return index
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Build BP/NBR training pairs as sharded NPZ patch files.')
+    parser.add_argument('--bp-root', required=True, dest='bp_root',
+                        help='Folder with the organized Burned Area tiles (tile/scene_BP). (Required)')
+    parser.add_argument('--input-root', required=True, dest='input_root',
+                        help='Folder with the organized ARD tiles (tile/<tile>_<date> scene folders). (Required)')
+    parser.add_argument('-o', '--output', required=True, help='Output folder for the shards. (Required)')
+    parser.add_argument('--inputs', nargs='+', default=['SR_NBR_norm'],
+                        help='Input file kinds, one channel each [Default: SR_NBR_norm]')
+    parser.add_argument('--size', type=int, default=PATCH_SIZE, help='Patch size [Default: %(default)s]')
+    parser.add_argument('--stride', type=int, default=PATCH_SIZE, help='Patch stride [Default: %(default)s]')
+    parser.add_argument('--max-nodata', type=float, default=0.0, dest='max_nodata',
+                        help='Largest fraction of nodata pixels in a kept patch [Default: %(default)s]')
+    parser.add_argument('--max-cloud', type=float, default=None, dest='max_cloud',
+                        help='Skip scenes with more cloud cover (scene CLOUD_COVER from the BA metadata .xml; '
+                             'no per-pixel cloud masking)')
+    parser.add_argument('--shard-size', type=int, default=SHARD_SIZE, dest='shard_size',
+                        help='Patches per shard [Default: %(default)s]')
+    parser.add_argument('-w', '--workers', type=int, default=None,
+                        help='Number of worker processes [Default: CPU count]')
+    parser.add_argument('--cache-mb', type=float, default=None, dest='cache_mb',
+                        help='Raster block cache budget per worker (see raster_io)')
+    args = parser.parse_args()
+    raster_io.configure(cache_mb=args.cache_mb)
+
+    pairs = pair_scenes(args.bp_root, args.input_root, args.inputs, args.max_cloud)
+    print('Found {} scenes with a BP target and {} inputs'.format(len(pairs), ', '.join(args.inputs)))
+    index = build_dataset(pairs, args.output, args.inputs, args.size, args.stride, args.max_nodata,
+                          args.shard_size, args.workers)
+    print('Wrote {} patches in {} shards to {}'.format(index['patches'], len(index['shards']), args.output))
@@ -1,8 +1,21 @@
 import os
 import glob
+import time
 import numpy as np
 import rasterio
 import argparse
+from rasterio.windows import Window
+from concurrent.futures import ProcessPoolExecutor, as_completed
+
+import raster_io
+from tar_index import ard_scene_bands
+from tar_extract import STAGE_BANDS
+
+# windows are at least this many rows when the rasters are stored in strips
+MIN_WINDOW_ROWS = 256
+
+# bands read by the NBR (B5, B7)
+NBR_BANDS = STAGE_BANDS['nbr']
 
 
 def find_band_files(dir_path):
@@ -12,9 +25,8 @@ def find_band_files(dir_path):
     return b5_file, b7_file
 
 def read_raster(file_path):
-    """read a single raster band from the file."""
-    with rasterio.open(file_path) as src:
-        band = src.read(1)
+    """read a single raster band from the file (read once, so not kept in the raster_io block cache)."""
+    band = raster_io.read_band(file_path, 1, cache=False)
     return band 
 
 def calculate_nbr(band_5, band_7):
@@ -23,40 +35,190 @@ def calculate_nbr(band_5, band_7):
     nbr = (band_5.astype(float) - band_7.astype(float)) / (band_5 + band_7)
     return nbr
 
-def process_scene(scene_dir):
-    """process a single scene to calculate the NBR and save the result in the same folder."""
-    b5_file, b7_file = find_band_files(scene_dir)
-    band_5 = read_raster(b5_file)
-    band_7 = read_raster(b7_file)
-    nbr = calculate_nbr(band_5, band_7)
-    
-    # Define the output file path within the scene folder
+def calculate_nbr_block(band_5, band_7, out):
+    """calculate NBR in float32 for one block, in place: band_5 and band_7 are float32 buffers, out receives the NBR."""
+    with np.errstate(divide='ignore', invalid='ignore'):
+        np.subtract(band_5, band_7, out=out)
+        np.add(band_5, band_7, out=band_7)
+        np.divide(out, band_7, out=out)
+    return out
+
+def iter_windows(src, min_rows=MIN_WINDOW_ROWS):
+    """windows covering the raster, following its internal blocks (strips are grouped into windows of min_rows or more)."""
+    block_rows, block_cols = src.block_shapes[0]
+    if block_cols < src.width:
+        # tiled: one window per internal tile
+        for ji, window in src.block_windows(1):
+            yield window
+        return
+    rows = -(-min_rows // block_rows) * block_rows
+    for row in range(0, src.height, rows):
+        yield Window(0, row, src.width, min(rows, src.height - row))
+
+def nbr_output_file(scene_dir, b5_file):
+    """output file path of the NBR of a scene, next to its bands."""
     base_name = os.path.basename(b5_file)  # ge the final component of reference filename (e.g LC08...B5)
     output_file_name = base_name.replace("B5", "NBR")  # replace "B5" with "NBR"
-    output_file = os.path.join(scene_dir, output_file_name)
+    return os.path.join(scene_dir, output_file_name)
+
+def process_scene(scene_dir):
+    """process a single scene to calculate the NBR block by block and save the result in the same folder."""
+    b5_file, b7_file = find_band_files(scene_dir)
+    output_file = nbr_output_file(scene_dir, b5_file)
+    return calculate_nbr_file(b5_file, b7_file, output_file)
+
+def calculate_nbr_file(b5_file, b7_file, output_file):
+    """calculate the NBR of one pair of B5/B7 rasters (files or GDAL paths such as /vsisubfile/) block by block into output_file."""
+    with rasterio.open(b5_file) as src5, rasterio.open(b7_file) as src7:
+        if (src5.width, src5.height) != (src7.width, src7.height):
+            raise ValueError(f"B5 and B7 sizes differ for {output_file}")
+
+        # save the NBR to a new raster file, with the B5 profile in the configured output format
+        profile = src5.profile
+        profile.update(dtype=rasterio.float32, count=1)
+
+        with raster_io.open_output(output_file, profile) as dst:
+            # buffers for the largest output block, reused for every block
+            windows = list(iter_windows(dst))
+            size = max(int(w.height) * int(w.width) for w in windows)
+            buffers = [np.empty(size, dtype=np.float32) for _ in range(3)]
 
-    # save the NBR to a new raster file
-    with rasterio.open(b5_file) as src:
-        profile = src.profile
-    profile.update(dtype=rasterio.float32, count=1)
-    
-    with rasterio.open(output_file, 'w', **profile) as dst:
-        dst.write(nbr.astype(rasterio.float32), 1)
-    print(f"NBR calculated and saved for {output_file_name} at {output_file}")
+            for window in windows:
+                shape = (int(window.height), int(window.width))
+                band_5, band_7, nbr = (b[:shape[0] * shape[1]].reshape(shape) for b in buffers)
+                src5.read(1, window=window, out=band_5)
+                src7.read(1, window=window, out=band_7)
+                dst.write(calculate_nbr_block(band_5, band_7, nbr), 1, window=window)
+    print(f"NBR calculated and saved for {os.path.basename(output_file)} at {output_file}")
+    return output_file
+
+def tar_nbr_output_file(tile_dir, folder, product_id):
+    """output file path of the NBR of a scene read from a tar, in the scene folder extraction would create."""
+    return os.path.join(tile_dir, folder, product_id + '_SR_NBR.TIF')
+
+def tar_nbr_outputs(in_tar, tile_dir):
+    """output files process_tar writes for a tar."""
+    return [tar_nbr_output_file(tile_dir, folder, product_id)
+            for product_id, (folder, bands) in ard_scene_bands(in_tar, NBR_BANDS).items()]
+
+def process_tar(in_tar, tile_dir):
+    """calculate the NBR of the scenes in an uncompressed ARD tar, reading B5/B7 inside the tar (no extraction), into the tile's scene folders."""
+    outputs = []
+    for product_id, (folder, bands) in ard_scene_bands(in_tar, NBR_BANDS).items():
+        if set(bands) != set(NBR_BANDS):
+            raise ValueError(f"{in_tar} has no B5 and B7 for {product_id}")
+        output_file = tar_nbr_output_file(tile_dir, folder, product_id)
+        os.makedirs(os.path.dirname(output_file), exist_ok=True)
+        outputs.append(calculate_nbr_file(bands['5'], bands['7'], output_file))
+    return outputs
+
+def find_tile_tars(base_dir):
+    """.tar files of a tile folder, waiting in it or already moved to tar_downloads."""
+    return sorted(glob.glob(os.path.join(base_dir, '*.tar')) +
+                  glob.glob(os.path.join(base_dir, 'tar_downloads', '*.tar')))
+
+def find_scene_dirs(base_dir):
+    """scene folders (containing B5 and B7 bands) directly under a tile folder."""
+    scene_dirs = []
+    for scene_dir in sorted(os.listdir(base_dir)):
+        full_scene_dir = os.path.join(base_dir, scene_dir)
+        if os.path.isdir(full_scene_dir):  # ensure it's a directory
+            if glob.glob(os.path.join(full_scene_dir, '*_B5*')) and glob.glob(os.path.join(full_scene_dir, '*_B7*')):
+                scene_dirs.append(full_scene_dir)
+    return scene_dirs
+
+def catalog_scene_dirs(catalog, tiles=None, max_cloud=None, start=None, end=None, status=None):
+    """scene folders of the scenes the catalog selects (those with a B5 file), instead of a walk over the tile folders."""
+    scenes = catalog.query(tiles=tiles, max_cloud=max_cloud, start=start, end=end, status=status, kind='SR_B5')
+    return sorted(set(os.path.dirname(scene['file']) for scene in scenes))
+
+def process_scenes(scene_dirs, workers=None):
+    """calculate the NBR of many scenes across a process pool. returns (output files, errors)."""
+    outputs = []
+    errors = []
+    with ProcessPoolExecutor(max_workers=workers, initializer=raster_io.configure,
+                             initargs=raster_io.settings()) as executor:
+        futures = {executor.submit(process_scene, scene_dir): scene_dir for scene_dir in scene_dirs}
+        for future in as_completed(futures):
+            try:
+                outputs.append(future.result())
+            except Exception as e:
+                print(f"ERROR calculating NBR for {futures[future]}: {e}")
+                errors.append(futures[future])
+    return sorted(outputs), sorted(errors)
+
+def tar_tile_dir(in_tar):
+    """tile folder of a .tar in it or in its tar_downloads folder."""
+    folder = os.path.dirname(os.path.abspath(in_tar))
+    return os.path.dirname(folder) if os.path.basename(folder) == 'tar_downloads' else folder
+
+def process_tars(tars, workers=None):
+    """calculate the NBR of the scenes in many tars across a process pool, reading the bands inside the tars. returns (output files, errors)."""
+    outputs = []
+    errors = []
+    with ProcessPoolExecutor(max_workers=workers, initializer=raster_io.configure,
+                             initargs=raster_io.settings()) as executor:
+        futures = {executor.submit(process_tar, in_tar, tar_tile_dir(in_tar)): in_tar for in_tar in tars}
+        for future in as_completed(futures):
+            try:
+                outputs.extend(future.result())
+            except Exception as e:
+                print(f"ERROR calculating NBR for {futures[future]}: {e}")
+                errors.append(futures[future])
+    return sorted(outputs), sorted(errors)
 
           
 if __name__ == '__main__':
     # Set up argument parser
     parser = argparse.ArgumentParser(description='Process scenes to calculate NBR and save in each scene folder.')
-    parser.add_argument('-i', '--input_dir', required=True,
-                        help='Path to the base directory containing scene folders.', type=str)
+    parser.add_argument('-i', '--input_dir', nargs='+', default=[],
+                        help='Path to the base directory containing scene folders (one or many tiles). '
+                             'With --catalog, the tiles whose scenes are selected [Default: every tile in the catalog]', type=str)
+    parser.add_argument('-w', '--workers', type=int, default=None,
+                        help='Number of worker processes [Default: CPU count]')
+    parser.add_argument('--from-tars', action='store_true', dest='from_tars',
+                        help='Read B5/B7 straight from the uncompressed .tar files of each tile (in it or in tar_downloads) '
+                             'instead of extracted scene folders, writing the NBR to the same scene folders.')
+    catalog_args = parser.add_argument_group('scene catalog (see scene_catalog.py)')
+    catalog_args.add_argument('--catalog', type=str, default=None,
+                              help='Select the scenes from this catalog instead of walking the tile folders (except with --from-tars), '
+                                   'and record the NBR files (status nbr) in it.')
+    catalog_args.add_argument('--max-cloud', type=float, default=None, dest='max_cloud',
+                              help='Only scenes with less cloud cover than this.')
+    catalog_args.add_argument('--start', default=None, help='First acquisition date (YYYY-MM-DD)')
+    catalog_args.add_argument('--end', default=None, help='Last acquisition date (YYYY-MM-DD)')
+    catalog_args.add_argument('--status', nargs='+', default=None, help='Only scenes with this status, e.g. organized')
+    raster_io.add_arguments(parser)
 
     # Parse arguments
     args = parser.parse_args()
-    base_dir = os.path.normpath(args.input_dir)
+    raster_io.configure(args.output_format, args.compress, args.cache_mb)
+    if not args.input_dir and not args.catalog:
+        parser.error('specify -i and/or --catalog')
+    catalog = None
+    if args.catalog:
+        from scene_catalog import SceneCatalog, NBR
+        catalog = SceneCatalog(args.catalog)
 
-    # Process all scenes
-    for scene_dir in os.listdir(base_dir):
-        full_scene_dir = os.path.join(base_dir, scene_dir)
-        if os.path.isdir(full_scene_dir):  # ensure it's a directory
-            process_scene(full_scene_dir)
+    # Process all scenes of all tiles
+    start = time.time()
+    if args.from_tars:
+        tars = []
+        for input_dir in args.input_dir:
+            tars.extend(find_tile_tars(os.path.normpath(input_dir)))
+        outputs, errors = process_tars(tars, args.workers)
+    elif catalog is not None:
+        tiles = [os.path.basename(os.path.normpath(d)) for d in args.input_dir] or None
+        scene_dirs = catalog_scene_dirs(catalog, tiles, args.max_cloud, args.start, args.end, args.status)
+        outputs, errors = process_scenes(scene_dirs, args.workers)
+    else:
+        scene_dirs = []
+        for input_dir in args.input_dir:
+            scene_dirs.extend(find_scene_dirs(os.path.normpath(input_dir)))
+        outputs, errors = process_scenes(scene_dirs, args.workers)
+    if catalog is not None:
+        catalog.record(outputs, NBR)
+        catalog.close()
+    print(f"NBR calculated for {len(outputs)} scenes in {time.time() - start:.1f} s")
+    if errors:
+        print("ERRORS calculating NBR for:", errors)
@@ -0,0 +1,213 @@
+import os
+import numpy as np
+import rasterio
+from concurrent.futures import ProcessPoolExecutor
+
+import raster_io
+from calculate_nbr import iter_windows
+from scene_catalog import scene_id_of
+
+# accumulator state saved next to mean_nbr_image.tif/std_nbr_image.tif
+STATE_NAME = 'climatology_state.npz'
+
+
+def scene_id(file_path):
+    """id of the scene of an nbr file: its product ID, or the file name if it has none."""
+    return scene_id_of(file_path) or os.path.basename(file_path)
+
+
+def read_nbr_window(src, window=None):
+    """read one window of an nbr band as float64, nodata/inf as nan and values clamped to [-1, 1] (same as normalize_nbr.read_nbr)."""
+    nbr_data = raster_io.read_window(src, 1, window).astype(np.float64)
+    invalid = np.isinf(nbr_data)
+    if src.nodata is not None:
+        invalid |= nbr_data == src.nodata
+    nbr_data[invalid] = np.nan
+    np.clip(nbr_data, -1, 1, out=nbr_data)
+    return nbr_data
+
+
+class Climatology(object):
+    """
+    per-pixel running count, mean and M2 (sum of squared differences from the
+    mean) over a stack of scenes, updated one scene at a time with Welford's
+    algorithm.  nan pixels are missing and do not count.  accumulators of the
+    same raster built from different scenes can be merged, a scene can be
+    removed again, and the state (with the ids of the scenes it includes and
+    excludes) can be saved and loaded so new scenes update it incrementally.
+    """
+
+    def __init__(self, shape):
+        self.shape = tuple(shape)
+        self.count = np.zeros(self.shape, dtype=np.uint32)
+        self.mean = np.zeros(self.shape, dtype=np.float64)
+        self.m2 = np.zeros(self.shape, dtype=np.float64)
+        self.scenes = set()
+        self.excluded = set()
+
+    def add(self, values, window=None):
+        """add one scene (or one window of it, given as (row slice, col slice))."""
+        index = window if window is not None else (slice(None), slice(None))
+        count, mean, m2 = self.count[index], self.mean[index], self.m2[index]
+        valid = ~np.isnan(values)
+        x = values[valid]
+        n = count[valid] + 1
+        delta = x - mean[valid]
+        new_mean = mean[valid] + delta / n
+        m2[valid] += delta * (x - new_mean)
+        mean[valid] = new_mean
+        count[valid] = n
+
+    def remove(self, values, window=None):
+        """take one scene (or one window of it) back out, the inverse of add."""
+        index = window if window is not None else (slice(None), slice(None))
+        count, mean, m2 = self.count[index], self.mean[index], self.m2[index]
+        valid = ~np.isnan(values) & (count > 0)
+        x = values[valid]
+        n = count[valid] - 1
+        old_mean = mean[valid]
+        with np.errstate(divide='ignore', invalid='ignore'):
+            new_mean = np.where(n > 0, (old_mean * (n + 1) - x) / n, 0)
+        new_m2 = np.where(n > 0, m2[valid] - (x - new_mean) * (x - old_mean), 0)
+        m2[valid] = np.maximum(new_m2, 0)
+        mean[valid] = new_mean
+        count[valid] = n
+
+    def merge(self, other):
+        """combine the scenes of another accumulator into this one (Chan et al. pairwise update)."""
+        if other.shape != self.shape:
+            raise ValueError('cannot merge climatologies of shape {} and {}'.format(self.shape, other.shape))
+        if self.scenes & other.scenes:
+            raise ValueError('cannot merge climatologies sharing scenes: {}'.format(sorted(self.scenes & other.scenes)))
+        n_a = self.count.astype(np.float64)
+        n_b = other.count.astype(np.float64)
+        n = n_a + n_b
+        with np.errstate(divide='ignore', invalid='ignore'):
+            delta = other.mean - self.mean
+            weight = np.where(n > 0, n_b / n, 0)
+            self.mean += delta * weight
+            self.m2 += other.m2 + delta * delta * n_a * weight
+        self.count += other.count
+        self.scenes |= other.scenes
+        self.excluded |= other.excluded
+        return self
+
+    def save(self, path):
+        """write the state to path (.npz) atomically."""
+        tmp = path + '.part'
+        with open(tmp, 'wb') as f:
+            np.savez(f, count=self.count, mean=self.mean, m2=self.m2,
+                     scenes=np.array(sorted(self.scenes), dtype=str),
+                     excluded=np.array(sorted(self.excluded), dtype=str))
+        os.replace(tmp, path)
+
+    @classmethod
+    def load(cls, path):
+        """read a state written by save."""
+        with np.load(path) as state:
+            climatology = cls(state['count'].shape)
+            climatology.count = state['count']
+            climatology.mean = state['mean']
+            climatology.m2 = state['m2']
+            climatology.scenes = set(state['scenes'].tolist())
+            climatology.excluded = set(state['excluded'].tolist())
+        return climatology
+
+    def mean_image(self, fill=0.0):
+        """per-pixel mean, fill where no scene had a valid value."""
+        return np.where(self.count > 0, self.mean, fill)
+
+    def std_image(self, fill=0.0):
+        """per-pixel population standard deviation (as np.std), fill where no scene had a valid value."""
+        with np.errstate(divide='ignore', invalid='ignore'):
+            return np.where(self.count > 0, np.sqrt(self.m2 / self.count), fill)
+
+
+def _open_scene(file_path, climatology):
+    src = rasterio.open(file_path)
+    if climatology is not None and (src.height, src.width) != climatology.shape:
+        src.close()
+        raise ValueError(f"{file_path} does not match the climatology shape {climatology.shape}")
+    return src
+
+
+def accumulate(nbr_files, climatology=None):
+    """add nbr_files to a climatology (a new one by default) block by block and return it. scenes already included or excluded are skipped."""
+    for file_path in nbr_files:
+        if climatology is not None and scene_id(file_path) in climatology.scenes | climatology.excluded:
+            continue
+        print(f"Processing file: {file_path}")
+        with _open_scene(file_path, climatology) as src:
+            if climatology is None:
+                climatology = Climatology((src.height, src.width))
+            for window in iter_windows(src):
+                climatology.add(read_nbr_window(src, window), window.toslices())
+        climatology.scenes.add(scene_id(file_path))
+    return climatology
+
+
+def exclude(nbr_files, climatology):
+    """take nbr_files out of a climatology in one pass over each, and keep them out of later updates."""
+    for file_path in nbr_files:
+        if scene_id(file_path) in climatology.scenes:
+            print(f"Removing file: {file_path}")
+            with _open_scene(file_path, climatology) as src:
+                for window in iter_windows(src):
+                    climatology.remove(read_nbr_window(src, window), window.toslices())
+            climatology.scenes.discard(scene_id(file_path))
+        climatology.excluded.add(scene_id(file_path))
+    return climatology
+
+
+def calculate_climatology(nbr_files, workers=1, climatology=None):
+    """
+    per-pixel climatology of nbr_files, or climatology updated with the ones
+    it does not include yet.  with workers > 1 the files are split into
+    groups accumulated in parallel processes, then merged.
+    """
+    nbr_files = list(nbr_files)
+    if climatology is not None:
+        known = climatology.scenes | climatology.excluded
+        nbr_files = [f for f in nbr_files if scene_id(f) not in known]
+    if not nbr_files:
+        return climatology
+    workers = min(workers or os.cpu_count(), len(nbr_files))
+    if workers <= 1:
+        return accumulate(nbr_files, climatology)
+
+    groups = [nbr_files[i::workers] for i in range(workers)]
+    with ProcessPoolExecutor(max_workers=workers, initializer=raster_io.configure,
+                             initargs=raster_io.settings()) as executor:
+        for part in executor.map(accumulate, groups):
+            climatology = part if climatology is None else climatology.merge(part)
+    return climatology
+
+
+def update_state(state_path, nbr_files, workers=1, excluded_files=(), rebuild=False):
+    """
+    load the climatology saved at state_path, bring it up to date with
+    nbr_files (one pass over each new scene, one pass over each file in
+    excluded_files to take it out) and save it again.  if a scene of the
+    state is no longer among nbr_files it can't be taken out, so the
+    climatology is recomputed from scratch, as with rebuild.
+    """
+    climatology = None
+    if os.path.exists(state_path) and not rebuild:
+        climatology = Climatology.load(state_path)
+        missing = climatology.scenes - set(scene_id(f) for f in nbr_files)
+        if missing:
+            print(f"{len(missing)} scenes of {state_path} are gone, recomputing the climatology")
+            excluded = climatology.excluded
+            climatology = Climatology(climatology.shape)
+            climatology.excluded = excluded
+        else:
+            print(f"Updating {state_path} ({len(climatology.scenes)} scenes)")
+    if excluded_files:
+        if climatology is None:
+            with rasterio.open(excluded_files[0]) as src:
+                climatology = Climatology((src.height, src.width))
+        exclude(excluded_files, climatology)
+    climatology = calculate_climatology(nbr_files, workers, climatology)
+    if climatology is not None:
+        climatology.save(state_path)
+    return climatology
@@ -0,0 +1,224 @@
+"""
+Persistent download manifest, one SQLite file per download directory
+
+Records every scene found by a search, keyed by M2M entityId, and each of
+its products (productCode, e.g. the SR and QA bundles of one scene) with
+its download URL, local filename, size, mtime, checksum, status and
+timestamps.  A rerun asks the manifest for the entity IDs whose products
+are all complete and drops them before download-options/download-request
+are called, so an incremental refresh of a tile costs one scene-search and
+nothing else.
+"""
+
+import os
+import sqlite3
+import hashlib
+import datetime
+import threading
+
+
+MANIFEST_NAME = 'download_manifest.sqlite'
+CHECKSUM_ALGORITHM = 'md5'
+
+# status values
+SEARCHED = 'searched'
+REQUESTED = 'requested'
+QUEUED = 'queued'
+COMPLETE = 'complete'
+FAILED = 'failed'
+
+# one row per entity with product '' for the search result, plus one row per
+# product of the entity once download-options has listed it
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS downloads (
+    entity_id   TEXT NOT NULL,
+    product     TEXT NOT NULL DEFAULT '',
+    display_id  TEXT,
+    url         TEXT,
+    filename    TEXT,
+    size        INTEGER,
+    mtime       REAL,
+    checksum    TEXT,
+    status      TEXT NOT NULL,
+    error       TEXT,
+    created     TEXT NOT NULL,
+    updated     TEXT NOT NULL,
+    PRIMARY KEY (entity_id, product)
+);
+CREATE INDEX IF NOT EXISTS downloads_status ON downloads (status);
+CREATE INDEX IF NOT EXISTS downloads_filename ON downloads (filename);
+"""
+
+
+def file_checksum(path, chunk_size=8*1024*1024):
+    """
+    Hex digest (CHECKSUM_ALGORITHM) of a file, read sequentially
+    """
+    digest = hashlib.new(CHECKSUM_ALGORITHM)
+    with open(path, 'rb') as f:
+        for block in iter(lambda: f.read(chunk_size), b''):
+            digest.update(block)
+    return digest.hexdigest()
+
+
+def stored_checksum(directory, filename, size, mtime, name=MANIFEST_NAME):
+    """
+    Checksum the manifest of directory holds for a file of this size and
+    mtime, or None (no manifest, unknown file, or the file has changed)
+    """
+    path = os.path.join(directory, name)
+    if not os.path.exists(path):
+        return None
+    try:
+        conn = sqlite3.connect('file:{}?mode=ro'.format(path), uri=True,
+                               timeout=60)
+        try:
+            row = conn.execute(
+                'SELECT checksum FROM downloads WHERE filename = ? AND '
+                'size = ? AND mtime = ? AND checksum IS NOT NULL LIMIT 1',
+                (filename, size, mtime)).fetchone()
+        finally:
+            conn.close()
+    except sqlite3.Error:
+        return None
+    return row[0] if row else None
+
+
+def _now():
+    return datetime.datetime.now().isoformat(timespec='seconds')
+
+
+class DownloadManifest(object):
+    """
+    SQLite manifest of the downloads in one directory.  Safe to share
+    between threads of one process (e.g. pool result callbacks).
+    """
+
+    def __init__(self, directory, name=MANIFEST_NAME):
+        self.path = os.path.join(directory, name)
+        self._lock = threading.Lock()
+        self._conn = sqlite3.connect(self.path, timeout=60,
+                                     check_same_thread=False)
+        self._conn.row_factory = sqlite3.Row
+        with self._lock, self._conn:
+            self._migrate()
+            self._conn.executescript(SCHEMA)
+
+    def _migrate(self):
+        """
+        Rows of a manifest from before products were tracked become the
+        search rows (product '') of their entities
+        """
+        columns = [row[1] for row in self._conn.execute(
+            'PRAGMA table_info(downloads)')]
+        if not columns or 'product' in columns:
+            return
+        self._conn.execute('ALTER TABLE downloads RENAME TO downloads_v1')
+        self._conn.executescript(SCHEMA)
+        self._conn.execute(
+            'INSERT INTO downloads (entity_id, display_id, url, filename, '
+            'size, checksum, status, error, created, updated) '
+            'SELECT entity_id, display_id, url, filename, size, checksum, '
+            'status, error, created, updated FROM downloads_v1')
+        # also drops the old indexes, recreated by the SCHEMA that follows
+        self._conn.execute('DROP TABLE downloads_v1')
+
+    def close(self):
+        with self._lock:
+            self._conn.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+    def completed_entity_ids(self):
+        """
+        Set of entity IDs already downloaded into this directory: every
+        product of the entity is complete
+        """
+        with self._lock:
+            rows = self._conn.execute(
+                'SELECT entity_id FROM downloads GROUP BY entity_id '
+                'HAVING SUM(status = ?) > 0 '
+                "AND SUM(product != '' AND status != ?) = 0",
+                (COMPLETE, COMPLETE))
+            return set(row[0] for row in rows)
+
+    def record_search(self, entity_ids, display_ids):
+        """
+        Add search results that are not in the manifest yet
+        """
+        now = _now()
+        with self._lock, self._conn:
+            self._conn.executemany(
+                'INSERT OR IGNORE INTO downloads '
+                '(entity_id, display_id, status, created, updated) '
+                'VALUES (?, ?, ?, ?, ?)',
+                [(e, d, SEARCHED, now, now)
+                 for e, d in zip(entity_ids, display_ids)])
+
+    def record_products(self, entity_id, products):
+        """
+        Add the products download-options lists for an entity, so it is
+        only complete once all of them are
+        """
+        now = _now()
+        with self._lock, self._conn:
+            self._conn.executemany(
+                'INSERT OR IGNORE INTO downloads '
+                '(entity_id, product, status, created, updated) '
+                'VALUES (?, ?, ?, ?, ?)',
+                [(entity_id, p, REQUESTED, now, now) for p in products])
+
+    def update(self, entity_id, status, product='', **fields):
+        """
+        Set the status (and any of url, filename, size, mtime, checksum,
+        error) of one product of an entity, inserting it if needed
+        """
+        now = _now()
+        fields = {k: fields[k] for k in ('url', 'filename', 'size', 'mtime',
+                                         'checksum', 'error') if k in fields}
+        columns = ['entity_id', 'product', 'status', 'created',
+                   'updated'] + list(fields)
+        values = [entity_id, product or '', status, now, now] + list(fields.values())
+        assignments = ', '.join('{0} = excluded.{0}'.format(c)
+                                for c in ['status', 'updated'] + list(fields))
+        with self._lock, self._conn:
+            self._conn.execute(
+                'INSERT INTO downloads ({}) VALUES ({}) '
+                'ON CONFLICT (entity_id, product) DO UPDATE SET {}'.format(
+                    ', '.join(columns), ', '.join('?' * len(columns)),
+                    assignments),
+                values)
+
+    def mark_queued(self, entity_id, url, product=''):
+        self.update(entity_id, QUEUED, product, url=url, error=None)
+
+    def mark_complete(self, entity_id, url, filename, size, checksum,
+                      product='', mtime=None):
+        self.update(entity_id, COMPLETE, product, url=url, filename=filename,
+                    size=size, mtime=mtime, checksum=checksum, error=None)
+
+    def mark_failed(self, entity_id, url, error, product=''):
+        self.update(entity_id, FAILED, product, url=url, error=str(error))
+
+    def lookup_filename(self, filename):
+        """
+        Manifest row (dict) for a downloaded file name, or None
+        """
+        with self._lock:
+            row = self._conn.execute(
+                'SELECT * FROM downloads WHERE filename = ? '
+                'ORDER BY updated DESC LIMIT 1', (filename,)).fetchone()
+        return dict(row) if row else None
+
+    def rows(self, status=None):
+        with self._lock:
+            if status:
+                cursor = self._conn.execute(
+                    'SELECT * FROM downloads WHERE status = ?', (status,))
+            else:
+                cursor = self._conn.execute('SELECT * FROM downloads')
+            return [dict(row) for row in cursor]
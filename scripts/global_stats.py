@@ -0,0 +1,119 @@
+import os
+import numpy as np
+import rasterio
+from concurrent.futures import ProcessPoolExecutor
+
+import raster_io
+from calculate_nbr import iter_windows
+
+# histogram kept for percentiles, NBR values outside the range are only counted
+HIST_RANGE = (-1.0, 1.0)
+HIST_BINS = 4000
+
+
+class GlobalStats(object):
+    """
+    exact count, mean, standard deviation, min and max of every valid value
+    seen, plus a fixed-bin histogram for approximate percentiles.  blocks are
+    reduced with numpy and combined with the pairwise (Chan et al.) update,
+    so partial results from different workers merge exactly.
+    """
+
+    def __init__(self, hist_range=HIST_RANGE, bins=HIST_BINS):
+        self.count = 0
+        self.mean = 0.0
+        self.m2 = 0.0
+        self.min = np.inf
+        self.max = -np.inf
+        self.hist_range = tuple(hist_range)
+        self.histogram = np.zeros(bins, dtype=np.int64)
+        self.below = 0
+        self.above = 0
+
+    def _combine(self, count, mean, m2):
+        total = self.count + count
+        delta = mean - self.mean
+        self.mean += delta * count / total
+        self.m2 += m2 + delta * delta * self.count * count / total
+        self.count = total
+
+    def add(self, values):
+        """add the valid (finite) values of an array."""
+        values = values[np.isfinite(values)].astype(np.float64, copy=False)
+        if values.size == 0:
+            return
+        mean = values.mean()
+        self._combine(values.size, mean, np.square(values - mean).sum())
+        self.min = min(self.min, values.min())
+        self.max = max(self.max, values.max())
+        low, high = self.hist_range
+        self.below += int(np.count_nonzero(values < low))
+        self.above += int(np.count_nonzero(values > high))
+        self.histogram += np.histogram(values, bins=self.histogram.size, range=self.hist_range)[0]
+
+    def merge(self, other):
+        """combine the values of another GlobalStats (same histogram) into this one."""
+        if other.hist_range != self.hist_range or other.histogram.size != self.histogram.size:
+            raise ValueError('cannot merge statistics with different histograms')
+        if other.count:
+            self._combine(other.count, other.mean, other.m2)
+            self.min = min(self.min, other.min)
+            self.max = max(self.max, other.max)
+        self.histogram += other.histogram
+        self.below += other.below
+        self.above += other.above
+        return self
+
+    @property
+    def std(self):
+        """population standard deviation (as np.nanstd)."""
+        return np.sqrt(self.m2 / self.count) if self.count else np.nan
+
+    def percentiles(self, q):
+        """approximate percentiles (0-100) from the histogram, interpolated within bins."""
+        q = np.atleast_1d(np.asarray(q, dtype=np.float64))
+        if not self.count:
+            return np.full(q.shape, np.nan)
+        low, high = self.hist_range
+        edges = np.linspace(low, high, self.histogram.size + 1)
+        # values outside the histogram range sit at min/max
+        counts = np.concatenate(([self.below], self.histogram, [self.above]))
+        edges = np.concatenate(([min(self.min, low)], edges, [max(self.max, high)]))
+        cumulative = np.concatenate(([0], np.cumsum(counts)))
+        result = np.interp(q / 100.0 * self.count, cumulative, edges)
+        return np.clip(result, self.min, self.max)
+
+
+def read_valid_window(src, window=None):
+    """one window of band 1 as float64 with nodata as nan."""
+    data = raster_io.read_window(src, 1, window).astype(np.float64)
+    if src.nodata is not None:
+        data[data == src.nodata] = np.nan
+    return data
+
+
+def accumulate(files, hist_range=HIST_RANGE, bins=HIST_BINS):
+    """GlobalStats of every valid value of files, read block by block."""
+    stats = GlobalStats(hist_range, bins)
+    for file_path in files:
+        print(f"Processing file: {file_path}")
+        with rasterio.open(file_path) as src:
+            for window in iter_windows(src):
+                stats.add(read_valid_window(src, window))
+    return stats
+
+
+def calculate_global_stats(files, workers=1, hist_range=HIST_RANGE, bins=HIST_BINS):
+    """GlobalStats of files, split into groups over worker processes and merged when workers > 1."""
+    files = list(files)
+    workers = min(workers or os.cpu_count(), len(files)) if files else 1
+    if workers <= 1:
+        return accumulate(files, hist_range, bins)
+
+    groups = [files[i::workers] for i in range(workers)]
+    stats = GlobalStats(hist_range, bins)
+    with ProcessPoolExecutor(max_workers=workers, initializer=raster_io.configure,
+                             initargs=raster_io.settings()) as executor:
+        for part in executor.map(accumulate, groups, [hist_range] * workers, [bins] * workers):
+            stats.merge(part)
+    return stats
@@ -35,8 +35,16 @@ import time
 import datetime
 import logging
 import traceback
+import functools
+import threading
 import multiprocessing
 from argparse import ArgumentParser
+from concurrent.futures import ThreadPoolExecutor
+from urllib.parse import urlparse
+
+import m2m_session
+from m2m_search_cache import SearchCache, DEFAULT_TTL, DEFAULT_DIR
+from download_manifest import DownloadManifest, file_checksum, stored_checksum
 
 urllib3.disable_warnings(urllib3.exceptions.InsecureRequestWarning)
 
@@ -69,8 +77,12 @@ class M2M(object):
     https://m2m.cr.usgs.gov/api/docs/json/
 
     """
-    
-    
+
+    # read-only endpoints, retried on connection errors and 5xx/429; the
+    # others (login-token, download-request) are sent exactly once
+    RETRY_RESOURCES = frozenset(['scene-search', 'download-options',
+                                 'download-retrieve'])
+
 
     def __init__(self, instance='ops'):
         url_lookup = dict(
@@ -270,8 +282,14 @@ class M2M(object):
         url = self.baseurl + resource
         data_ = {k: v if k != 'token' else 'xxxxx' for k, v in data.items()}
         logger.debug('POST {} {}'.format(url, data_))
-        response = getattr(requests, verb)(url, headers=headers,
-                                           data=json.dumps(data))
+        if resource in self.RETRY_RESOURCES:
+            response = m2m_session.request_with_retries(
+                verb, url, headers=headers, data=json.dumps(data))
+        else:
+            # never repeated: a second download-request/login creates another
+            session = m2m_session.get_session()
+            response = getattr(session, verb)(url, headers=headers,
+                                              data=json.dumps(data))
         return self._parse(response)
 
     def login(self, username=None, token=None, **kwargs):
@@ -289,6 +307,46 @@ class M2M(object):
         return self._api_request("post", "scene-search",  \
                                  data, headers).get('data')
 
+    def scene_search_pages(self, headers, data, page_size=5000):
+        """
+        Paginated scene-search.  Requests page_size results at a time using
+        startingNumber/nextRecord and yields each page's results as it
+        arrives, up to data['maxResults'] in total.
+
+        Yields:
+            List[dict] scene results
+        """
+        max_results = int(data.get('maxResults') or 0) or None
+        starting_number = 1
+        returned = 0
+        while True:
+            size = page_size
+            if max_results is not None:
+                size = min(size, max_results - returned)
+            page = dict(data, startingNumber=starting_number,
+                        maxResults=size)
+            resp = self.scene_search(headers, page) or {}
+            results = resp.get('results') or []
+            returned += len(results)
+            logger.debug('scene-search page from {}: {} of {} results'.format(
+                starting_number, len(results), resp.get('totalHits')))
+            if results:
+                yield results
+            next_record = resp.get('nextRecord')
+            if (not results or not next_record or
+                    next_record <= starting_number or
+                    (max_results is not None and returned >= max_results)):
+                return
+            starting_number = next_record
+
+    def scene_search_iter(self, headers, data, page_size=5000):
+        """
+        Stream scene results one at a time from scene_search_pages
+        """
+        for page in self.scene_search_pages(headers, data, page_size):
+            for scene in page:
+                yield scene
+
     def product_lookup(self, dataset, products):
         """
         Match the dataset/product with the M2M download-options code
@@ -313,7 +371,8 @@ class M2M(object):
         resp = self._api_request("post", "download-options", params, headers)
         codes = self.product_lookup(dataset, products)
         product_info = filter(lambda i: i['productCode'] in codes and i['available'], resp.get('data'))
-        return [(p.get('entityId'), p.get('id')) for p in product_info]
+        return [(p.get('entityId'), p.get('id'), p.get('productCode'))
+                for p in product_info]
 
     def download_retrieve(self, headers, label):
         """
@@ -352,16 +411,28 @@ class M2M(object):
 
         return resp
 
-    def get_download_urls(self, headers, entity_ids, product_ids, label):
+    def poll_download_urls(self, headers, entity_ids, product_ids, label,
+                           initial_wait=5, max_wait=120, backoff=2.0,
+                           deadline=3600):
         """
-        Use download-request and download-retrieve to get available data URLs
+        Use download-request, then poll download-retrieve until every
+        requested product is ready or the deadline passes.  Each URL is
+        yielded as soon as its status turns A/P/D, so downloads can start
+        while the rest of the request is still staging.
+
+        The poll interval starts at initial_wait seconds and grows by
+        backoff up to max_wait; it drops back to initial_wait whenever a
+        poll finds new URLs.  Products still staging at the deadline are
+        logged rather than silently dropped.
+
+        Yields:
+            Tuple[entityId, productCode, url]
         """
-        url_mapping = dict()
+        wanted = set(entity_ids)
+        expected = len(entity_ids)
         request_resp = self.download_request(headers, entity_ids, product_ids,
                                              label)['data']
 
-        request_avail  = request_resp.get('availableDownloads', [])
-        # request_prep = request_resp.get('preparingDownloads', [])
         req_duplicates = request_resp.get('duplicateProducts', [])
 
         if isinstance(req_duplicates, list):
@@ -369,51 +440,72 @@ class M2M(object):
         else:
             duplicates = set(req_duplicates.values())
 
-        for label_ in duplicates:
-            retrieve_resp = self.download_retrieve(headers, label_)['data']
-            retrieve_avail = retrieve_resp.get('available', [])
-            retrieve_requested = retrieve_resp.get('requested', [])
-            # M2M URL statusCodes that represent URLs we can use immediately
-            # A = Available
-            # P = Proxied
-            # D = Downloading
-            found = list(filter(lambda x: x['statusCode'] in ('A', 'P', 'D'), retrieve_avail + retrieve_requested))
-            logger.debug('Retrieved {}/{} downloads using duplicateProducts label {}'.format(len(found), len(entity_ids), label_))
-            for item in found:
-                key = item['entityId']
-                if key not in url_mapping:
-                    url_mapping[key] = item['url']
-            if len(url_mapping) >= len(entity_ids):
-                logger.debug('All {} URLs retrieved!'.format(len(entity_ids)))
-                return url_mapping
-
-        if len(request_avail) == len(entity_ids):
-            wait = None  # don't need to wait, all requested URLs are ready
-        else:
-            wait = 30  # seconds
-
-##        while (len(url_mapping) < len(entity_ids)):
-        if wait:
-            logger.info("Waiting for {} seconds before attempting to retrieve available downloads".format(wait))
+        # Products requested earlier under another label are retrieved
+        # through that label
+        labels = [label] + sorted(set(duplicates) - {label})
+
+        seen = set()
+        wait = initial_wait
+        stop_at = time.time() + deadline
+        polls = 0
+        while True:
+            found_new = 0
+            for label_ in labels:
+                retrieve_resp = self.download_retrieve(headers, label_)['data']
+                retrieve_avail = retrieve_resp.get('available', [])
+                retrieve_requested = retrieve_resp.get('requested', [])
+                # M2M URL statusCodes that represent URLs we can use immediately
+                # A = Available
+                # P = Proxied
+                # D = Downloading
+                for item in retrieve_avail + retrieve_requested:
+                    if item.get('statusCode') not in ('A', 'P', 'D'):
+                        continue
+                    # the labels of duplicates also list other requests' scenes
+                    if item.get('entityId') not in wanted:
+                        continue
+                    key = (item['entityId'], item.get('productCode'))
+                    if key in seen:
+                        continue
+                    seen.add(key)
+                    found_new += 1
+                    yield item['entityId'], item.get('productCode'), item['url']
+            polls += 1
+            logger.debug('Retrieved {}/{} downloads for label {} (poll {})'.format(len(seen), expected, label, polls))
+
+            if len(seen) >= expected:
+                logger.debug('All {} URLs retrieved!'.format(expected))
+                return
+            if time.time() >= stop_at:
+                missing = sorted(wanted - set(entity_id for entity_id, product_code in seen))
+                logger.warning('Staging deadline reached for label {}: {} of {} downloads still not available: {}'.format(label, expected - len(seen), expected, ', '.join(missing)))
+                return
+
+            wait = initial_wait if found_new else min(wait * backoff, max_wait)
+            wait = min(wait, max(stop_at - time.time(), 0))
+            logger.info("{}/{} downloads ready, polling again in {:.0f} seconds".format(len(seen), expected, wait))
             time.sleep(wait)
-        
-        retr_resp = self.download_retrieve(headers, label)['data']
-        retrieve_avail = retr_resp.get('available', [])
-        retrieve_requested   = retr_resp.get('requested', [])
 
-        found = list(filter(lambda x: x['statusCode'] in ('A', 'P', 'D'), retrieve_avail + retrieve_requested))
-        for item in found:
-            if len(found) > 1:
+    def get_download_urls(self, headers, entity_ids, product_ids, label,
+                          **kwargs):
+        """
+        Use download-request and download-retrieve to get available data URLs
+
+        Collects poll_download_urls into a dict keyed by entityId, or by
+        entityId_productCode when more than one product was retrieved
+        """
+        found = list(self.poll_download_urls(headers, entity_ids, product_ids,
+                                             label, **kwargs))
+        url_mapping = dict()
+        for entity, product_code, url in found:
+            if len(found) > 1 and product_code:
                 # multiple products for this dataset
-                key = item['entityId']
-                key2 = item['productCode']
-                key = key + '_' + key2
+                key = entity + '_' + product_code
             else:
                 # only one product with this dataset
-                key = item['entityId']
+                key = entity
             if key not in url_mapping:
-                url_mapping[key] = item['url']
-
+                url_mapping[key] = url
         return url_mapping
 
     @staticmethod
@@ -490,7 +582,7 @@ class M2M(object):
 
 
 def handle_redirect(x):
-    head = requests.head(x, timeout=60)
+    head = m2m_session.get_session().head(x, timeout=60)
     location = head.headers.get('Location')
     if location is None:
         msg = 'Error retrieving redirect URL for {}'.format(x)
@@ -502,19 +594,122 @@ def handle_redirect(x):
     return redirect_url
 
 
-def download_url(x):
+SEGMENT_MIN_SIZE = 64 * 1024 * 1024  # only segment files at least this big
+
+
+def _save_segment_state(state_file, state):
+    tmp = state_file + '.tmp'
+    with open(tmp, 'w') as f:
+        json.dump(state, f)
+    os.replace(tmp, state_file)
+
+
+def download_segmented(session, fileurl, local_fname, file_size, segments=4,
+                       progress=None, chunk_size=1024*1024):
+    """
+    Fetch one file as N concurrent byte ranges into a preallocated *.part
+
+    Per-segment progress is kept in *.part.segments as
+    {"size": file_size, "segments": [[start, end, received], ...]}, so an
+    interrupted download resumes each range where it stopped.  The *.part is
+    renamed to local_fname once every range is complete.
+    """
+    part = local_fname + '.part'
+    state_file = part + '.segments'
+    state = None
+    if os.path.exists(state_file) and os.path.exists(part):
+        try:
+            with open(state_file, 'r') as f:
+                state = json.load(f)
+        except ValueError:
+            state = None
+        if state and state.get('size') != file_size:
+            state = None
+
+    if state is None:
+        step = -(-file_size // segments)
+        state = {'size': file_size,
+                 'segments': [[a, min(a + step, file_size) - 1, 0]
+                              for a in range(0, file_size, step)]}
+        with open(part, 'wb') as f:
+            if hasattr(os, 'posix_fallocate'):
+                os.posix_fallocate(f.fileno(), 0, file_size)
+            else:
+                f.truncate(file_size)
+        _save_segment_state(state_file, state)
+
+    lock = threading.Lock()
+    filename = os.path.basename(local_fname)
+    received = [sum(seg[2] for seg in state['segments'])]
+    resumed = received[0]
+
+    def fetch(seg):
+        start, end = seg[0], seg[1]
+        if start + seg[2] > end:
+            return
+        headers = {'Range': 'bytes=%d-%d' % (start + seg[2], end)}
+        with session.get(fileurl, headers=headers, timeout=6000, stream=True,
+                         verify=False, allow_redirects=True) as sock, \
+                open(part, 'r+b') as f:
+            if sock.status_code != 206:
+                raise DDSError('Range request not honoured ({}) for {}'.format(
+                    sock.status_code, fileurl))
+            f.seek(start + seg[2])
+            for n, block in enumerate(sock.iter_content(chunk_size=chunk_size)):
+                if not block:
+                    continue
+                block = block[:end + 1 - start - seg[2]]
+                f.write(block)
+                with lock:
+                    seg[2] += len(block)
+                    received[0] += len(block)
+                    if n % 16 == 15:
+                        _save_segment_state(state_file, state)
+                if progress:
+                    progress(filename, received[0], file_size)
+
+    start = time.time()
+    try:
+        with ThreadPoolExecutor(max_workers=len(state['segments'])) as executor:
+            for future in [executor.submit(fetch, seg) for seg in state['segments']]:
+                future.result()
+    finally:
+        with lock:
+            _save_segment_state(state_file, state)
+
+    incomplete = [seg for seg in state['segments'] if seg[0] + seg[2] <= seg[1]]
+    if incomplete:
+        raise DDSError('{} of {} segments incomplete for {}'.format(
+            len(incomplete), len(state['segments']), local_fname))
+
+    ns = time.time() - start
+    mb = (received[0] - resumed) / float(1024*1024)
+    logger.info("Complete - %s (%3.2f (MB) in %3.2f (s), or  %3.2f (MB/s), %d segments) \n" % (filename, mb, ns, mb/max(ns, 1e-6), len(state['segments'])))
+    os.rename(part, local_fname)
+    os.remove(state_file)
+
+
+def download_url(x, progress=None, segments=1,
+                 segment_min_size=SEGMENT_MIN_SIZE):
+    # progress: optional callable(filename, bytes_recv, file_size) called
+    # after every block written
+    # segments: fetch files >= segment_min_size as this many concurrent byte
+    # ranges when the server honours Range (see download_segmented)
+    # Returns a dict (filename, path, size, checksum, skipped) once the file
+    # is complete on disk, or None if the transfer ended short
     # We need to get the redirect URL first
     pattern = r'(L[E|T|O|C]\d{2}_L\d{1}\w{2}_\d{6}_\d{8}_\d{8}_\d{2}_\w\d(\.tar)?)|(L\w{1}\d{2}_\w{2}_\d{6}_\d{8}_\d{8}_\d{2}_\d{2}*.tar)|(L1C_.*\.zip)|(S2A_.*\.zip)'
     fileurl, directory = x[0], x[1]
     bytes_recv = 0
     bytes_in_mb = 1024*1024
+    session = m2m_session.get_session()
 
     if 'download-staging' in fileurl:
         fileurl_ = handle_redirect(fileurl)
     else:
         fileurl_ = fileurl
 
-    head = requests.head(fileurl_, timeout=60)
+    head = session.head(fileurl_, timeout=60)
 
     content_disposition = head.headers.get('Content-Disposition')
     location = head.headers.get('Location')
@@ -539,52 +734,114 @@ def download_url(x):
         filename = filename + '.tar'
 
     local_fname = os.path.join(directory, filename)
+
+    def completed(skipped=False):
+        size = os.path.getsize(local_fname)
+        mtime = os.path.getmtime(local_fname)
+        # a file already there keeps the checksum its manifest recorded
+        checksum = stored_checksum(directory, filename, size, mtime) \
+            if skipped else None
+        return dict(filename=filename, path=local_fname, size=size,
+                    mtime=mtime, skipped=skipped,
+                    checksum=checksum or file_checksum(local_fname))
+
     if os.path.exists(local_fname):
         logger.warning('Already exists - skipping: %s \n' % local_fname)
-        return
+        return completed(skipped=True)
     try:
         file_size = None
         if 'Content-Length' in head.headers:
             file_size = int(head.headers['Content-Length'])
-            
-            if os.path.exists(local_fname + '.part'):
-                bytes_recv = os.path.getsize(local_fname + '.part')
 
-            logger.info("Downloading\n\t{}\n\tto\n\t{} ... \n".format(fileurl_, local_fname))
-            resume_header = {'Range': 'bytes=%d-' % bytes_recv}
-            sock = requests.get(fileurl_, headers=resume_header, timeout=6000,
-                                stream=True, verify=False, allow_redirects=True)
+            part = local_fname + '.part'
+            ranges = head.headers.get('Accept-Ranges', '').lower() == 'bytes'
+
+            # A preallocated *.part of a segmented download is only ever
+            # resumed segment by segment, whatever segments is now
+            if os.path.exists(part + '.segments'):
+                if ranges:
+                    logger.info("Resuming\n\t{}\n\tto\n\t{} (segmented) ... \n".format(fileurl_, local_fname))
+                    download_segmented(session, fileurl_, local_fname,
+                                       file_size, max(segments, 1), progress)
+                    return completed()
+                for leftover in (part, part + '.segments'):
+                    if os.path.exists(leftover):
+                        os.remove(leftover)
+
+            # Segmented fetch, unless a single-stream *.part is being resumed
+            if (segments > 1 and file_size >= segment_min_size and ranges and
+                    not os.path.exists(part)):
+                logger.info("Downloading\n\t{}\n\tto\n\t{} ({} segments) ... \n".format(fileurl_, local_fname, segments))
+                download_segmented(session, fileurl_, local_fname, file_size,
+                                   segments, progress)
+                return completed()
+
+            if os.path.exists(part):
+                bytes_recv = os.path.getsize(part)
+                if bytes_recv >= file_size:
+                    # can't tell a complete *.part from a padded one
+                    os.remove(part)
+                    bytes_recv = 0
 
+            logger.info("Downloading\n\t{}\n\tto\n\t{} ... \n".format(fileurl_, local_fname))
+            resume_header = {'Range': 'bytes=%d-' % bytes_recv} if bytes_recv else {}
             start = time.time()
-            with open(local_fname + '.part', 'ab') as f:
-                
-                for block in sock.iter_content(chunk_size=bytes_in_mb):
-                    if block:
-                        f.write(block)
-                        bytes_recv += len(block)
+            with session.get(fileurl_, headers=resume_header, timeout=6000,
+                             stream=True, verify=False,
+                             allow_redirects=True) as sock:
+                if bytes_recv and sock.status_code == 200:
+                    # Range ignored, the whole file is coming: start over
+                    logger.info('Range not honoured, restarting {}'.format(filename))
+                    bytes_recv = 0
+                elif bytes_recv and (sock.status_code != 206 or not
+                        sock.headers.get('Content-Range', '').startswith(
+                            'bytes %d-' % bytes_recv)):
+                    raise DDSError('Cannot resume {} at byte {} ({} {})'.format(
+                        filename, bytes_recv, sock.status_code,
+                        sock.headers.get('Content-Range')))
+                elif sock.status_code != 200 and not bytes_recv:
+                    raise DDSError('HTTP {} for {}'.format(sock.status_code,
+                                                           fileurl_))
+                with open(part, 'ab' if bytes_recv else 'wb') as f:
+                    for block in sock.iter_content(chunk_size=bytes_in_mb):
+                        if block:
+                            f.write(block)
+                            bytes_recv += len(block)
+                            if progress:
+                                progress(filename, bytes_recv, file_size)
             ns = time.time() - start
             mb = bytes_recv/float(bytes_in_mb)
-            logger.info("Complete - %s (%3.2f (MB) in %3.2f (s), or  %3.2f (MB/s)) \n" % (filename, mb, ns, mb/ns))
+            logger.info("Complete - %s (%3.2f (MB) in %3.2f (s), or  %3.2f (MB/s)) \n" % (filename, mb, ns, mb/max(ns, 1e-6)))
+
+            if bytes_recv == file_size:
+                os.rename(part, local_fname)
+                return completed()
+            if bytes_recv > file_size:
+                os.remove(part)
+                raise DDSError('{} is {} bytes, expected {}'.format(
+                    filename, bytes_recv, file_size))
+            return None
 
-            if bytes_recv >= file_size:
-                os.rename(local_fname + '.part', local_fname) 
-        
         else:  # content-length unknown - cloud-hosted?
             if os.path.exists(local_fname + '.part'):
                 # We aren't gonna deal with this if we don't know
                 # the final file size
                 os.remove(local_fname + '.part')
             logger.info("Downloading\n\t{}\n\tto\n\t{} ... \n".format(fileurl_, local_fname))
-            sock = requests.get(fileurl_, timeout=6000, stream=True, verify=False, allow_redirects=True)
             start = time.time()
-            with open(local_fname, 'ab') as f:
+            with session.get(fileurl_, timeout=6000, stream=True, verify=False,
+                             allow_redirects=True) as sock, \
+                    open(local_fname, 'ab') as f:
                 for block in sock.iter_content(chunk_size=bytes_in_mb):
                     if block:
                         f.write(block)
                         bytes_recv += len(block)
+                        if progress:
+                            progress(filename, bytes_recv, file_size)
             ns = time.time() - start
             mb = bytes_recv/float(bytes_in_mb)
             logger.info("Complete - %s (%3.2f (MB) in %3.2f (s), or  %3.2f (MB/s)) \n" % (filename, mb, ns, mb/ns))
+            return completed()
     except Exception as e:
         try:
             # Need to remove the *.tar/*.zip/*.tar.gz
@@ -594,11 +851,109 @@ def download_url(x):
             pass
         raise
 
-def download_url_wrapper(x):
+def download_url_wrapper(x, progress=None, segments=1):
+    """
+    Download one URL, never raise.
+
+    x is (url, directory) or (url, directory, entityId, productCode).  Returns a dict with
+    the work item, the download_url result (None if incomplete), the error
+    message if it failed and the connection counters used by this download,
+    so the parent can update the manifest and report reuse across worker
+    processes.
+    """
+    before = m2m_session.connection_stats()
+    result = dict(item=x, download=None, error=None)
     try:
-        download_url(x)
+        result['download'] = download_url(x, progress=progress,
+                                          segments=segments)
     except Exception as e:
         logger.warning('\n\n *** Failed download %s: %s \n' % (x[0], str(e)))
+        result['error'] = str(e) or e.__class__.__name__
+    result['connections'] = m2m_session.stats_delta(
+        m2m_session.connection_stats(), before)
+    return result
+
+
+class DownloadEngine(object):
+    """
+    Thread-based alternative to the multiprocessing.Pool download mode
+
+    Every transfer is a thread blocked on a socket read of the shared,
+    pooled session instead of a whole worker process, so hundreds of
+    transfers can be in flight at once.  Concurrency is bounded overall
+    (threads) and per download host (per_host).  Files stream into their
+    *.part file exactly as download_url does, progress is logged per file
+    every progress_interval seconds and join() waits without a global
+    timeout.
+
+    Usage:
+        engine = DownloadEngine(threads=200, per_host=32)
+        engine.submit((url, directory))
+        ...
+        engine.join()
+    """
+
+    def __init__(self, threads=64, per_host=16, progress_interval=30,
+                 segments=1):
+        self.per_host = per_host
+        self.segments = segments
+        self.progress_interval = progress_interval
+        self._executor = ThreadPoolExecutor(max_workers=threads)
+        self._host_slots = dict()
+        self._lock = threading.Lock()
+        self._futures = []
+        self.completed = 0
+
+    def _slot(self, url):
+        host = urlparse(url).netloc
+        with self._lock:
+            if host not in self._host_slots:
+                self._host_slots[host] = threading.BoundedSemaphore(self.per_host)
+            return self._host_slots[host]
+
+    def _progress(self):
+        last = [time.time()]
+
+        def report(filename, bytes_recv, file_size):
+            now = time.time()
+            if now - last[0] < self.progress_interval:
+                return
+            last[0] = now
+            mb = bytes_recv / float(1024 * 1024)
+            if file_size:
+                logger.info('Progress - %s %3.2f (MB) %3.1f%%' % (
+                    filename, mb, 100.0 * bytes_recv / file_size))
+            else:
+                logger.info('Progress - %s %3.2f (MB)' % (filename, mb))
+        return report
+
+    def _run(self, x):
+        with self._slot(x[0]):
+            result = download_url_wrapper(x, progress=self._progress(),
+                                          segments=self.segments)
+        with self._lock:
+            self.completed += 1
+        return result
+
+    def submit(self, x):
+        """
+        Queue one (url, directory) work item, returns a Future
+        """
+        future = self._executor.submit(self._run, x)
+        with self._lock:
+            self._futures.append(future)
+        return future
+
+    def pending(self):
+        with self._lock:
+            return sum(1 for f in self._futures if not f.done())
+
+    def join(self):
+        """
+        Wait for every submitted download, no global timeout
+        """
+        self._executor.shutdown(wait=True)
+        return [f.result() for f in self._futures]
 
 
 def chunkify(iterable, n=1):
@@ -618,12 +973,128 @@ def clean(param):
         return param
 
 
+def tile_name(h, v):
+    """
+    ARD tile folder name, same as TILE_LONG in download_one_tile.sh
+    """
+    return 'h{:03d}v{:03d}'.format(int(h), int(v))
+
+
+def parse_tile(tile):
+    """
+    Parse a tile given as (h, v), "h,v" or "h v"
+    """
+    if isinstance(tile, (tuple, list)):
+        h, v = tile
+    else:
+        h, v = re.split(r'[\s,]+', tile.strip())
+    return int(h), int(v)
+
+
+def read_tile_list(tile_file):
+    """
+    Read ARD tiles from a text file, one tile per line.  The last two
+    integers on each line are taken as h and v, so plain "h v" / "h,v" lists
+    work as well as the existing download_multiple_tiles.sh.  Blank lines and
+    lines starting with # are skipped.
+
+    :return: List[Tuple[h, v]]
+    """
+    tiles = []
+    with open(tile_file, 'r') as f:
+        for line in f:
+            line = line.strip()
+            if not line or line.startswith('#'):
+                continue
+            match = re.search(r'(\d+)[\s,]+(\d+)\s*$', line)
+            if match:
+                tiles.append((int(match.group(1)), int(match.group(2))))
+    return tiles
+
+
+def build_scene_filter(m2m, dataset, h=None, v=None, p=None, r=None,
+                       sensor=None, spacecraft=None, satellite=None,
+                       region=None, prod_date=None, cloud_cover=None,
+                       land_cloud_cover=None, tile_number=None, platform=None,
+                       acq_date=None):
+    """
+    Build the scene-search sceneFilter for one set of criteria
+    """
+    scene_filter = dict(
+        metadataFilter    = None,
+        cloudCoverFilter  = {"max": 100, "min": 0},
+        acquisitionFilter = None
+    )
+
+    if any([h, v, p, r, sensor, spacecraft, region, prod_date, cloud_cover,
+            land_cloud_cover, tile_number, platform]):
+        scene_filter.update(m2m.additionalCriteriaValues(m2m, dataset=dataset,
+             h=h, v=v, p=p, r=r, s=sensor, sc=spacecraft, sat=satellite,
+             rg=region, pd=clean(prod_date), cc=cloud_cover,
+             lcc=land_cloud_cover, tile_number=tile_number, platform=platform))
+
+    if acq_date:
+        scene_filter.update(m2m.temporalCriteria(ad=clean(acq_date)))
+
+    return scene_filter
+
+
+def search_tiles(m2m, get_header, dataset, N, jobs, filter_kwargs, workers=8,
+                 cache=None, page_size=5000):
+    """
+    Run one paginated scene-search per tile concurrently on the shared
+    session.  Only the display/entity IDs of each result are kept.
+
+    Args:
+        get_header: callable returning the X-Auth-Token header, only called
+                    when a search is not answered by the cache
+        jobs: List[Tuple[directory, h, v]]
+        filter_kwargs: criteria shared by all tiles (see build_scene_filter)
+        cache: SearchCache [Optional]
+    Returns:
+        List[Tuple[directory, display_ids, entity_ids]] in the order of jobs
+    """
+    def search_one(job):
+        directory, h, v = job
+        scene_filter = build_scene_filter(m2m, dataset, h=h, v=v,
+                                          **filter_kwargs)
+        search = dict(
+            datasetName = dataset,
+            maxResults  = "{}".format(N),
+            sceneFilter = scene_filter)
+        results = cache.get(search) if cache else None
+        source = 'cache'
+        if results is None:
+            source = 'M2M'
+            results = m2m.scene_search_iter(get_header(), search, page_size)
+            if cache:
+                results = cache.store(search, results)
+        display_ids, entity_ids = [], []
+        for scene in results:
+            display_ids.append(scene['displayId'])
+            entity_ids.append(scene['entityId'])
+        logger.info('Total search results for {}: {} ({}) \n'.format(
+            directory, len(entity_ids), source))
+        return directory, display_ids, entity_ids
+
+    workers = max(1, min(workers, len(jobs)))
+    with ThreadPoolExecutor(max_workers=workers) as executor:
+        return list(executor.map(search_one, jobs))
+
+
 def download_files(directory, h=None, v=None, p=None, r=None, username=None, token=None,
                    dataset=None, tile_number=None, sensor=None, spacecraft=None,
                    satellite=None, region=None, N=15000, products=None,
                    acq_date=None, prod_date=None, cloud_cover=None,
                    land_cloud_cover=None, platform=None, threads=12,
-                   search_only=False, instance='ops', debug=False):
+                   search_only=False, instance='ops', pool_size=None,
+                   retries=None, tiles=None, tile_file=None, batch_size=1000,
+                   search_threads=8, engine='process', per_host=16,
+                   segments=1, staging_deadline=3600, use_manifest=True,
+                   page_size=5000, search_cache_ttl=DEFAULT_TTL,
+                   search_cache_dir=DEFAULT_DIR, on_complete=None,
+                   before_submit=None, on_failed=None, configure_session=True,
+                   debug=False):
     """
     Search for and download files to local directory
 
@@ -656,88 +1127,242 @@ def download_files(directory, h=None, v=None, p=None, r=None, username=None, tok
             threads: Number of download threads to launch in parallel
             search_only: Boolean, if true only show results, don't download
             instance: What instance of M2M to use (devsys, devmast, ops)
+            pool_size: Keep-alive connections per host [Default: m2m_session]
+            retries: HTTP-level retries with backoff [Default: m2m_session]
+            tiles: List of ARD tiles [(h, v) or "h,v"] to fetch in one run.
+                   Each tile is written to directory/hHHHvVVV [Optional]
+            tile_file: Text file of ARD tiles, see read_tile_list [Optional]
+            batch_size: Max entity IDs per download-options/download-request
+            search_threads: Number of concurrent scene-searches (tile mode)
+            engine: Download engine, 'process' (multiprocessing.Pool) or
+                    'thread' (DownloadEngine, no global timeout)
+            per_host: Max concurrent downloads per host (thread engine)
+            segments: Byte ranges fetched concurrently per large file
+            staging_deadline: Seconds to keep polling for staging products
+            use_manifest: Keep a download_manifest.sqlite in each download
+                          directory and skip scenes it lists as complete
+            page_size: scene-search results requested per page
+            search_cache_ttl: Seconds a cached scene-search stays valid,
+                              0 disables the cache
+            search_cache_dir: Directory of the scene-search cache
+            on_complete: Optional callable(download, item) called with the
+                         download_url result (filename, path, size, ...)
+                         and the work item once a file is complete on disk.
+                         It runs in this process; with the thread engine it
+                         runs in the download thread, so blocking in it
+                         holds that download slot (backpressure)
+            before_submit: Optional callable(item) called before each URL is
+                           queued for download; blocking in it throttles the
+                           downloads (e.g. on free disk space)
+            on_failed: Optional callable(item, error) called, like
+                       on_complete, when the download of a work item failed
+                       or ended short
+            configure_session: Apply pool_size/retries (and the thread
+                               engine's pool size) to this process's shared
+                               session.  Pass False when several calls run
+                               at once on a session configured beforehand:
+                               configuring closes the session in use
             debug (bool): If True, set log level to DEBUG
     """
     if debug:
         stream.setLevel(logging.DEBUG)
 
+    if configure_session:
+        m2m_session.configure(pool_maxsize=pool_size, retries=retries)
+
     if not directory and not search_only:
         logger.error('Must specify download directory')
         sys.exit(0)
 
-    if directory and not os.path.exists(directory):
-        os.makedirs(directory)
-
-    m2m = M2M(instance)
-
-    full_token = m2m.login(username=username, token=token) # or input('Enter ERS username: '))
-    header = {'X-Auth-Token': full_token}
-    
-    scene_filter = dict(
-        metadataFilter    = None,
-        cloudCoverFilter  = {"max": 100, "min": 0},
-        acquisitionFilter = None
-    )
-    
-    if any([h, v, p, r, sensor, spacecraft, region, prod_date, cloud_cover,
-            land_cloud_cover, tile_number, platform]):
-        scene_filter.update(m2m.additionalCriteriaValues(m2m, dataset=dataset,
-             h=h, v=v, p=p, r=r, s=sensor, sc=spacecraft, sat=satellite,
-             rg=region, pd=clean(prod_date), cc=cloud_cover,
-             lcc=land_cloud_cover, tile_number=tile_number, platform=platform))
-    
-    if acq_date:
-        scene_filter.update(m2m.temporalCriteria(ad=clean(acq_date)))
+    # One (directory, h, v) job per tile; a single job without a tile list
+    tile_list = [parse_tile(t) for t in (tiles or [])]
+    if tile_file:
+        tile_list.extend(read_tile_list(tile_file))
+    # Tiles listed more than once are searched and downloaded once
+    tile_list = list(dict.fromkeys(tile_list))
+    if tile_list:
+        jobs = [(os.path.join(directory or '.', tile_name(th, tv)), th, tv)
+                for th, tv in tile_list]
+    else:
+        jobs = [(directory, h, v)]
 
-    search = dict(
-        datasetName = dataset, 
-        maxResults  = "{}".format(N),
-        sceneFilter = scene_filter)
-    
-    results = m2m.scene_search(header, search)
-    n_results = results.get('totalHits')
-    display_ids, entity_ids = get_product_ids(results.get('results'))
+    for job_dir, _, _ in jobs:
+        if job_dir and not os.path.exists(job_dir):
+            os.makedirs(job_dir)
 
-    logger.info('Total search results: %d \n' % n_results)
+    m2m = M2M(instance)
 
-    if len(display_ids) < 1:
+    # Log in on first use, searches answered by the cache don't need it
+    header = dict()
+    login_lock = threading.Lock()
+
+    def get_header():
+        with login_lock:
+            if not header:
+                full_token = m2m.login(username=username, token=token) # or input('Enter ERS username: '))
+                header['X-Auth-Token'] = full_token
+        return header
+
+    cache = SearchCache(search_cache_dir, search_cache_ttl, instance) \
+        if search_cache_ttl else None
+
+    filter_kwargs = dict(p=p, r=r, sensor=sensor, spacecraft=spacecraft,
+                         satellite=satellite, region=region,
+                         prod_date=prod_date, cloud_cover=cloud_cover,
+                         land_cloud_cover=land_cloud_cover,
+                         tile_number=tile_number, platform=platform,
+                         acq_date=acq_date)
+    searches = search_tiles(m2m, get_header, dataset, N, jobs, filter_kwargs,
+                            search_threads, cache, page_size)
+
+    # entityId -> destination directory, across all tiles
+    entity_dirs = dict()
+    for job_dir, display_ids, entity_ids in searches:
+        for e in entity_ids:
+            entity_dirs.setdefault(e, job_dir)
+
+    logger.info('Total search results: %d \n' % len(entity_dirs))
+
+    if len(entity_dirs) < 1:
         logger.warning('No results found!')
         sys.exit(0)
 
     if not search_only:
-        download_info = m2m.download_options(header, entity_ids, dataset,
-                                             products)
-        e_ids = [x[0] for x in download_info]
-        d_ids = [x[1] for x in download_info]
-        work_todo = list()
-
-        # Make the initial download request, then sleep for 10 seconds
-        # to allow data to stage
-        # List[url]
+        # Per-directory manifests: drop scenes already downloaded before any
+        # download-options/download-request call
+        manifests = dict()
+        if use_manifest:
+            for job_dir, display_ids, tile_entity_ids in searches:
+                if job_dir not in manifests:
+                    manifests[job_dir] = DownloadManifest(job_dir)
+                manifests[job_dir].record_search(tile_entity_ids, display_ids)
+            completed = {d: m.completed_entity_ids()
+                         for d, m in manifests.items()}
+            n_found = len(entity_dirs)
+            entity_dirs = {e: d for e, d in entity_dirs.items()
+                           if e not in completed[d]}
+            logger.info('Skipping {} scenes already in the download manifest'.format(n_found - len(entity_dirs)))
+            if not entity_dirs:
+                logger.info('Nothing left to download')
+                return None
+
+        def record(result):
+            # runs in this process (pool result handler / engine thread)
+            item = result['item']
+            manifest = manifests.get(item[1])
+            if manifest is not None and len(item) >= 3:
+                product = item[3] if len(item) >= 4 else ''
+                if result['download']:
+                    d = result['download']
+                    manifest.mark_complete(item[2], item[0], d['filename'],
+                                           d['size'], d['checksum'], product,
+                                           d['mtime'])
+                else:
+                    manifest.mark_failed(item[2], item[0],
+                                         result['error'] or 'incomplete download',
+                                         product)
+            if on_complete is not None and result['download']:
+                on_complete(result['download'], item)
+            elif on_failed is not None and not result['download']:
+                on_failed(item, result['error'] or 'incomplete download')
+
+        entity_ids = list(entity_dirs.keys())
         now = datetime.datetime.strftime(datetime.datetime.now(),
                                          '%Y%m%d%H%M%S')
-        label = f'{dataset}-{now}'
-        # req_avail = m2m.download_request(header, e_ids, d_ids, label)
-        # dict entityId: URL
-        urls = m2m.get_download_urls(header, e_ids, d_ids, label)
-        work_todo.extend([(x, directory) for x in urls.values()])
 
-        pool = multiprocessing.Pool(threads)
-        pool.map_async(download_url_wrapper, work_todo).get(6000)
-        pool.close()
-        pool.join()
+        # One shared download pool for every tile, fed while URLs stage
+        if engine == 'thread':
+            # Keep enough keep-alive connections for every in-flight transfer
+            if configure_session:
+                m2m_session.configure(pool_maxsize=max(
+                    pool_size or m2m_session.POOL_MAXSIZE, per_host * segments))
+            downloader = DownloadEngine(threads, per_host, segments=segments)
+            submit = lambda item: downloader.submit(item).add_done_callback(
+                lambda f: record(f.result()))
+        else:
+            pool = multiprocessing.Pool(threads,
+                                        initializer=m2m_session.configure,
+                                        initargs=(None, pool_size, retries))
+            worker = functools.partial(download_url_wrapper, segments=segments)
+            async_results = []
+            submit = lambda item: async_results.append(
+                pool.apply_async(worker, (item,), callback=record))
+
+        queued = set()
+        queued_lock = threading.Lock()
+
+        def request_batch(n, chunk):
+            download_info = m2m.download_options(get_header(), chunk, dataset,
+                                                 products)
+            e_ids = [x[0] for x in download_info]
+            d_ids = [x[1] for x in download_info]
+            if not e_ids:
+                return 0
+            for entity, _, code in download_info:
+                if entity_dirs.get(entity) in manifests:
+                    manifests[entity_dirs[entity]].record_products(entity, [code])
+
+            # Request the batch and stream each URL into the download pool
+            # the moment it is staged
+            label = f'{dataset}-{now}' if n == 0 else f'{dataset}-{now}-{n}'
+            count = 0
+            for entity, code, url in m2m.poll_download_urls(
+                    get_header(), e_ids, d_ids, label,
+                    deadline=staging_deadline):
+                with queued_lock:
+                    if url in queued:
+                        continue
+                    queued.add(url)
+                entity_dir = entity_dirs.get(entity, directory)
+                item = (url, entity_dir, entity, code)
+                if before_submit is not None:
+                    before_submit(item)
+                if entity_dir in manifests:
+                    manifests[entity_dir].mark_queued(entity, url, code)
+                submit(item)
+                count += 1
+            return count
+
+        # Batched download-options/download-request over the merged entity
+        # list of every tile, staged concurrently
+        batches = list(enumerate(chunkify(entity_ids, batch_size)))
+        with ThreadPoolExecutor(max_workers=max(1, min(search_threads,
+                                                       len(batches)))) as executor:
+            n_queued = sum(executor.map(lambda b: request_batch(*b), batches))
+        logger.info('Queued {} of {} downloads'.format(n_queued,
+                                                        len(entity_ids)))
+
+        if engine == 'thread':
+            downloader.join()
+            logger.info('HTTP connections: {}'.format(
+                m2m_session.format_stats(m2m_session.connection_stats())))
+        else:
+            pool.close()
+            pool.join()
+            worker_stats = [r.get()['connections'] for r in async_results]
+            logger.info('M2M API connections: {}'.format(
+                m2m_session.format_stats(m2m_session.connection_stats())))
+            logger.info('Download connections: {}'.format(
+                m2m_session.format_stats(m2m_session.merge_stats(*worker_stats))))
+
+        for manifest in manifests.values():
+            manifest.close()
 
     else:
         now = datetime.datetime.now()
         name = datetime.datetime.strftime(now, '%Y-%m-%d_%H:%M:%S')
         name = 'results_{}.txt'.format(name)
-        text_output = os.path.join(directory, name)
-        with open(text_output, 'w') as f:
-            for i in display_ids:
-                f.write('{}\n'.format(i))
-        logger.info('SEARCH RESULTS: ')
-        logger.info('{}'.format(display_ids))
-        logger.info('Writing results to {}'.format(text_output))
+        for job_dir, display_ids, _ in searches:
+            if not display_ids:
+                logger.warning('No results found for {}'.format(job_dir))
+                continue
+            text_output = os.path.join(job_dir, name)
+            with open(text_output, 'w') as f:
+                for i in display_ids:
+                    f.write('{}\n'.format(i))
+            logger.info('SEARCH RESULTS: ')
+            logger.info('{}'.format(display_ids))
+            logger.info('Writing results to {}'.format(text_output))
 
     return None
 
@@ -805,6 +1430,55 @@ def build_command_line_arguments():
     parser.add_argument('--instance', type=str, dest='instance',
         choices=['devsys', 'devmast', 'ops'], default='ops',
         help='Which instance of M2M to use (devsys, devmast, ops)')
+    parser.add_argument('--tiles', type=str, dest='tiles', nargs='+',
+        default=None,
+        help='ARD tiles to fetch in one run, as h,v pairs (e.g. --tiles 3,10 '
+             '4,10). Each tile is written to DIRECTORY/hHHHvVVV')
+    parser.add_argument('--tile-file', type=str, dest='tile_file',
+        default=None,
+        help='File with one ARD tile per line ("h v", "h,v" or a '
+             'download_one_tile.sh call), same layout as --tiles')
+    parser.add_argument('--batch-size', type=int, dest='batch_size',
+        default=1000,
+        help='Max scenes per download-options/download-request call '
+             '[Default: 1000]')
+    parser.add_argument('--search-threads', type=int, dest='search_threads',
+        default=8,
+        help='Concurrent scene-searches in tile mode [Default: 8]')
+    parser.add_argument('--engine', type=str, dest='engine',
+        choices=['process', 'thread'], default='process',
+        help='Download engine: a multiprocessing pool, or threads on one '
+             'shared connection pool (use with a large -t) '
+             '[Default: process]')
+    parser.add_argument('--per-host', type=int, dest='per_host', default=16,
+        help='Max concurrent downloads per host with --engine thread '
+             '[Default: 16]')
+    parser.add_argument('--segments', type=int, dest='segments', default=1,
+        help='Fetch each large file (>= 64 MB) as this many concurrent byte '
+             'ranges when the server supports it [Default: 1]')
+    parser.add_argument('--staging-deadline', type=int,
+        dest='staging_deadline', default=3600,
+        help='Seconds to keep polling M2M for products that are still '
+             'staging [Default: 3600]')
+    parser.add_argument('--no-manifest', action='store_false',
+        dest='use_manifest',
+        help='Do not read or update download_manifest.sqlite; skip files '
+             'only when they already exist on disk')
+    parser.add_argument('--page-size', type=int, dest='page_size',
+        default=5000,
+        help='scene-search results requested per page [Default: 5000]')
+    parser.add_argument('--search-cache-ttl', type=int,
+        dest='search_cache_ttl', default=DEFAULT_TTL,
+        help='Seconds a cached scene-search is reused, 0 disables the cache '
+             '[Default: {}]'.format(DEFAULT_TTL))
+    parser.add_argument('--search-cache-dir', type=str,
+        dest='search_cache_dir', default=DEFAULT_DIR,
+        help='Scene-search cache directory [Default: {}]'.format(DEFAULT_DIR))
+    parser.add_argument('--pool-size', type=int, dest='pool_size',
+        default=None,
+        help='Keep-alive HTTP connections kept open per host [Default: 32]')
+    parser.add_argument('--retries', type=int, dest='retries', default=None,
+        help='HTTP-level retries with exponential backoff [Default: 5]')
     parser.add_argument('--debug', action='store_true', default=False,
         help='Set log level to DEBUG (Shows M2M POST requests/responses)')
     args = parser.parse_args()
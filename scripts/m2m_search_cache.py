@@ -0,0 +1,114 @@
+"""
+Local TTL cache of M2M scene-search results
+
+Results are cached per M2M instance and normalized search request
+(datasetName, sceneFilter and maxResults) as a JSON-lines file, one scene per line, so a cached search
+streams back with flat memory just like a paginated live search.  Entries
+older than the TTL are ignored and replaced on the next live search.
+"""
+
+import os
+import json
+import time
+import tempfile
+import hashlib
+import logging
+
+
+logger = logging.getLogger(__name__)
+
+DEFAULT_DIR = os.path.join(os.path.expanduser('~'), '.cache', 'm2m_search')
+DEFAULT_TTL = 600  # seconds
+
+
+def _normalize(value):
+    """
+    Drop None entries and sort keys so equivalent filters hash the same
+    """
+    if isinstance(value, dict):
+        return {k: _normalize(v) for k, v in sorted(value.items())
+                if v is not None}
+    if isinstance(value, (list, tuple)):
+        return [_normalize(v) for v in value]
+    return value
+
+
+def search_key(search, instance='ops'):
+    """
+    Cache key of a scene-search request sent to an M2M instance
+    """
+    normalized = _normalize(dict(instance=instance,
+                                 datasetName=search.get('datasetName'),
+                                 sceneFilter=search.get('sceneFilter'),
+                                 maxResults=str(search.get('maxResults'))))
+    text = json.dumps(normalized, sort_keys=True, separators=(',', ':'))
+    return hashlib.sha256(text.encode('utf-8')).hexdigest()
+
+
+class SearchCache(object):
+    """
+    Usage:
+        cache = SearchCache(ttl=600, instance='ops')
+        results = cache.get(search)          # iterator or None
+        if results is None:
+            results = cache.store(search, live_results)
+        for scene in results:
+            ...
+    """
+
+    def __init__(self, directory=DEFAULT_DIR, ttl=DEFAULT_TTL, instance='ops'):
+        self.directory = directory
+        self.ttl = ttl
+        self.instance = instance
+
+    def _path(self, search):
+        return os.path.join(self.directory,
+                            search_key(search, self.instance) + '.jsonl')
+
+    def get(self, search):
+        """
+        Iterator over the cached results of this search, or None on a miss
+        """
+        if not self.ttl:
+            return None
+        path = self._path(search)
+        try:
+            age = time.time() - os.path.getmtime(path)
+        except OSError:
+            return None
+        if age > self.ttl:
+            return None
+        logger.debug('Search cache hit {} ({:.0f} s old)'.format(path, age))
+        return self._read(path)
+
+    @staticmethod
+    def _read(path):
+        with open(path, 'r') as f:
+            for line in f:
+                if line.strip():
+                    yield json.loads(line)
+
+    def store(self, search, results):
+        """
+        Pass results through, writing them to the cache as they go.  The
+        entry only becomes visible once the iterator is exhausted, so an
+        interrupted search is never cached.  Each call writes its own temp
+        file, so identical searches running on several threads don't clash.
+        """
+        if not self.ttl:
+            for scene in results:
+                yield scene
+            return
+        os.makedirs(self.directory, exist_ok=True)
+        path = self._path(search)
+        fd, tmp = tempfile.mkstemp(dir=self.directory, suffix='.tmp',
+                                   prefix=os.path.basename(path) + '.')
+        try:
+            with os.fdopen(fd, 'w') as f:
+                for scene in results:
+                    f.write(json.dumps(scene, separators=(',', ':')) + '\n')
+                    yield scene
+            os.replace(tmp, path)
+        finally:
+            if os.path.exists(tmp):
+                os.remove(tmp)
@@ -0,0 +1,208 @@
+"""
+Shared, connection-pooled HTTP sessions for the M2M API and download workers
+
+Every M2M call (scene-search, download-options, download-request,
+download-retrieve) and every HEAD/GET against the download hosts goes through
+one keep-alive ``requests.Session`` per process, so TCP+TLS handshakes are
+paid once per host instead of once per request.  The session mounts an
+adapter with a per-host connection pool and HTTP-level retry/backoff, and
+counts how many requests were served on a reused connection.  The adapter
+only repeats HEAD/GET requests by itself; POSTs that are safe to send again
+(read-only M2M endpoints) go through request_with_retries.
+"""
+
+import os
+import time
+import threading
+import logging
+import requests
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
+from urllib3.connectionpool import HTTPConnectionPool, HTTPSConnectionPool
+
+
+logger = logging.getLogger(__name__)
+
+# Defaults, override with configure()
+POOL_CONNECTIONS = 10     # number of distinct hosts to keep pools for
+POOL_MAXSIZE = 32         # keep-alive connections kept open per host
+RETRIES = 5               # HTTP-level retries (connect, read and status)
+BACKOFF_FACTOR = 1.0      # sleep {backoff} * 2 ** (retry - 1) between retries
+STATUS_FORCELIST = (429, 500, 502, 503, 504)
+# methods the adapter retries on read errors and STATUS_FORCELIST responses
+RETRY_METHODS = frozenset(['HEAD', 'GET'])
+
+_config = dict(pool_connections=POOL_CONNECTIONS, pool_maxsize=POOL_MAXSIZE,
+               retries=RETRIES, backoff_factor=BACKOFF_FACTOR)
+_session = None
+_session_pid = None
+_lock = threading.Lock()
+
+# Connection counters for this process
+_stats = dict(requests=0, new_connections=0)
+_stats_lock = threading.Lock()
+
+
+def _count(key):
+    with _stats_lock:
+        _stats[key] += 1
+
+
+class _CountingPoolMixin(object):
+    """
+    Count connection checkouts (one per request attempt) and new connections,
+    so that reused = requests - new_connections
+    """
+
+    def _get_conn(self, *args, **kwargs):
+        _count('requests')
+        return super(_CountingPoolMixin, self)._get_conn(*args, **kwargs)
+
+    def _new_conn(self):
+        _count('new_connections')
+        return super(_CountingPoolMixin, self)._new_conn()
+
+
+class CountingHTTPConnectionPool(_CountingPoolMixin, HTTPConnectionPool):
+    pass
+
+
+class CountingHTTPSConnectionPool(_CountingPoolMixin, HTTPSConnectionPool):
+    pass
+
+
+class PooledAdapter(HTTPAdapter):
+    """
+    HTTPAdapter whose pool manager builds counting connection pools
+    """
+
+    def init_poolmanager(self, *args, **kwargs):
+        super(PooledAdapter, self).init_poolmanager(*args, **kwargs)
+        self.poolmanager.pool_classes_by_scheme = {
+            'http': CountingHTTPConnectionPool,
+            'https': CountingHTTPSConnectionPool}
+
+
+def configure(pool_connections=None, pool_maxsize=None, retries=None,
+              backoff_factor=None):
+    """
+    Change the pool/retry settings.  The next call to get_session() in this
+    process builds a new session with them.  Safe to use as a
+    multiprocessing.Pool initializer.
+    """
+    global _session
+    with _lock:
+        for key, value in (('pool_connections', pool_connections),
+                           ('pool_maxsize', pool_maxsize),
+                           ('retries', retries),
+                           ('backoff_factor', backoff_factor)):
+            if value is not None:
+                _config[key] = value
+        if _session is not None:
+            _session.close()
+            _session = None
+
+
+def new_session(pool_connections=POOL_CONNECTIONS, pool_maxsize=POOL_MAXSIZE,
+                retries=RETRIES, backoff_factor=BACKOFF_FACTOR):
+    """
+    Build a keep-alive session with a per-host pool and retry/backoff
+    """
+    retry = Retry(total=retries, connect=retries, read=retries,
+                  status=retries, backoff_factor=backoff_factor,
+                  status_forcelist=STATUS_FORCELIST,
+                  allowed_methods=RETRY_METHODS,
+                  raise_on_status=False, respect_retry_after_header=True)
+    adapter = PooledAdapter(pool_connections=pool_connections,
+                            pool_maxsize=pool_maxsize, max_retries=retry,
+                            pool_block=False)
+    session = requests.Session()
+    session.headers.update({'Connection': 'keep-alive'})
+    session.mount('https://', adapter)
+    session.mount('http://', adapter)
+    return session
+
+
+def get_session():
+    """
+    Return the shared session for this process.  A forked worker never
+    reuses the parent's sockets; it gets its own session on first use.
+    """
+    global _session, _session_pid
+    pid = os.getpid()
+    if _session is None or _session_pid != pid:
+        with _lock:
+            if _session is None or _session_pid != pid:
+                _session = new_session(**_config)
+                _session_pid = pid
+                logger.debug('New HTTP session (pid {}, {})'.format(pid, _config))
+    return _session
+
+
+def request_with_retries(verb, url, **kwargs):
+    """
+    session.<verb>(url, **kwargs) retried on connection/read errors and
+    STATUS_FORCELIST responses with the configured retries and backoff, for
+    requests that are safe to repeat but that the adapter doesn't retry
+    (POST).  The last response (or error) is returned (raised).
+    """
+    retries = _config['retries']
+    for attempt in range(retries + 1):
+        try:
+            response = getattr(get_session(), verb)(url, **kwargs)
+        except (requests.ConnectionError, requests.Timeout) as e:
+            if attempt == retries:
+                raise
+            reason = e.__class__.__name__
+            wait = _config['backoff_factor'] * 2 ** attempt
+        else:
+            if response.status_code not in STATUS_FORCELIST or \
+                    attempt == retries:
+                return response
+            reason = 'HTTP {}'.format(response.status_code)
+            wait = _config['backoff_factor'] * 2 ** attempt
+            retry_after = response.headers.get('Retry-After', '')
+            if retry_after.isdigit():
+                wait = max(wait, int(retry_after))
+        logger.warning('Retrying {} {} in {:.0f} s ({})'.format(
+            verb.upper(), url, wait, reason))
+        time.sleep(wait)
+
+
+def connection_stats():
+    """
+    Snapshot of the connection counters for this process
+
+    :return: dict with requests, new_connections and reused
+    """
+    with _stats_lock:
+        stats = dict(_stats)
+    stats['reused'] = max(stats['requests'] - stats['new_connections'], 0)
+    return stats
+
+
+def stats_delta(after, before):
+    """
+    Difference between two connection_stats() snapshots
+    """
+    return {k: after[k] - before.get(k, 0) for k in after}
+
+
+def merge_stats(*stats):
+    """
+    Sum connection_stats() snapshots (e.g. from several worker processes)
+    """
+    total = dict(requests=0, new_connections=0, reused=0)
+    for s in stats:
+        if s:
+            for k in total:
+                total[k] += s.get(k, 0)
+    return total
+
+
+def format_stats(stats):
+    requests_ = stats.get('requests', 0)
+    reused = stats.get('reused', 0)
+    pct = 100.0 * reused / requests_ if requests_ else 0.0
+    return '{} requests, {} new connections, {} reused ({:3.1f}%)'.format(
+        requests_, stats.get('new_connections', 0), reused, pct)
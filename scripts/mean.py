@@ -2,6 +2,8 @@ import os
 import numpy as np
 import rasterio
 
+import raster_io
+
 def calculate_mean_nbr_image(directory, output_path):
     # Initialize a list to hold all NBR data arrays
     nbr_stack = []
@@ -15,7 +17,7 @@ def calculate_mean_nbr_image(directory, output_path):
 
                 # Read the NBR file using rasterio
                 with rasterio.open(file_path) as src:
-                    nbr_data = src.read(1).astype(float)
+                    nbr_data = raster_io.read_window(src, 1, cache=False).astype(float)
                     
                     # Mask out the no-data values and replace with NaN
                     nbr_data = np.where((nbr_data == src.nodata) | np.isinf(nbr_data), np.nan, nbr_data)
@@ -34,9 +36,7 @@ def calculate_mean_nbr_image(directory, output_path):
         mean_nbr_image = np.where(np.isnan(mean_nbr_image), np.nan, mean_nbr_image)
 
         # Save the mean NBR image to a new file
-        with rasterio.open(
-            output_path,
-            'w',
+        profile = dict(
             driver='GTiff',
             height=mean_nbr_image.shape[0],
             width=mean_nbr_image.shape[1],
@@ -44,8 +44,8 @@ def calculate_mean_nbr_image(directory, output_path):
             dtype='float32',
             crs=src.crs,
             transform=src.transform
-        ) as dst:
-            dst.write(mean_nbr_image, 1)
+        )
+        raster_io.write_array(output_path, mean_nbr_image.astype('float32'), profile)
         
         print(f"Mean NBR image saved to: {output_path}")
     else:
@@ -1,33 +1,33 @@
 import os
 import numpy as np
 import rasterio
+import argparse
 
-def calculate_mean_nbr(directory):
-    nbr_values = []
+import raster_io
+from global_stats import calculate_global_stats
 
+def find_nbr_files(directory):
+    nbr_files = []
     for root, dirs, files in os.walk(directory):
         for file in files:
             if file.endswith("NBR.TIF"):
-                file_path = os.path.join(root, file)
-                print(f"Processing file: {file_path}")
+                nbr_files.append(os.path.join(root, file))
+    return sorted(nbr_files)
 
-                # Read the NBR file using rasterio
-                with rasterio.open(file_path) as src:
-                    nbr_data = src.read(1)
-
-                    # Mask out the no-data values
-                    nbr_data = np.where((nbr_data == src.nodata) | np.isinf(nbr_data), np.nan, nbr_data)
-
-                    # Append non-NaN values to the list
-                    valid_nbr_values = nbr_data[~np.isnan(nbr_data)]
-                    nbr_values.extend(valid_nbr_values)
+def calculate_mean_nbr(directory, workers=1, percentiles=None):
+    # Reduce every NBR file block by block into running statistics (exact mean/std,
+    # histogram for percentiles); workers each take a share of the files and are merged
+    stats = calculate_global_stats(find_nbr_files(directory), workers)
 
     # Calculate the mean of all NBR values
-    if nbr_values:
-        mean_nbr = np.nanmean(nbr_values)
-        std_nbr = np.nanstd(nbr_values)  # Calculate standard deviation
+    if stats.count:
+        mean_nbr = stats.mean
+        std_nbr = stats.std  # Calculate standard deviation
         print(f"Mean NBR value: {mean_nbr}")
         print(f"Standard deviation of NBR values: {std_nbr}")
+        if percentiles:
+            for q, value in zip(percentiles, stats.percentiles(percentiles)):
+                print(f"{q:g}th percentile of NBR values (approximate): {value}")
 
         return mean_nbr, std_nbr
     else:
@@ -36,7 +36,7 @@ def calculate_mean_nbr(directory):
 
 def normalize_nbr_image(image_path, mean_nbr, std_nbr, output_path):
     with rasterio.open(image_path) as src:
-        nbr_data = src.read(1).astype(float)
+        nbr_data = raster_io.read_window(src, 1).astype(float)
 
         # Replace no-data values with NaN
         nbr_data = np.where(nbr_data == src.nodata, np.nan, nbr_data)
@@ -45,9 +45,7 @@ def normalize_nbr_image(image_path, mean_nbr, std_nbr, output_path):
         normalized_nbr = (nbr_data - mean_nbr) / std_nbr
 
         # Save the normalized NBR data to a new file
-        with rasterio.open(
-            output_path, 
-            'w', 
+        profile = dict(
             driver='GTiff',
             height=src.height,
             width=src.width,
@@ -55,18 +53,35 @@ def normalize_nbr_image(image_path, mean_nbr, std_nbr, output_path):
             dtype='float32',
             crs=src.crs,
             transform=src.transform
-        ) as dst:
-            dst.write(normalized_nbr, 1)
+        )
+        raster_io.write_array(output_path, normalized_nbr.astype('float32'), profile)
         print(f"Normalized image saved to: {output_path}")
 
 # Main execution
 if __name__ == "__main__":
-    directory = 'Landsat_AUGCOMP'  # Update this path
-    image_to_normalize = 'Landsat_AUGCOMP/h002v008/002008_20200825/LC08_CU_002008_20200825_20210504_02_SR_NBR.TIF'  # Update this path
-    output_path = 'Landsat_AUGCOMP/h002v008/002008_20200825/normalized_nbr.TIF'
+    parser = argparse.ArgumentParser(description='Normalize an NBR image with the mean/std of every NBR value under a directory.')
+    parser.add_argument('-d', '--directory', default='Landsat_AUGCOMP', type=str,  # Update this path
+                        help='Directory searched for NBR.TIF files.')
+    parser.add_argument('-i', '--image', type=str,  # Update this path
+                        default='Landsat_AUGCOMP/h002v008/002008_20200825/LC08_CU_002008_20200825_20210504_02_SR_NBR.TIF',
+                        help='NBR image to normalize.')
+    parser.add_argument('-o', '--output', type=str,  # Update this path
+                        default='Landsat_AUGCOMP/h002v008/002008_20200825/normalized_nbr.TIF',
+                        help='Output path of the normalized image.')
+    parser.add_argument('-w', '--workers', type=int, default=1,
+                        help='Number of worker processes for the statistics [Default: 1]')
+    parser.add_argument('--percentiles', nargs='+', type=float, default=None,
+                        help='Also print these (approximate) percentiles, e.g. 2 50 98')
+    raster_io.add_arguments(parser)
+    args = parser.parse_args()
+    raster_io.configure(args.output_format, args.compress, args.cache_mb)
 
-    mean_nbr, std_nbr = calculate_mean_nbr(directory)
+    mean_nbr, std_nbr = calculate_mean_nbr(args.directory, args.workers, args.percentiles)
     
     if mean_nbr is not None and std_nbr is not None:
-        normalize_nbr_image(image_to_normalize, mean_nbr, std_nbr, output_path)
-
+        normalize_nbr_image(args.image, mean_nbr, std_nbr, args.output)
+    if args.workers <= 1:
+        print(raster_io.format_cache_stats())
+    else:
+        # the statistics were read in the worker processes, each with its own cache
+        print("raster block cache: per worker process, not reported with --workers > 1")
@@ -4,11 +4,17 @@ import glob
 import rasterio
 import imageio
 import argparse
+import tempfile
+from concurrent.futures import ProcessPoolExecutor, as_completed
+
+import raster_io
+from calculate_nbr import iter_windows
+from climatology import update_state, read_nbr_window, STATE_NAME
 
 def read_nbr(file_path):
     """read a single nbr band from the file."""
     with rasterio.open(file_path) as src:
-        nbr_data = src.read(1).astype(float)
+        nbr_data = raster_io.read_window(src, 1).astype(float)
         nbr_data = np.where((nbr_data == src.nodata) | np.isinf(nbr_data), np.nan, nbr_data)
         # clamp values over 1 and below -1
         nbr_data = np.where(nbr_data > 1, 1, nbr_data)
@@ -16,8 +22,8 @@ def read_nbr(file_path):
     return nbr_data
 
                                                                                                                                                                                                                                                                                                                                                                                                                                                                                                                                                                                                                                                                                                                                                                                                                                                                                                                                                                                                                                                                                                                                                                                                                                                                                                                                                                                                                                                                                                                                                                                                                                                                                                                                                                                                                                                                                                                                                                                                                                                                                                                                                                                                                                                                                                                                                                                                                                                                                                         
-def calculate_mean_and_std_nbr_image(directory):
-    nbr_stack = []
+def calculate_mean_and_std_nbr_image(directory, workers=1, excluded_files=(), rebuild=False):
+    nbr_files = []
     output_mean_path = None  # Initialize to None
     output_std_path = None
     nbr_path = None
@@ -27,7 +33,6 @@ def calculate_mean_and_std_nbr_image(directory):
             if file.endswith("NBR.TIF"):
                 # process each file
                 file_path = os.path.join(root, file)
-                print(f"Processing file: {file_path}")
                 # extract the parent directory
                 parent_dir = os.path.dirname(root)
 
@@ -36,20 +41,18 @@ def calculate_mean_and_std_nbr_image(directory):
                     output_mean_path = os.path.join(parent_dir, "mean_nbr_image.tif")
                     output_std_path = os.path.join(parent_dir, "std_nbr_image.tif")
                 
-                #read nbr band
-                nbr_data = read_nbr(file_path)
-                nbr_stack.append(nbr_data)
+                nbr_files.append(file_path)
                 if nbr_path is None: 
                     nbr_path = file_path
     
-    if nbr_stack:
-        # stack all NBR arrays along a new third axis
-        nbr_stack = np.stack(nbr_stack, axis=0)
-        nbr_stack = np.nan_to_num(nbr_stack, nan=0)
-        
-        # calculate mean and std pixel-wise
-        mean_nbr_image = np.mean(nbr_stack, axis=0).astype(float)
-        std_nbr_image = np.std(nbr_stack, axis=0).astype(float)
+    if nbr_files:
+        # accumulate the per-pixel mean and std one scene at a time, block by block;
+        # nan pixels are missing, pixels without any valid value get 0.
+        # the accumulator state is kept next to the mean image so a rerun only reads new scenes
+        state_path = os.path.join(os.path.dirname(output_mean_path), STATE_NAME)
+        climatology = update_state(state_path, nbr_files, workers, excluded_files, rebuild)
+        mean_nbr_image = climatology.mean_image()
+        std_nbr_image = climatology.std_image()
 
 	    # shift the nbr image
         mean_nbr_image_output = (mean_nbr_image + 0.5) * 127.5
@@ -72,11 +75,10 @@ def calculate_mean_and_std_nbr_image(directory):
             profile = src.profile
             profile.update(dtype=rasterio.float32, count=1)
     
-        with rasterio.open(output_mean_path, 'w', **profile) as dst:
-            dst.write(mean_nbr_image_output.astype(rasterio.float32), 1)
+        raster_io.write_array(output_mean_path, mean_nbr_image_output.astype(rasterio.float32), profile)
 
         # save as PNG (Normalize values to [0, 255] for PNG)
-        png_output_path = output_mean_path.replace('.TIF', '.png')
+        png_output_path = os.path.splitext(output_mean_path)[0] + '.png'
         
         # convert to 8-bit format
         mean_8bit = mean_nbr_image_output.astype(np.uint8)  # Convert to 8-bit format
@@ -107,11 +109,10 @@ def calculate_mean_and_std_nbr_image(directory):
             crs = src.crs # Get crs from original file
             profile.update(dtype=rasterio.float32, count=1)
     
-            with rasterio.open(output_std_path, 'w', **profile) as dst:
-                dst.write(std_nbr_image_output.astype(rasterio.float32), 1)
+            raster_io.write_array(output_std_path, std_nbr_image_output.astype(rasterio.float32), profile)
             
         # save as PNG (Normalize values to [0, 255] for PNG)
-        png_output_path = output_std_path.replace('.TIF', '.png')
+        png_output_path = os.path.splitext(output_std_path)[0] + '.png'
         
         # convert to 8-bit format
         std_8bit = std_nbr_image_output.astype(np.uint8)  # Convert to 8-bit format
@@ -137,51 +138,93 @@ def normalize_nbr(directory, mean_nbr_image, std_nbr_image):
     # mean_nbr_image, std_nbr_image = calculate_mean_and_std_nbr_image(directory)
     
     # get the nbr image 
-    nbr_file = glob.glob(os.path.join(directory, '*_NBR*'))[0]
-    nbr_image = read_nbr(nbr_file)
-    # check and convert nan values to 0
-    nbr_image = np.nan_to_num(nbr_image, nan=0.0,  posinf=255.0, neginf=0.0)
-    
-    # normalize the nbr
-    # temporarily suppress the error messages
-    with np.errstate(divide='ignore', invalid='ignore'):
-        normalized_nbr = (mean_nbr_image - nbr_image).astype(float) / std_nbr_image
-        
-    # shift the image values
-    normalized_nbr = normalized_nbr * 30 + 128
+    nbr_file = glob.glob(os.path.join(directory, '*_NBR.TIF'))[0]
+    return normalize_nbr_file(nbr_file, mean_nbr_image, std_nbr_image)
+
+
+def normalize_nbr_file(nbr_file, mean_nbr_image, std_nbr_image):
+    """normalize one nbr file block by block and write the 8-bit GeoTIFF and PNG from the same buffer."""
     
     # define the output file path within the scene folder
     base_name = os.path.basename(nbr_file)  # get the final component of reference filename (e.g LC08...B5)
     output_file_name = base_name.replace("NBR", "NBR_norm")  # replace "B5" with "NBR"
-    output_file = os.path.join(directory, output_file_name)
-    
-    # convert to 8-bit format
-    normalized_8bit = normalized_nbr.astype(np.uint8)  # Convert to 8-bit format
-    
-    # # save the normalized image
-    # with rasterio.open(nbr_file) as src:
-    #     profile = src.profile
-    # profile.update(dtype=rasterio.float32, count=1)
-    
-    # with rasterio.open(output_file, 'w', **profile) as dst:
-    #     dst.write(normalized_nbr.astype(rasterio.float32), 1)
+    output_file = os.path.join(os.path.dirname(nbr_file), output_file_name)
+    png_output_path = output_file.replace('.TIF', '.png')
     
     with rasterio.open(nbr_file) as src:
         profile = src.profile
         profile.update(dtype=np.uint8, count=1)  # Set dtype to uint8
+        normalized_8bit = np.empty((src.height, src.width), dtype=np.uint8)
 
-        with rasterio.open(output_file, 'w', **profile) as dst:
-            dst.write(normalized_8bit, 1)  # Write the 8-bit data
-    
-    # print(f"Normalized image saved to: {output_file}")
+        with raster_io.open_output(output_file, profile) as dst:
+            for window in iter_windows(dst):
+                rows, cols = window.toslices()
+                # read the nbr block (nodata/inf as nan, clamped to [-1, 1]) and convert nan values to 0
+                nbr_block = read_nbr_window(src, window)
+                np.nan_to_num(nbr_block, copy=False, nan=0.0, posinf=255.0, neginf=0.0)
+                
+                # normalize the nbr and shift the values, in place
+                # temporarily suppress the error messages
+                with np.errstate(divide='ignore', invalid='ignore'):
+                    np.subtract(mean_nbr_image[rows, cols], nbr_block, out=nbr_block)
+                    np.divide(nbr_block, std_nbr_image[rows, cols], out=nbr_block)
+                nbr_block *= 30
+                nbr_block += 128
+                
+                # convert to 8-bit format and write the block
+                block_8bit = normalized_8bit[rows, cols]
+                with np.errstate(invalid='ignore'):
+                    block_8bit[...] = nbr_block
+                dst.write(block_8bit, 1, window=window)  # Write the 8-bit data
     
-    # save as PNG (Normalize values to [0, 255] for PNG)
-    png_output_path = output_file.replace('.TIF', '.png')
-
-    # save PNG
+    # save PNG from the same 8-bit buffer
     imageio.imwrite(png_output_path, normalized_8bit)
     
     print(f"Normalized image saved to: {png_output_path}")
+    return output_file
+
+
+# mean/std images shared with the worker processes through memory-mapped .npy files
+_worker_images = {}
+
+def _load_images(mean_path, std_path, *raster_settings):
+    raster_io.configure(*raster_settings)
+    _worker_images['mean'] = np.load(mean_path, mmap_mode='r')
+    _worker_images['std'] = np.load(std_path, mmap_mode='r')
+
+def _normalize_in_worker(nbr_file):
+    return normalize_nbr_file(nbr_file, _worker_images['mean'], _worker_images['std'])
+
+
+def normalize_scenes(nbr_files, mean_nbr_image, std_nbr_image, workers=1):
+    """normalize many nbr files, in parallel processes when workers > 1. returns (output files, errors)."""
+    outputs = []
+    errors = []
+    workers = min(workers or os.cpu_count(), len(nbr_files)) if nbr_files else 1
+    if workers <= 1:
+        for nbr_file in nbr_files:
+            try:
+                outputs.append(normalize_nbr_file(nbr_file, mean_nbr_image, std_nbr_image))
+            except Exception as e:
+                print(f"ERROR normalizing {nbr_file}: {e}")
+                errors.append(nbr_file)
+        return outputs, errors
+
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        mean_path = os.path.join(tmp_dir, 'mean_nbr_image.npy')
+        std_path = os.path.join(tmp_dir, 'std_nbr_image.npy')
+        np.save(mean_path, mean_nbr_image)
+        np.save(std_path, std_nbr_image)
+        with ProcessPoolExecutor(max_workers=workers, initializer=_load_images,
+                                 initargs=(mean_path, std_path) + raster_io.settings()) as executor:
+            futures = {executor.submit(_normalize_in_worker, nbr_file): nbr_file for nbr_file in nbr_files}
+            for future in as_completed(futures):
+                try:
+                    outputs.append(future.result())
+                except Exception as e:
+                    print(f"ERROR normalizing {futures[future]}: {e}")
+                    errors.append(futures[future])
+    return sorted(outputs), sorted(errors)
     
     
 # Main block to call the function
@@ -197,18 +240,37 @@ if __name__ == "__main__":
     parser = argparse.ArgumentParser(description='Process scenes to calculate NBR and save in each scene folder.')
     parser.add_argument('-i', '--input_dir', required=True,
                         help='Path to the base directory containing scene folders.', type=str)
+    parser.add_argument('-w', '--workers', type=int, default=1,
+                        help='Number of worker processes for the mean/std images and the normalization [Default: 1]')
+    parser.add_argument('--exclude', nargs='+', default=[], type=str,
+                        help='NBR file(s) to take out of (and keep out of) the mean/std images.')
+    parser.add_argument('--rebuild', action='store_true',
+                        help='Recompute the mean/std images from scratch instead of updating %s.' % STATE_NAME)
+    parser.add_argument('--catalog', type=str, default=None,
+                        help='Record the normalized files (status normalized) and the mean/std images in this scene catalog (see scene_catalog.py).')
+    raster_io.add_arguments(parser)
 
     # Parse arguments
     args = parser.parse_args()
+    raster_io.configure(args.output_format, args.compress, args.cache_mb)
     base_dir = os.path.normpath(args.input_dir)
     
     # get the mean and the std nbr image
     print(base_dir)
-    mean_nbr_image, std_nbr_image = calculate_mean_and_std_nbr_image(base_dir)
+    mean_nbr_image, std_nbr_image = calculate_mean_and_std_nbr_image(base_dir, args.workers, args.exclude, args.rebuild)
     
     # Process all scenes
-    for scene_dir in os.listdir(base_dir):
-        full_scene_dir = os.path.join(base_dir, scene_dir)
-        if os.path.isdir(full_scene_dir):  # ensure it's a directory
-            normalize_nbr(full_scene_dir, mean_nbr_image, std_nbr_image)
-    
+    nbr_files = sorted(glob.glob(os.path.join(base_dir, '*', '*_NBR.TIF')))
+    outputs, errors = normalize_scenes(nbr_files, mean_nbr_image, std_nbr_image, args.workers)
+    if errors:
+        print("ERRORS normalizing:", errors)
+    if args.catalog:
+        from scene_catalog import SceneCatalog, NORMALIZED
+        with SceneCatalog(args.catalog) as catalog:
+            catalog.record(outputs + [os.path.join(base_dir, name) for name in ('mean_nbr_image.tif', 'std_nbr_image.tif')],
+                           NORMALIZED, tile=os.path.basename(base_dir))
+    if args.workers <= 1:
+        print(raster_io.format_cache_stats())
+    else:
+        # the reads happened in the worker processes, each with its own cache
+        print("raster block cache: per worker process, not reported with --workers > 1")
@@ -8,148 +8,59 @@
 import os
 import argparse
 import glob
-import tarfile
-import time
-import shutil
-import pandas as pd
-from xml.dom import minidom
+
+from stack_index import write_stack_csv
+from tar_extract import extract_members, move_tar, BA_PRODUCT_ROUTES
+
+# route table used by extract_tar (and organize_parallel.py)
+ROUTES = BA_PRODUCT_ROUTES
 
 # extract BP.tif, BC.tif, .png, and .xml files from .tar and put them in indiviual folders within a tile folder
 def extract_tar(in_tar, out_dir, new_tar_folder):
     
     print('Exctracting files from .tar in', in_tar)
     
-    #extract the three files from .tar
+    #extract the files from .tar in one pass, routed by ROUTES
     try:
-        tar = tarfile.open(in_tar, mode='r:*')
+        extract_members(in_tar, out_dir, ROUTES)
     except:
         print('ERROR opening:', in_tar)
-        
-    tar_members = tar.getmembers()
-    
-    for i in range(0, len(tar_members)):
-        tm = tar_members[i].name
-        
-        if 'BP.TIF' in tm:
-            tar.extract(tm, os.path.join(out_dir, 'scene_BP'))
-        elif 'BC.TIF' in tm:
-            tar.extract(tm, os.path.join(out_dir, 'scene_BC'))
-        elif '.png' in tm:
-            tar.extract(tm, os.path.join(out_dir, 'scene_png'))
-        elif '.xml' in tm:
-            tar.extract(tm, os.path.join(out_dir, 'metadata'))
-        elif 'BA.json' in tm:
-            tar.extract(tm, os.path.join(out_dir, 'BA_json'))
-        elif 'BA_stac.json' in tm:
-            tar.extract(tm, os.path.join(out_dir, 'BA_stac_json'))
-        else:
-            pass
-        
-    tar.close()
+        raise
     
     #move .tar to new folder within tile folder
     print('Moving', in_tar, 'to new folder')
-    tar_path = os.path.abspath(in_tar)
-    shutil.move(tar_path, new_tar_folder)
+    move_tar(os.path.abspath(in_tar), new_tar_folder)
     
 # generate stack.csv
-def generate_stack_csv(in_dir, tar_folder):
-    
-     #list of xml files to use
-     meta_folder = os.path.join(tar_folder, 'metadata')
-     #xml_files = sorted(glob.glob(os.path.join(meta_folder, '*.xml')))
-     xml_files = glob.glob(os.path.join(meta_folder, '*.xml'))
-     
-     #create empty dataframe
-     stack = pd.DataFrame()
-     
-     #get data
-     for xml in xml_files:
-         doc = minidom.parse(xml)
-
-         #file
-         ARD_ID = doc.getElementsByTagName('ARD_PRODUCT_ID')[0]
-         filename = ARD_ID.firstChild.data
-         
-         #H and V
-         h = doc.getElementsByTagName('TILE_GRID_H')[0]
-         hh = h.firstChild.data
-         v = doc.getElementsByTagName('TILE_GRID_V')[0]
-         vv = v.firstChild.data
-         
-         #path and row
-         p = doc.getElementsByTagName('WRS_PATH')[0]
-         path = p.firstChild.data
-         r = doc.getElementsByTagName('WRS_ROW')[0]
-         row = r.firstChild.data
-         
-         #sensor
-         spacecraft = doc.getElementsByTagName('SPACECRAFT_ID')[0]
-         sensor = spacecraft.firstChild.data[-1:]
-         
-         #full acquisition date, year, month, and day acquired
-         acquisition_date = doc.getElementsByTagName('DATE_ACQUIRED')[0]
-         a_date = acquisition_date.firstChild.data
-         year = a_date[0:4]
-         month = a_date[5:7]
-         day = a_date[8:]
-         
-         #julian
-         struct_time = time.strptime(a_date, '%Y-%m-%d')
-         julian = struct_time[7]
-         
-         #RMSE
-         geometric_rmse_model = doc.getElementsByTagName('GEOMETRIC_RMSE_MODEL')
-         if len(geometric_rmse_model) > 0: 
-             geometric_rmse_model = doc.getElementsByTagName('GEOMETRIC_RMSE_MODEL')[0]
-             RMSE = float(geometric_rmse_model.firstChild.data)
-             
-         #not sure exactly what to put here - some .xmls do not have this data    
-         else:
-             RMSE = 'NA'
-            
-         #cloud cover
-         cloud_cover = doc.getElementsByTagName('CLOUD_COVER')[0]
-         cloudcover = float(cloud_cover.firstChild.data)
-         
-         #snow and ice
-         snow_ice = doc.getElementsByTagName('SNOW_ICE_COVER')[0]
-         snowice = float(snow_ice.firstChild.data)
-         
-         #fill
-         fill_ = doc.getElementsByTagName('FILL')[0]
-         fill = float(fill_.firstChild.data)
-         
-         #instrument
-         instru = doc.getElementsByTagName('SENSOR_ID')[0]
-         instrument = instru.firstChild.data
-         
-         #production date
-         production_date = doc.getElementsByTagName('DATE_PRODUCT_GENERATED')[0]
-         p_date = production_date.firstChild.data
-         
-         ###not sure exactly what the output column means but making it 1 for every row so it can be read by QA tool
-         output = 1
-         
-         #add data to stack.csv
-         df_temp = pd.DataFrame(data={'FILE': filename, 'HH': hh, 'VV': vv, 'PATH': path, 'ROW': row, \
-                                      'SENSOR': sensor, 'YEAR': year, 'MONTH': month, 'DAY': day, \
-                                          'JULIAN': julian, 'RMSE': RMSE, 'CLOUD_COVER': cloudcover, \
-                                              'SNOW_ICE': snowice, 'FILL': fill, 'INSTRUMENT': instrument, 'ACQUISITION_DATE': a_date, \
-                                                  'PRODUCTION_DATE': p_date, 'OUTPUT': output}, index=[0])
-             
-         df_temp = df_temp.set_index('FILE')
-         #stack = stack.append(df_temp)
-         stack = pd.concat([stack, df_temp])
+def generate_stack_csv(in_dir, tar_folder, workers=None):
     
-     #write dataframe to csv
-     stack.sort_values(by='ACQUISITION_DATE', axis=0, inplace=True)
-     stack.to_csv(os.path.join(tar_folder, 'stack_new.csv'))
+     #stream the .xml files in the metadata folder in parallel and build the stack once (see stack_index.py)
+     return write_stack_csv(tar_folder, workers=workers)
 
 # change .png file names to acquistion date
 def png_name_change(png, tar_folder):
     new_png_name = os.path.basename(png)[15:23] + 'L' + os.path.basename(png)[0:4]
     os.rename(png, os.path.join(tar_folder, 'scene_png', new_png_name + '.png'))
+
+# rename the .png files and generate stack_new.csv once every .tar of the tile is extracted
+def finalize_tile(tar_dir):
+    
+    #list for files that throw errors
+    errors = []
+    
+    png_files_list = glob.glob(os.path.join(tar_dir, 'scene_png', '*.png'))
+
+    for file in png_files_list:
+        print(file)
+        try:
+            png_name_change(file, tar_dir)
+        except:
+            error = file
+            errors.append(error)
+    
+    generate_stack_csv(tar_dir, tar_dir)
+    
+    return errors
     
 
 if __name__ == '__main__':
@@ -173,9 +84,8 @@ if __name__ == '__main__':
     #list of .tar files to extract from
     tar_files_list = glob.glob(os.path.join(tar_dir, '*.tar'))
 
-    #lists for files that throw errors
+    #list for files that throw errors
     errors1 = []
-    errors2 = []
     
     #loop extract_tar over list
     for file in tar_files_list:
@@ -185,17 +95,7 @@ if __name__ == '__main__':
             error = file
             errors1.append(error)
             
-    png_files_list = glob.glob(os.path.join(tar_dir, 'scene_png', '*.png'))
-
-    for file in png_files_list:
-        print(file)
-        try:
-            png_name_change(file, tar_dir)
-        except:
-            error = file
-            errors2.append(error)
-    
-    generate_stack_csv(tar_dir, tar_dir)
+    errors2 = finalize_tile(tar_dir)
     
     print('ERRORS opening the following .tar files:', errors1)
     print('Could not rename file (already exists):', errors2)
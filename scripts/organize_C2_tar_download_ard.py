@@ -8,48 +8,35 @@
 import os
 import tarfile
 import glob
-import shutil
 import argparse
-import re
 
-def extract_tar(in_tar, out_dir, new_tar_folder):
+from tar_extract import extract_members, move_tar, ARD_SR_ROUTES, STAGE_BANDS, ard_sr_routes, stage_bands
+
+# route table used by extract_tar (and organize_parallel.py)
+ROUTES = ARD_SR_ROUTES
+
+def routes(stages=None):
+    # only the bands the downstream stages read (see tar_extract.STAGE_BANDS) plus the scene .xml, or every SR band
+    return ard_sr_routes(stage_bands(stages), metadata=True) if stages else ROUTES
+
+def extract_tar(in_tar, out_dir, new_tar_folder, routes=ROUTES):
     print('Extracting files from .tar in', in_tar)
     
+    # single pass over the tar: SR band files go to <tile>_<acquisition date>
+    # scene folders (see tar_extract.ARD_SR_ROUTES), everything else is skipped
     try:
-        tar = tarfile.open(in_tar, mode='r:*')
-    except Exception as e:
+        extracted = extract_members(in_tar, out_dir, routes)
+    except (tarfile.TarError, OSError) as e:
         print('ERROR opening:', in_tar, '-', e)
         return  # skip if cannot open
     
-    tar_members = tar.getmembers()
-    
-    for member in tar_members:
-        tm = member.name
-        
-        # using regex to match the filename and extract the acquisition date 
-        match = re.search(r'LC0[8-9]_CU_(\d{6})_(\d{8})_\d{8}_\d{2}_SR_B([1-9])', tm)
-        if match:
-            tile = match.group(1)  # capture the tile number
-            acquisition_date = match.group(2) # get acquisition date
-            band_number = match.group(3)  # Capture the band number (e.g., '1', '2', etc.)
-            
-            # define folder name based on tile number and acquisition date
-            scene_folder_name = f"{tile}_{acquisition_date}"
-            scene_output_dir = os.path.join(out_dir, scene_folder_name)
-            os.makedirs(scene_output_dir, exist_ok=True)
-            
-            # extract the file (unzip)
-            tar.extract(member, scene_output_dir)
-            print(f'Extracted {tm} to {scene_output_dir}')
-        else:
-            pass  # skip is file doesn't match
-    
-    tar.close()
+    for path in extracted:
+        print(f'Extracted {os.path.basename(path)} to {os.path.dirname(path)}')
     
     # move .tar to a new folder within the tile folder
     print('Moving', in_tar, 'to new folder')
-    tar_path = os.path.abspath(in_tar)
-    shutil.move(tar_path, new_tar_folder)
+    move_tar(os.path.abspath(in_tar), new_tar_folder)
+    return extracted
 
 if __name__ == '__main__':
     # Set up command-line argument parser
@@ -57,6 +44,8 @@ if __name__ == '__main__':
     parser.add_argument('-d', '--tar_directory', required=True,
                         help='Path to folder where .tar files are located. (Required)', 
                         type=str, dest='tar_directory')
+    parser.add_argument('--extract-for', nargs='+', default=None, choices=sorted(STAGE_BANDS), dest='extract_for',
+                        help='Only extract the bands these downstream stages read (plus metadata) instead of every SR band.')
 
     # Parse command-line arguments
     args = parser.parse_args()
@@ -75,7 +64,7 @@ if __name__ == '__main__':
     # loop through each .tar file (dirs) and extract contents
     for file in tar_files_list:
         try:
-            extract_tar(file, tar_dir, new_tar_folder)
+            extract_tar(file, tar_dir, new_tar_folder, routes(args.extract_for))
         except Exception as e:
             print(f'Error processing {file}: {e}')
             errors_opening.append(file)
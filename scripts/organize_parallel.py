@@ -0,0 +1,170 @@
+#parallel driver for the organize_C2_tar_download_* scripts
+#
+#extracts the .tar files of many tiles concurrently across a process pool
+#instead of one tile (and one tar) at a time.  every tar is extracted with the
+#route table of the chosen organizer, then atomically moved into its tile's
+#tar_downloads folder.  once all tars of a tile are done the organizer's
+#per-tile step runs (png renames + stack_new.csv for the BA organizers).
+#a per-tar result/error summary is printed and written as JSON.  with
+#--catalog every organized scene and its files are added to the scene catalog.
+#
+# python organize_parallel.py --type BP --root D:/BA_C2_CU/downloads -w 48
+# python organize_parallel.py --type ard -d downloads/h003v010 downloads/h003v011
+# python organize_parallel.py --type 1 --root downloads --tile-file download_multiple_tiles.sh
+# python organize_parallel.py --type BP --root downloads --catalog downloads/scene_catalog.sqlite
+# python organize_parallel.py --type ard --root downloads --extract-for nbr
+
+import os
+import glob
+import json
+import time
+import argparse
+import importlib
+from concurrent.futures import ProcessPoolExecutor, as_completed
+
+from tar_extract import extract_members, move_tar, STAGE_BANDS
+from stack_index import index_tar
+from scene_catalog import SceneCatalog, ORGANIZED, scene_from_stack_row
+
+# --type values, same as TYPE in organize_one_tile.sh
+ORGANIZERS = {
+    'ard': 'organize_C2_tar_download_ard',
+    '1': 'organize_C2_tar_download_1',
+    'BP': 'organize_C2_tar_download_BP',
+}
+
+
+def organize_tar(organizer, in_tar, tile_dir, catalog=False, extract_for=None):
+    """
+    extract one tar with the organizer's routes and move it to tar_downloads.
+    with extract_for (stage names, see tar_extract.STAGE_BANDS) only the bands
+    those stages read are extracted, if the organizer extracts bands at all.
+    with catalog, the result also carries the scene metadata and file paths.
+    """
+    module = importlib.import_module(ORGANIZERS[organizer])
+    routes = module.routes(extract_for) if hasattr(module, 'routes') else module.ROUTES
+    start = time.time()
+    result = dict(tar=in_tar, tile=tile_dir, status='ok', members=0, error=None)
+    try:
+        extracted = extract_members(in_tar, tile_dir, routes)
+        result['members'] = len(extracted)
+        if catalog:
+            #.png files are renamed by the per-tile step, so they are not catalogued
+            rows, errors = index_tar(in_tar)
+            result['scenes'] = [scene_from_stack_row(row) for name, row in rows]
+            result['files'] = [path for path in extracted if not path.endswith('.png')]
+        move_tar(in_tar, os.path.join(tile_dir, 'tar_downloads'))
+    except Exception as e:
+        result['status'] = 'error'
+        result['error'] = '{}: {}'.format(e.__class__.__name__, e)
+    result['seconds'] = round(time.time() - start, 3)
+    return result
+
+
+def finalize_tile(organizer, tile_dir):
+    """run the organizer's per-tile step, if it has one"""
+    module = importlib.import_module(ORGANIZERS[organizer])
+    if not hasattr(module, 'finalize_tile'):
+        return dict(tile=tile_dir, status='ok', errors=[])
+    try:
+        errors = module.finalize_tile(tile_dir)
+        return dict(tile=tile_dir, status='ok', errors=errors)
+    except Exception as e:
+        return dict(tile=tile_dir, status='error', errors=['{}: {}'.format(e.__class__.__name__, e)])
+
+
+def organize_tiles(organizer, tile_dirs, workers=None, catalog=None, extract_for=None):
+    """
+    organize every .tar in tile_dirs on a process pool, adding the scenes to
+    catalog (a SceneCatalog) if given.  returns (tar results, tile results)
+    """
+    tars = {tile_dir: sorted(glob.glob(os.path.join(tile_dir, '*.tar'))) for tile_dir in tile_dirs}
+    for tile_dir in tile_dirs:
+        os.makedirs(os.path.join(tile_dir, 'tar_downloads'), exist_ok=True)
+    remaining = {tile_dir: len(tile_tars) for tile_dir, tile_tars in tars.items()}
+
+    tar_results = []
+    tile_results = []
+    with ProcessPoolExecutor(max_workers=workers) as executor:
+        futures = {executor.submit(organize_tar, organizer, tar, tile_dir, catalog is not None, extract_for): 'tar'
+                   for tile_dir, tile_tars in tars.items() for tar in tile_tars}
+        # tiles without tars still get their per-tile step
+        for tile_dir, count in remaining.items():
+            if count == 0:
+                futures[executor.submit(finalize_tile, organizer, tile_dir)] = 'tile'
+
+        while futures:
+            done = next(as_completed(futures))
+            kind = futures.pop(done)
+            result = done.result()
+            if kind == 'tile':
+                tile_results.append(result)
+                print('Finished tile', result['tile'], result['status'])
+                continue
+
+            if catalog is not None and result['status'] == 'ok':
+                catalog.add_scenes(result.pop('scenes'), status=ORGANIZED)
+                catalog.add_files(result.pop('files'))
+            tar_results.append(result)
+            if result['status'] == 'ok':
+                print('Extracted {} members from {} ({} s)'.format(result['members'], result['tar'], result['seconds']))
+            else:
+                print('ERROR', result['tar'], '-', result['error'])
+            remaining[result['tile']] -= 1
+            if remaining[result['tile']] == 0:
+                futures[executor.submit(finalize_tile, organizer, result['tile'])] = 'tile'
+
+    return tar_results, tile_results
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Organize the .tar downloads of many tiles in parallel.')
+    parser.add_argument('-t', '--type', required=True, choices=sorted(ORGANIZERS), dest='organizer',
+                        help='Which organize_C2_tar_download_<type>.py layout to produce. (Required)')
+    parser.add_argument('-d', '--tar_directory', nargs='+', default=[], type=str, dest='tar_directory',
+                        help='Tile folder(s) where .tar files are located.')
+    parser.add_argument('--root', type=str, default=None,
+                        help='Folder containing the tile folders (hHHHvVVV).')
+    parser.add_argument('--tile-file', type=str, default=None, dest='tile_file',
+                        help='Only organize the tiles listed in this file (needs --root), '
+                             'same format as m2m_download.py --tile-file.')
+    parser.add_argument('-w', '--workers', type=int, default=None,
+                        help='Number of worker processes [Default: CPU count]')
+    parser.add_argument('--catalog', type=str, default=None,
+                        help='Add the organized scenes to this scene catalog (see scene_catalog.py).')
+    parser.add_argument('--extract-for', nargs='+', default=None, choices=sorted(STAGE_BANDS), dest='extract_for',
+                        help='Only extract the bands these downstream stages read (plus metadata) instead of every band.')
+    parser.add_argument('-o', '--output', type=str, default=None,
+                        help='Path of the JSON summary [Default: organize_summary.json in --root or the first folder]')
+    args = parser.parse_args()
+
+    tile_dirs = [os.path.normpath(d) for d in args.tar_directory]
+    if args.root and args.tile_file:
+        from m2m_download import read_tile_list, tile_name
+        tile_dirs.extend(os.path.join(args.root, tile_name(h, v)) for h, v in read_tile_list(args.tile_file))
+        tile_dirs = [d for d in tile_dirs if os.path.isdir(d)]
+    elif args.root:
+        tile_dirs.extend(sorted(d for d in glob.glob(os.path.join(args.root, '*'))
+                                if os.path.isdir(d)))
+    if not tile_dirs:
+        parser.error('specify -d and/or --root')
+
+    start = time.time()
+    catalog = SceneCatalog(args.catalog) if args.catalog else None
+    try:
+        tar_results, tile_results = organize_tiles(args.organizer, tile_dirs, args.workers, catalog, args.extract_for)
+    finally:
+        if catalog is not None:
+            catalog.close()
+    errors = [r for r in tar_results if r['status'] != 'ok']
+
+    output = args.output or os.path.join(args.root or tile_dirs[0], 'organize_summary.json')
+    with open(output, 'w') as f:
+        json.dump(dict(tiles=len(tile_dirs), tars=len(tar_results), errors=len(errors),
+                       seconds=round(time.time() - start, 3),
+                       tar_results=sorted(tar_results, key=lambda r: r['tar']),
+                       tile_results=sorted(tile_results, key=lambda r: r['tile'])), f, indent=2)
+
+    print('Organized {} tars in {} tiles ({} errors) in {:.1f} s'.format(len(tar_results), len(tile_dirs), len(errors), time.time() - start))
+    print('ERRORS opening the following .tar files:', [r['tar'] for r in errors])
+    print('Summary written to', output)
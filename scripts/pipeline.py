@@ -0,0 +1,471 @@
+#end-to-end tile pipeline: download -> test -> organize -> NBR -> normalize
+#
+#instead of running each stage as its own loop over every tile (and rescanning
+#the disk each time), every stage of every tile/tar/scene is a task with
+#declared input and output files and the tasks it depends on.  tasks run as
+#soon as their dependencies are done, so the NBR of tile A is computed while
+#tile B is still downloading.  tasks discover their successors when they
+#finish: a tile download adds test/organize tasks for its tars, organizing a
+#tar adds NBR tasks for the scenes it wrote, and a tile's normalize task waits
+#for all of them.
+#
+#a task whose outputs are up to date is skipped: with --check mtime (default)
+#when every output is newer than every input, with --check hash when the
+#inputs' checksums match the ones recorded in pipeline_state.json the last
+#time the task ran.  a per-task summary (with the time to the first product)
+#is written as JSON.  a tar that passed its test keeps a <tar>.verified stamp,
+#so with --from-tars (the tars stay in the tile folder) reruns don't read
+#them again.
+#
+# python pipeline.py --root downloads --tiles 3,10 3,11 --dataset landsat_ard_tile_c2 --acq-date "2020-08-01,2020-08-31" -u user -tkn token
+# python pipeline.py --root downloads --tile-file download_multiple_tiles.sh --no-download -w 32
+# python pipeline.py --root downloads --no-download --check hash --stages organize nbr
+
+import os
+import glob
+import json
+import time
+import argparse
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor, FIRST_COMPLETED, wait
+
+import raster_io
+from download_manifest import file_checksum
+from verify_tars import verify_tar
+from tar_extract import extract_members, move_tar, STAGE_BANDS
+from organize_C2_tar_download_ard import routes
+from scene_catalog import SceneCatalog, NBR, NORMALIZED
+from calculate_nbr import process_scene, process_tar, tar_nbr_outputs, find_scene_dirs, find_band_files, nbr_output_file
+
+# concurrent downloads per host of one download task
+DOWNLOAD_PER_HOST = 16
+
+STAGES = ('download', 'test', 'organize', 'nbr', 'normalize')
+STATE_NAME = 'pipeline_state.json'
+# stamp next to a tar that passed verify_tar, the output of its test task
+VERIFIED_SUFFIX = '.verified'
+
+# task states
+PENDING, RUNNING, DONE, SKIPPED, FAILED, BLOCKED = 'pending', 'running', 'done', 'skipped', 'failed', 'blocked'
+
+
+class Task(object):
+    """
+    one unit of work: func(*args) run in the thread pool (io) or the process
+    pool.  inputs/outputs are file lists, or callables returning them when the
+    files are only known once the dependencies are done.  expand(result) runs
+    in the scheduler after the task and may add tasks to the pipeline.
+    """
+
+    def __init__(self, name, func, args=(), inputs=(), outputs=(), deps=(), expand=None, io=False):
+        self.name = name
+        self.func = func
+        self.args = args
+        self.inputs = inputs
+        self.outputs = outputs
+        self.deps = set(deps)
+        self.expand = expand
+        self.io = io
+        self.state = PENDING
+        self.error = None
+        self.started = None
+        self.seconds = None
+        self.finished = None
+
+    def files(self, which):
+        files = getattr(self, which)
+        return sorted(files() if callable(files) else files)
+
+
+def _signature(files, check):
+    if check == 'hash':
+        return {path: file_checksum(path) for path in files}
+    return {path: os.path.getmtime(path) for path in files}
+
+
+def up_to_date(task, check='mtime', state=None):
+    """
+    True if the task's outputs exist and are current: newer than every input
+    (mtime), or built from inputs with the checksums recorded in state (hash).
+    tasks without outputs are never up to date.
+    """
+    outputs = task.files('outputs')
+    if not outputs or not all(os.path.exists(path) for path in outputs):
+        return False
+    inputs = task.files('inputs')
+    if not all(os.path.exists(path) for path in inputs):
+        return False
+    if check == 'hash':
+        return state is not None and state.get(task.name) == _signature(inputs, check)
+    if not inputs:
+        return True
+    return min(os.path.getmtime(path) for path in outputs) >= max(os.path.getmtime(path) for path in inputs)
+
+
+class Pipeline(object):
+    """
+    run a DAG of tasks that can grow while it runs: io tasks on a thread pool,
+    the others on a process pool (configured with the raster_io settings).
+    a task that fails blocks everything depending on it.
+    """
+
+    def __init__(self, workers=None, io_workers=2, check='mtime', state_path=None):
+        self.workers = workers
+        self.io_workers = io_workers
+        self.check = check
+        self.state_path = state_path
+        self.state = {}
+        if state_path and os.path.exists(state_path):
+            with open(state_path) as f:
+                self.state = json.load(f)
+        self.tasks = {}
+        self.start = None
+
+    def add(self, task):
+        """add a task (a task of the same name already added is kept), returns the pipeline's task"""
+        return self.tasks.setdefault(task.name, task)
+
+    def depend(self, name, dep):
+        """make the (not yet started) task name wait for dep as well"""
+        task = self.tasks[name]
+        if task.state != PENDING:
+            raise ValueError('{} has already started'.format(name))
+        task.deps.add(dep)
+
+    def _ready(self):
+        ready = []
+        for task in self.tasks.values():
+            if task.state != PENDING:
+                continue
+            states = [self.tasks[dep].state if dep in self.tasks else PENDING for dep in task.deps]
+            if any(s in (FAILED, BLOCKED) for s in states):
+                task.state = BLOCKED
+                task.error = 'dependency failed: ' + ', '.join(
+                    sorted(d for d in task.deps if self.tasks[d].state in (FAILED, BLOCKED)))
+                print('BLOCKED', task.name, '-', task.error)
+            elif all(s in (DONE, SKIPPED) for s in states):
+                ready.append(task)
+        return ready
+
+    def _finish(self, task, state, result=None, error=None):
+        task.state = state
+        task.error = error
+        task.finished = round(time.time() - self.start, 3)
+        if state == DONE and self.check == 'hash':
+            self.state[task.name] = _signature(task.files('inputs'), self.check)
+        if state in (DONE, SKIPPED) and task.expand is not None:
+            task.expand(result)
+
+    def run(self):
+        """run every task (including the ones added on the way), returns the task list"""
+        self.start = time.time()
+        running = {}
+        with ThreadPoolExecutor(max_workers=self.io_workers) as io_executor, \
+                ProcessPoolExecutor(max_workers=self.workers, initializer=raster_io.configure,
+                                    initargs=raster_io.settings()) as executor:
+            while True:
+                for task in self._ready():
+                    if up_to_date(task, self.check, self.state):
+                        print('Up to date:', task.name)
+                        self._finish(task, SKIPPED)
+                        continue
+                    task.state = RUNNING
+                    task.started = time.time()
+                    pool = io_executor if task.io else executor
+                    running[pool.submit(task.func, *task.args)] = task
+                if not running:
+                    # nothing running and nothing ready: done (or only tasks waiting on missing ones)
+                    if not self._ready():
+                        break
+                    continue
+
+                done, _ = wait(running, return_when=FIRST_COMPLETED)
+                for future in done:
+                    task = running.pop(future)
+                    task.seconds = round(time.time() - task.started, 3)
+                    try:
+                        result = future.result()
+                    except BaseException as e:
+                        print('ERROR', task.name, '-', '{}: {}'.format(e.__class__.__name__, e))
+                        self._finish(task, FAILED, error='{}: {}'.format(e.__class__.__name__, e))
+                        continue
+                    print('Finished {} ({} s, {:.1f} s since start)'.format(task.name, task.seconds, time.time() - self.start))
+                    self._finish(task, DONE, result)
+                self.save_state()
+
+        for task in self.tasks.values():
+            if task.state == PENDING:
+                task.state = BLOCKED
+                task.error = 'missing dependency: ' + ', '.join(sorted(d for d in task.deps if d not in self.tasks))
+        self.save_state()
+        return list(self.tasks.values())
+
+    def save_state(self):
+        if self.state_path and self.check == 'hash':
+            tmp = self.state_path + '.part'
+            with open(tmp, 'w') as f:
+                json.dump(self.state, f, indent=1, sort_keys=True)
+            os.replace(tmp, self.state_path)
+
+
+# stage functions, run in the worker pools
+
+def download_tile(root, h, v, download_kwargs):
+    """download the tars of one tile with m2m_download (its manifest skips the scenes already downloaded)"""
+    from m2m_download import download_files
+    try:
+        download_files(root, tiles=[(h, v)], **download_kwargs)
+    except SystemExit:
+        # download_files exits when the search finds nothing
+        pass
+
+
+def verified_stamp(in_tar):
+    return in_tar + VERIFIED_SUFFIX
+
+
+def test_tar(in_tar):
+    """
+    verify_tar, raising on a damaged archive.  a good tar gets a <tar>.verified
+    stamp with its size and mtime, and is not read again until they change
+    """
+    stat = os.stat(in_tar)
+    stamp = verified_stamp(in_tar)
+    try:
+        with open(stamp) as f:
+            verified = json.load(f)
+        if verified['size'] == stat.st_size and verified['mtime_ns'] == stat.st_mtime_ns:
+            return verified['members']
+    except (OSError, ValueError, KeyError):
+        pass
+    report = verify_tar(in_tar)
+    if not report['ok']:
+        raise ValueError('; '.join(report['errors']))
+    with open(stamp + '.part', 'w') as f:
+        json.dump(dict(size=stat.st_size, mtime_ns=stat.st_mtime_ns, members=report['members']), f)
+    os.replace(stamp + '.part', stamp)
+    return report['members']
+
+
+def organize_tar(in_tar, tile_dir, extract_for=None):
+    """
+    extract the SR bands of one tar (only the ones the extract_for stages read,
+    if given) into its scene folders, move it to tar_downloads, returns the
+    scene folders
+    """
+    extracted = extract_members(in_tar, tile_dir, routes(extract_for))
+    move_tar(in_tar, os.path.join(tile_dir, 'tar_downloads'))
+    if os.path.exists(verified_stamp(in_tar)):
+        os.remove(verified_stamp(in_tar))
+    return sorted(set(os.path.dirname(path) for path in extracted))
+
+
+def normalize_tile(tile_dir):
+    """update the tile's mean/std images and normalize every NBR of the tile"""
+    from normalize_nbr import calculate_mean_and_std_nbr_image, normalize_scenes
+    nbr_files = tile_nbr_files(tile_dir)
+    if not nbr_files:
+        return []
+    mean_nbr_image, std_nbr_image = calculate_mean_and_std_nbr_image(tile_dir)
+    outputs, errors = normalize_scenes(nbr_files, mean_nbr_image, std_nbr_image)
+    if errors:
+        raise RuntimeError('normalizing failed for {}'.format(', '.join(errors)))
+    return outputs
+
+
+def tile_nbr_files(tile_dir):
+    return sorted(glob.glob(os.path.join(tile_dir, '*', '*_NBR.TIF')))
+
+
+def scene_band_files(scene_dir):
+    try:
+        return list(find_band_files(scene_dir))
+    except IndexError:
+        return []
+
+
+def scene_nbr_file(scene_dir):
+    bands = scene_band_files(scene_dir)
+    return [nbr_output_file(scene_dir, bands[0])] if bands else []
+
+
+class TilePipeline(object):
+    """the tasks of the ARD tile workflow for a set of tiles, as in readme.txt"""
+
+    def __init__(self, pipeline, root, stages=STAGES, download_kwargs=None, from_tars=False, extract_for=None,
+                 catalog=None):
+        self.pipeline = pipeline
+        self.root = root
+        self.stages = set(stages)
+        self.download_kwargs = download_kwargs or {}
+        # NBR read straight from the tars (see tar_index.py), which stay in the tile folder unextracted
+        self.from_tars = from_tars
+        self.extract_for = extract_for
+        # scene_catalog.SceneCatalog the nbr and normalize outputs are recorded in (done or up to date)
+        self.catalog = catalog
+
+    def add_tile(self, h, v):
+        from m2m_download import tile_name
+        tile_dir = os.path.join(self.root, tile_name(h, v))
+        os.makedirs(tile_dir, exist_ok=True)
+        normalize = None
+        if 'normalize' in self.stages:
+            outputs = lambda: [os.path.join(tile_dir, 'mean_nbr_image.tif')] + \
+                              [f.replace('_NBR.TIF', '_NBR_norm.TIF') for f in tile_nbr_files(tile_dir)]
+            normalize = self.pipeline.add(Task(
+                'normalize:' + tile_dir, normalize_tile, (tile_dir,),
+                inputs=lambda: tile_nbr_files(tile_dir), outputs=outputs,
+                expand=self._recorder(NORMALIZED, lambda: outputs() + [os.path.join(tile_dir, 'std_nbr_image.tif')],
+                                      tile=os.path.basename(tile_dir))))
+
+        if 'download' in self.stages:
+            download = self.pipeline.add(Task(
+                'download:' + tile_dir, download_tile, (self.root, h, v, self.download_kwargs),
+                expand=lambda result: self.add_tars(tile_dir), io=True))
+            if normalize is not None:
+                self.pipeline.depend(normalize.name, download.name)
+        else:
+            self.add_tars(tile_dir)
+        # scenes organized by earlier runs
+        if not self.from_tars:
+            self.add_scenes(tile_dir, find_scene_dirs(tile_dir))
+
+    def add_tars(self, tile_dir):
+        if 'organize' not in self.stages and not (self.from_tars and 'nbr' in self.stages):
+            return
+        for in_tar in sorted(glob.glob(os.path.join(tile_dir, '*.tar'))):
+            deps = ()
+            if 'test' in self.stages:
+                deps = (self.pipeline.add(Task('test:' + in_tar, test_tar, (in_tar,), inputs=[in_tar],
+                                               outputs=[verified_stamp(in_tar)])).name,)
+            if self.from_tars:
+                nbr = self.pipeline.add(Task(
+                    'nbr:' + in_tar, process_tar, (in_tar, tile_dir), inputs=[in_tar],
+                    outputs=lambda in_tar=in_tar: tar_nbr_outputs(in_tar, tile_dir), deps=deps,
+                    expand=self._recorder(NBR, lambda in_tar=in_tar: tar_nbr_outputs(in_tar, tile_dir))))
+                self._normalize_after(tile_dir, nbr)
+                continue
+            organize = self.pipeline.add(Task(
+                'organize:' + in_tar, organize_tar, (in_tar, tile_dir, self.extract_for), inputs=[in_tar],
+                outputs=[os.path.join(tile_dir, 'tar_downloads', os.path.basename(in_tar))], deps=deps,
+                expand=lambda scene_dirs, tile_dir=tile_dir: self.add_scenes(tile_dir, scene_dirs or [])))
+            self._normalize_after(tile_dir, organize)
+
+    def add_scenes(self, tile_dir, scene_dirs):
+        if 'nbr' not in self.stages:
+            return
+        for scene_dir in scene_dirs:
+            nbr = self.pipeline.add(Task(
+                'nbr:' + scene_dir, process_scene, (scene_dir,),
+                inputs=lambda scene_dir=scene_dir: scene_band_files(scene_dir),
+                outputs=lambda scene_dir=scene_dir: scene_nbr_file(scene_dir),
+                expand=self._recorder(NBR, lambda scene_dir=scene_dir: scene_nbr_file(scene_dir))))
+            self._normalize_after(tile_dir, nbr)
+
+    def _recorder(self, status, outputs, tile=None):
+        """expand callback recording the task's outputs with status in the catalog (None without one)"""
+        if self.catalog is None:
+            return None
+        return lambda result: self.catalog.record(outputs(), status, tile=tile)
+
+    def _normalize_after(self, tile_dir, task):
+        name = 'normalize:' + tile_dir
+        if name in self.pipeline.tasks:
+            self.pipeline.depend(name, task.name)
+
+
+def summary(tasks, start_seconds):
+    """per-stage counts and the per-task results, as written to pipeline_summary.json"""
+    stages = {}
+    for task in tasks:
+        counts = stages.setdefault(task.name.split(':', 1)[0], {})
+        counts[task.state] = counts.get(task.state, 0) + 1
+    products = [t.finished for t in tasks if t.state == DONE and t.name.split(':', 1)[0] in ('nbr', 'normalize')]
+    return dict(seconds=round(start_seconds, 3), stages=stages,
+                first_product_seconds=min(products) if products else None,
+                tasks=[dict(name=t.name, state=t.state, seconds=t.seconds, finished=t.finished, error=t.error)
+                       for t in sorted(tasks, key=lambda t: t.name)])
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Download, test, organize, calculate and normalize the NBR of ARD tiles as one pipeline.')
+    parser.add_argument('--root', required=True, help='Folder containing the tile folders (hHHHvVVV). (Required)')
+    parser.add_argument('--tiles', nargs='+', default=[], help='Tiles as h,v (e.g. 3,10 3,11)')
+    parser.add_argument('--tile-file', type=str, default=None, dest='tile_file',
+                        help='Text file of tiles, same format as m2m_download.py --tile-file.')
+    parser.add_argument('--stages', nargs='+', choices=STAGES, default=list(STAGES),
+                        help='Stages to run [Default: all]')
+    parser.add_argument('--no-download', action='store_true', dest='no_download',
+                        help='Only process the tars and scenes already on disk (same as leaving out the download stage).')
+    parser.add_argument('--from-tars', action='store_true', dest='from_tars',
+                        help='Calculate the NBR reading B5/B7 inside the uncompressed tars instead of organizing '
+                             '(extracting) them; the tars stay in the tile folders.')
+    parser.add_argument('--extract-for', nargs='+', default=None, choices=sorted(STAGE_BANDS), dest='extract_for',
+                        help='Only extract the bands these stages read (plus metadata) instead of every SR band.')
+    parser.add_argument('--check', choices=('mtime', 'hash'), default='mtime',
+                        help='How outputs are found up to date: newer than the inputs, or inputs unchanged since the '
+                             'last run (%s) [Default: %%(default)s]' % STATE_NAME)
+    parser.add_argument('-w', '--workers', type=int, default=None,
+                        help='Number of worker processes [Default: CPU count]')
+    parser.add_argument('--download-workers', type=int, default=2, dest='download_workers',
+                        help='Tiles downloading at the same time [Default: %(default)s]')
+    parser.add_argument('-o', '--output', type=str, default=None,
+                        help='Path of the JSON summary [Default: pipeline_summary.json in --root]')
+    parser.add_argument('--catalog', type=str, default=None,
+                        help='Scene catalog (see scene_catalog.py) to record the NBR and normalized outputs in.')
+    download = parser.add_argument_group('download arguments (see m2m_download.py)')
+    download.add_argument('--dataset', type=str, default='landsat_ard_tile_c2')
+    download.add_argument('--acq-date', type=str, dest='acq_date', default=None)
+    download.add_argument('--region', type=str, default='CU')
+    download.add_argument('--spacecraft', type=str, default=None)
+    download.add_argument('-cc', '--cloud-cover', type=int, dest='cloud_cover', default=None)
+    download.add_argument('-u', '--username', type=str, default=None)
+    download.add_argument('-tkn', '--token', type=str, default=None)
+    download.add_argument('-t', '--threads', type=int, default=12, help='Download threads per tile [Default: %(default)s]')
+    download.add_argument('--engine', choices=('process', 'thread'), default='thread')
+    raster_io.add_arguments(parser)
+    args = parser.parse_args()
+    raster_io.configure(args.output_format, args.compress, args.cache_mb)
+
+    import m2m_session
+    from m2m_download import parse_tile, read_tile_list
+    tiles = [parse_tile(t) for t in args.tiles]
+    if args.tile_file:
+        tiles.extend(read_tile_list(args.tile_file))
+    stages = [s for s in args.stages if not (args.no_download and s == 'download')]
+    if not tiles:
+        if 'download' in stages:
+            parser.error('specify --tiles and/or --tile-file to download')
+        # every tile folder under --root
+        tiles = [parse_tile((d[1:4], d[5:8])) for d in sorted(os.listdir(args.root))
+                 if len(d) == 8 and d[0] == 'h' and d[4] == 'v' and os.path.isdir(os.path.join(args.root, d))]
+
+    download_kwargs = dict(dataset=args.dataset, acq_date=args.acq_date, region=args.region,
+                           spacecraft=args.spacecraft, cloud_cover=args.cloud_cover,
+                           username=args.username, token=args.token, threads=args.threads, engine=args.engine,
+                           per_host=DOWNLOAD_PER_HOST, configure_session=False)
+    # the download tasks run at once on threads of this process and share its HTTP session, so it is
+    # configured once here (enough connections for each task's per-host downloads) and never by them
+    m2m_session.configure(pool_maxsize=max(m2m_session.POOL_MAXSIZE, DOWNLOAD_PER_HOST * args.download_workers))
+    pipeline = Pipeline(args.workers, args.download_workers, args.check, os.path.join(args.root, STATE_NAME))
+    catalog = SceneCatalog(args.catalog) if args.catalog else None
+    tile_pipeline = TilePipeline(pipeline, args.root, stages, download_kwargs, args.from_tars, args.extract_for,
+                                 catalog)
+    for h, v in tiles:
+        tile_pipeline.add_tile(h, v)
+
+    start = time.time()
+    tasks = pipeline.run()
+    if catalog is not None:
+        catalog.close()
+    result = summary(tasks, time.time() - start)
+
+    output = args.output or os.path.join(args.root, 'pipeline_summary.json')
+    with open(output, 'w') as f:
+        json.dump(result, f, indent=2)
+
+    print('Ran {} tasks for {} tiles in {:.1f} s'.format(len(tasks), len(tiles), time.time() - start))
+    for stage, counts in sorted(result['stages'].items()):
+        print('  {}: {}'.format(stage, ', '.join('{} {}'.format(n, s) for s, n in sorted(counts.items()))))
+    if result['first_product_seconds'] is not None:
+        print('First product after {:.1f} s'.format(result['first_product_seconds']))
+    print('Summary written to', output)
@@ -0,0 +1,263 @@
+#shared raster input/output layer for the NBR scripts
+#
+#every writer goes through open_output/write_array, which turn the source
+#profile into one of the output formats below and write atomically (to a
+#.part file renamed when complete):
+#  plain  the source profile as is (the old behaviour)
+#  tiled  GeoTIFF with 512x512 tiles, compression + predictor and internal overviews
+#  cog    Cloud-Optimized GeoTIFF (COG driver) with the same settings
+#the format and compression are process-wide settings (configure), so the
+#scripts only need to pass them on to their worker processes.
+#
+#reads can go through read_window/read_band, which keep recently decoded
+#blocks in an LRU cache keyed by (path, band, block window) within a memory
+#budget, so stages chained in one process don't decode the same tiles again.
+#the cache is per process and only hits when everything a run reads twice
+#fits in the budget (a 5000x5000 float32 NBR is about 100 MB); reads that
+#are not repeated pass cache=False so they don't push out the ones that are.
+
+import os
+import threading
+import contextlib
+from collections import OrderedDict
+
+import numpy as np
+
+import rasterio
+import rasterio.shutil
+from rasterio.enums import Resampling
+from rasterio.windows import Window
+
+from tar_index import real_path
+
+OUTPUT_FORMATS = ('plain', 'tiled', 'cog')
+COMPRESSIONS = ('deflate', 'zstd', 'lzw', 'none')
+BLOCK_SIZE = 512
+CACHE_MB = 256
+
+_settings = dict(output_format='tiled', compress='deflate', cache_mb=CACHE_MB)
+
+
+class BlockCache(object):
+    """LRU cache of decoded raster blocks with a memory budget in bytes"""
+
+    def __init__(self, max_bytes=CACHE_MB * 1024 * 1024):
+        self.max_bytes = max_bytes
+        self._blocks = OrderedDict()
+        self._lock = threading.Lock()
+        self.bytes = 0
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    def get(self, key):
+        with self._lock:
+            block = self._blocks.get(key)
+            if block is None:
+                self.misses += 1
+                return None
+            self._blocks.move_to_end(key)
+            self.hits += 1
+            return block
+
+    def put(self, key, block):
+        if block.nbytes > self.max_bytes:
+            return
+        block.flags.writeable = False
+        with self._lock:
+            old = self._blocks.pop(key, None)
+            if old is not None:
+                self.bytes -= old.nbytes
+            self._blocks[key] = block
+            self.bytes += block.nbytes
+            while self.bytes > self.max_bytes:
+                key, evicted = self._blocks.popitem(last=False)
+                self.bytes -= evicted.nbytes
+                self.evictions += 1
+
+    def resize(self, max_bytes):
+        with self._lock:
+            self.max_bytes = max_bytes
+            while self.bytes > self.max_bytes:
+                key, evicted = self._blocks.popitem(last=False)
+                self.bytes -= evicted.nbytes
+                self.evictions += 1
+
+    def clear(self):
+        with self._lock:
+            self._blocks.clear()
+            self.bytes = 0
+
+    def stats(self):
+        with self._lock:
+            return dict(hits=self.hits, misses=self.misses, evictions=self.evictions,
+                        blocks=len(self._blocks), bytes=self.bytes, max_bytes=self.max_bytes)
+
+
+_cache = BlockCache()
+
+
+def configure(output_format=None, compress=None, cache_mb=None):
+    """set the output format/compression and read cache budget for this process (also usable as a pool initializer)"""
+    if output_format is not None:
+        if output_format not in OUTPUT_FORMATS:
+            raise ValueError('unknown output format {!r}'.format(output_format))
+        _settings['output_format'] = output_format
+    if compress is not None:
+        if compress not in COMPRESSIONS:
+            raise ValueError('unknown compression {!r}'.format(compress))
+        _settings['compress'] = compress
+    if cache_mb is not None:
+        _settings['cache_mb'] = cache_mb
+        _cache.resize(int(cache_mb * 1024 * 1024))
+
+
+def settings():
+    """(output_format, compress, cache_mb) of this process, to pass to configure in workers"""
+    return _settings['output_format'], _settings['compress'], _settings['cache_mb']
+
+
+def add_arguments(parser):
+    """add --output-format/--compress/--cache-mb to an argparse parser"""
+    parser.add_argument('--output-format', choices=OUTPUT_FORMATS, default=_settings['output_format'],
+                        dest='output_format',
+                        help='Raster output format [Default: %(default)s]')
+    parser.add_argument('--compress', choices=COMPRESSIONS, default=_settings['compress'],
+                        help='Compression of tiled/cog outputs [Default: %(default)s]')
+    parser.add_argument('--cache-mb', type=float, default=_settings['cache_mb'], dest='cache_mb',
+                        help='Memory budget of the raster block cache per process, 0 disables it.  It only helps when '
+                             'every raster read twice fits, e.g. all NBR files of a tile for normalize_nbr.py '
+                             '(about 100 MB per 5000x5000 scene) [Default: %(default)s]')
+
+
+def _predictor(dtype):
+    return 3 if 'float' in str(dtype) else 2
+
+
+def output_profile(profile, output_format=None):
+    """the GTiff profile to write with, derived from a source profile"""
+    output_format = output_format or _settings['output_format']
+    profile = dict(profile)
+    if output_format == 'plain':
+        return profile
+    profile.update(driver='GTiff', tiled=True, blockxsize=BLOCK_SIZE, blockysize=BLOCK_SIZE,
+                   interleave='band', BIGTIFF='IF_SAFER')
+    for key in ('compress', 'predictor', 'zlevel', 'zstd_level'):
+        profile.pop(key, None)
+    if _settings['compress'] != 'none':
+        profile.update(compress=_settings['compress'], predictor=_predictor(profile['dtype']))
+    return profile
+
+
+def overview_factors(height, width):
+    """2, 4, 8, ... until the smallest overview fits in one block"""
+    factors = []
+    factor = 2
+    while max(height, width) / factor >= BLOCK_SIZE / 2:
+        factors.append(factor)
+        factor *= 2
+    return factors
+
+
+@contextlib.contextmanager
+def open_output(path, profile, resampling=Resampling.average):
+    """
+    open path for writing with the configured output format and yield the
+    dataset.  on success overviews are added (tiled/cog) and the file is
+    moved into place; on error the partial file is removed.
+    """
+    output_format = _settings['output_format']
+    profile = output_profile(profile, output_format)
+    tmp = path + '.part'
+    written = tmp + '.tif' if output_format == 'cog' else tmp
+    try:
+        with rasterio.open(written, 'w', **profile) as dst:
+            yield dst
+        if output_format == 'tiled':
+            factors = overview_factors(profile['height'], profile['width'])
+            if factors:
+                with rasterio.open(written, 'r+') as dst:
+                    dst.build_overviews(factors, resampling)
+        elif output_format == 'cog':
+            options = dict(BLOCKSIZE=BLOCK_SIZE, OVERVIEWS='AUTO', BIGTIFF='IF_SAFER',
+                           RESAMPLING=resampling.name.upper(),
+                           COMPRESS=_settings['compress'].upper())
+            if _settings['compress'] != 'none':
+                options['PREDICTOR'] = 'YES'
+            rasterio.shutil.copy(written, tmp, driver='COG', **options)
+        os.replace(tmp, path)
+    finally:
+        for leftover in {tmp, written}:
+            if os.path.exists(leftover):
+                os.remove(leftover)
+
+
+def write_array(path, array, profile, resampling=Resampling.average):
+    """write a 2D array as band 1 of path with the configured output format"""
+    with open_output(path, profile, resampling) as dst:
+        dst.write(array, 1)
+
+
+def cache_unit(src, min_rows=256):
+    """
+    (rows, cols) of the blocks cached for src: its internal tiles, or its
+    strips grouped to at least min_rows rows (as calculate_nbr.iter_windows)
+    """
+    block_rows, block_cols = src.block_shapes[0]
+    if block_cols < src.width:
+        return block_rows, block_cols
+    return -(-min_rows // block_rows) * block_rows, src.width
+
+
+def read_window(src, band=1, window=None, out=None, cache=True):
+    """
+    src.read(band, window=window, out=out) through the block cache: the
+    cache units (see cache_unit) overlapping the window are decoded once and
+    kept, whatever windows later reads use.  returns a new array (or out).
+    cache=False reads directly, for data that won't be read again.
+    """
+    if not cache or _cache.max_bytes <= 0:
+        return src.read(band, window=window, out=out)
+    if window is None:
+        window = Window(0, 0, src.width, src.height)
+    col_off, row_off = int(window.col_off), int(window.row_off)
+    width, height = int(window.width), int(window.height)
+    if out is None:
+        out = np.empty((height, width), dtype=src.dtypes[band - 1])
+
+    # a band read inside a .tar (/vsisubfile/) is keyed by its byte range and the tar's stat
+    path, offset = real_path(src.name)
+    stat = os.stat(path)
+    key = (os.path.abspath(path), offset, stat.st_mtime_ns, stat.st_size, band)
+    unit_rows, unit_cols = cache_unit(src)
+    for row in range(row_off - row_off % unit_rows, row_off + height, unit_rows):
+        for col in range(col_off - col_off % unit_cols, col_off + width, unit_cols):
+            block = _cache.get(key + (row, col))
+            if block is None:
+                block = src.read(band, window=Window(col, row, min(unit_cols, src.width - col),
+                                                     min(unit_rows, src.height - row)))
+                _cache.put(key + (row, col), block)
+            # overlap of the block and the window
+            r0, r1 = max(row, row_off), min(row + block.shape[0], row_off + height)
+            c0, c1 = max(col, col_off), min(col + block.shape[1], col_off + width)
+            out[r0 - row_off:r1 - row_off, c0 - col_off:c1 - col_off] = \
+                block[r0 - row:r1 - row, c0 - col:c1 - col]
+    return out
+
+
+def read_band(path, band=1, cache=True):
+    """a whole band of a raster file through the block cache (unless cache=False)"""
+    with rasterio.open(path) as src:
+        return read_window(src, band, cache=cache)
+
+
+def cache_stats():
+    return _cache.stats()
+
+
+def format_cache_stats(stats=None):
+    stats = stats or cache_stats()
+    lookups = stats['hits'] + stats['misses']
+    return 'raster block cache: {} hits, {} misses ({:.0%} hit rate), {} evictions, {:.1f} of {:.0f} MB used'.format(
+        stats['hits'], stats['misses'], stats['hits'] / lookups if lookups else 0, stats['evictions'],
+        stats['bytes'] / 1024 / 1024, stats['max_bytes'] / 1024 / 1024)
@@ -0,0 +1,363 @@
+"""
+Global scene catalog, one SQLite file for all tiles
+
+One row per scene (ARD product ID) with its tile, acquisition date, sensor,
+cloud/snow/fill cover and processing status (organized, nbr, normalized),
+plus one row per file of the scene (band, product, metadata, NBR, ...) and
+per tile-level file (mean/std images) with its path.  The catalog is filled
+in as tars are organized (organize_parallel.py --catalog) and products are
+made (calculate_nbr.py, normalize_nbr.py, pipeline.py and watch.py with
+--catalog) or built from an existing download tree, after which selecting
+scenes is an indexed query instead of a walk over the tile folders:
+
+    python scene_catalog.py -c catalog.sqlite build --root downloads
+    python scene_catalog.py -c catalog.sqlite query --tile h003v010 \\
+        --instrument OLI_TIRS --max-cloud 10 --month 8 --kind SR_B5
+"""
+
+import os
+import re
+import glob
+import sqlite3
+import argparse
+import datetime
+import threading
+
+from stack_index import COLUMNS, build_stack, find_tile_tars
+
+
+CATALOG_NAME = 'scene_catalog.sqlite'
+
+# status values
+ORGANIZED = 'organized'
+NBR = 'nbr'
+NORMALIZED = 'normalized'
+
+# ARD product ID at the start of every file name of a scene
+SCENE_ID = re.compile(r'L[CETMO]0\d_CU_\d{6}_\d{8}_\d{8}_\d{2}')
+
+SCHEMA = """
+PRAGMA journal_mode = WAL;
+CREATE TABLE IF NOT EXISTS scenes (
+    scene_id         TEXT PRIMARY KEY,
+    tile             TEXT NOT NULL,
+    hh               TEXT,
+    vv               TEXT,
+    path             TEXT,
+    row              TEXT,
+    sensor           TEXT,
+    instrument       TEXT,
+    acquisition_date TEXT NOT NULL,
+    year             INTEGER,
+    month            INTEGER,
+    day              INTEGER,
+    julian           INTEGER,
+    rmse             REAL,
+    cloud_cover      REAL,
+    snow_ice         REAL,
+    fill             REAL,
+    production_date  TEXT,
+    status           TEXT,
+    updated          TEXT NOT NULL
+);
+CREATE INDEX IF NOT EXISTS scenes_tile_date ON scenes (tile, acquisition_date);
+CREATE INDEX IF NOT EXISTS scenes_month ON scenes (month, cloud_cover);
+CREATE INDEX IF NOT EXISTS scenes_instrument ON scenes (instrument, cloud_cover);
+CREATE INDEX IF NOT EXISTS scenes_status ON scenes (status);
+CREATE TABLE IF NOT EXISTS files (
+    scene_id TEXT NOT NULL,
+    kind     TEXT NOT NULL,
+    path     TEXT NOT NULL,
+    PRIMARY KEY (scene_id, kind)
+);
+CREATE INDEX IF NOT EXISTS files_kind ON files (kind);
+CREATE INDEX IF NOT EXISTS files_path ON files (path);
+CREATE TABLE IF NOT EXISTS tile_files (
+    tile TEXT NOT NULL,
+    kind TEXT NOT NULL,
+    path TEXT NOT NULL,
+    PRIMARY KEY (tile, kind)
+);
+"""
+
+SCENE_COLUMNS = ('scene_id', 'tile', 'hh', 'vv', 'path', 'row', 'sensor',
+                 'instrument', 'acquisition_date', 'year', 'month', 'day',
+                 'julian', 'rmse', 'cloud_cover', 'snow_ice', 'fill',
+                 'production_date')
+
+
+def _now():
+    return datetime.datetime.now().isoformat(timespec='seconds')
+
+
+def scene_id_of(filename):
+    """
+    ARD product ID of a scene file name, or None
+    """
+    match = SCENE_ID.match(os.path.basename(filename))
+    return match.group(0) if match else None
+
+
+def file_kind(filename):
+    """
+    Kind of a scene file: what follows the product ID without the extension
+    (SR_B5, BP, SR_NBR, BA_stac, ...), or the extension when nothing does
+    (xml, png)
+    """
+    name = os.path.basename(filename)
+    scene_id = scene_id_of(name)
+    rest = name[len(scene_id):] if scene_id else name
+    stem, dot, ext = rest.rpartition('.')
+    return stem.lstrip('_') or ext.lower()
+
+
+def scene_from_stack_row(row):
+    """
+    scenes row (dict) from a stack_index.stack_row tuple
+    """
+    values = dict(zip(COLUMNS, row))
+    rmse = values['RMSE']
+    return dict(scene_id=values['FILE'],
+                tile='h{}v{}'.format(values['HH'], values['VV']),
+                hh=values['HH'], vv=values['VV'],
+                path=values['PATH'], row=values['ROW'],
+                sensor=values['SENSOR'], instrument=values['INSTRUMENT'],
+                acquisition_date=values['ACQUISITION_DATE'],
+                year=int(values['YEAR']), month=int(values['MONTH']),
+                day=int(values['DAY']), julian=int(values['JULIAN']),
+                rmse=None if rmse == 'NA' else rmse,
+                cloud_cover=values['CLOUD_COVER'],
+                snow_ice=values['SNOW_ICE'], fill=values['FILL'],
+                production_date=values['PRODUCTION_DATE'])
+
+
+class SceneCatalog(object):
+    """
+    SQLite catalog of scenes and their files.  Safe to share between
+    threads of one process; other processes can read it concurrently.
+    """
+
+    def __init__(self, path):
+        self.path = path
+        self._lock = threading.Lock()
+        self._conn = sqlite3.connect(path, timeout=60,
+                                     check_same_thread=False)
+        self._conn.row_factory = sqlite3.Row
+        with self._lock, self._conn:
+            self._conn.executescript(SCHEMA)
+
+    def close(self):
+        with self._lock:
+            self._conn.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+    def add_scenes(self, scenes, status=None):
+        """
+        Insert or update scenes (dicts with SCENE_COLUMNS).  The status of
+        an existing scene is kept unless one is given.
+        """
+        now = _now()
+        columns = list(SCENE_COLUMNS) + ['status', 'updated']
+        assignments = ', '.join('{0} = excluded.{0}'.format(c)
+                                for c in SCENE_COLUMNS[1:] + ('updated',))
+        assignments += ', status = COALESCE(excluded.status, status)'
+        with self._lock, self._conn:
+            self._conn.executemany(
+                'INSERT INTO scenes ({}) VALUES ({}) '
+                'ON CONFLICT (scene_id) DO UPDATE SET {}'.format(
+                    ', '.join(columns), ', '.join('?' * len(columns)),
+                    assignments),
+                [[scene[c] for c in SCENE_COLUMNS] + [status, now]
+                 for scene in scenes])
+
+    def add_files(self, paths):
+        """
+        Register scene files by path, the scene and kind come from the file
+        name.  Files without a product ID in their name are ignored.
+        """
+        rows = []
+        for path in paths:
+            scene_id = scene_id_of(path)
+            if scene_id:
+                rows.append((scene_id, file_kind(path), os.path.abspath(path)))
+        with self._lock, self._conn:
+            self._conn.executemany(
+                'INSERT OR REPLACE INTO files (scene_id, kind, path) '
+                'VALUES (?, ?, ?)', rows)
+        return len(rows)
+
+    def add_tile_files(self, tile, paths):
+        """
+        Register tile-level files (mean_nbr_image.tif, ...) of a tile
+        (hHHHvVVV), the kind is the file name without its extension
+        """
+        rows = [(tile, os.path.splitext(os.path.basename(path))[0],
+                 os.path.abspath(path)) for path in paths]
+        with self._lock, self._conn:
+            self._conn.executemany(
+                'INSERT OR REPLACE INTO tile_files (tile, kind, path) '
+                'VALUES (?, ?, ?)', rows)
+        return len(rows)
+
+    def record(self, paths, status, tile=None):
+        """
+        Register the products a stage wrote and move their scenes to status.
+        Files without a product ID in their name are tile-level files of
+        tile (ignored without one).  Scenes not in the catalog yet only get
+        their files.
+        """
+        paths = [path for path in paths if os.path.exists(path)]
+        scene_files = [path for path in paths if scene_id_of(path)]
+        self.add_files(scene_files)
+        self.set_status(sorted(set(scene_id_of(path) for path in scene_files)), status)
+        if tile:
+            self.add_tile_files(tile, [path for path in paths if not scene_id_of(path)])
+
+    def set_status(self, scene_ids, status):
+        now = _now()
+        with self._lock, self._conn:
+            self._conn.executemany(
+                'UPDATE scenes SET status = ?, updated = ? WHERE scene_id = ?',
+                [(status, now, scene_id) for scene_id in scene_ids])
+
+    def query(self, tiles=None, instrument=None, sensor=None, max_cloud=None,
+              months=None, start=None, end=None, status=None, kind=None):
+        """
+        Scenes (list of dicts) matching every given filter, ordered by tile
+        and acquisition date.  start/end are inclusive YYYY-MM-DD dates.
+        With kind, only scenes that have a file of that kind are returned,
+        with its path in 'file'.
+        """
+        where = []
+        params = []
+
+        def any_of(column, values):
+            values = [values] if isinstance(values, (str, int)) else list(values)
+            where.append('s.{} IN ({})'.format(column, ', '.join('?' * len(values))))
+            params.extend(values)
+
+        if tiles:
+            any_of('tile', tiles)
+        if instrument:
+            any_of('instrument', instrument)
+        if sensor:
+            any_of('sensor', sensor)
+        if months:
+            any_of('month', months)
+        if status:
+            any_of('status', status)
+        if max_cloud is not None:
+            where.append('s.cloud_cover < ?')
+            params.append(max_cloud)
+        if start:
+            where.append('s.acquisition_date >= ?')
+            params.append(start)
+        if end:
+            where.append('s.acquisition_date <= ?')
+            params.append(end)
+
+        sql = 'SELECT s.*'
+        if kind:
+            sql += ', f.path AS file FROM scenes s JOIN files f ' \
+                   'ON f.scene_id = s.scene_id AND f.kind = ?'
+            params.insert(0, kind)
+        else:
+            sql += ' FROM scenes s'
+        if where:
+            sql += ' WHERE ' + ' AND '.join(where)
+        sql += ' ORDER BY s.tile, s.acquisition_date'
+        with self._lock:
+            return [dict(row) for row in self._conn.execute(sql, params)]
+
+    def files(self, scene_id):
+        """
+        {kind: path} of one scene
+        """
+        with self._lock:
+            rows = self._conn.execute(
+                'SELECT kind, path FROM files WHERE scene_id = ?', (scene_id,))
+            return {row['kind']: row['path'] for row in rows}
+
+    def tile_files(self, tile):
+        """
+        {kind: path} of the tile-level files of one tile
+        """
+        with self._lock:
+            rows = self._conn.execute(
+                'SELECT kind, path FROM tile_files WHERE tile = ?', (tile,))
+            return {row['kind']: row['path'] for row in rows}
+
+
+def build_tile(catalog, tile_dir, workers=None):
+    """
+    Add one organized (or not yet organized) tile folder to the catalog:
+    scenes from its metadata and tars, files from one walk of the folder.
+    Returns (number of scenes, number of files, errors).
+    """
+    xml_files = glob.glob(os.path.join(tile_dir, 'metadata', '*.xml'))
+    stack, errors = build_stack(xml_files=xml_files,
+                                tars=find_tile_tars(tile_dir), workers=workers)
+    rows = stack.reset_index()[list(COLUMNS)].itertuples(index=False, name=None)
+    scenes = [scene_from_stack_row(row) for row in rows]
+
+    paths = []
+    for root, dirs, files in os.walk(tile_dir):
+        dirs[:] = [d for d in dirs if d != 'tar_downloads']
+        paths.extend(os.path.join(root, f) for f in files if scene_id_of(f))
+
+    #scenes with extracted files are organized, the others are still in their tar
+    extracted = set(scene_id_of(path) for path in paths)
+    catalog.add_scenes([s for s in scenes if s['scene_id'] in extracted], status=ORGANIZED)
+    catalog.add_scenes([s for s in scenes if s['scene_id'] not in extracted])
+    added = catalog.add_files(paths)
+    return len(scenes), added, errors
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Build or query the scene catalog.')
+    parser.add_argument('-c', '--catalog', required=True, type=str,
+                        help='Path of the catalog (e.g. downloads/{}). (Required)'.format(CATALOG_NAME))
+    subparsers = parser.add_subparsers(dest='command', required=True)
+
+    build = subparsers.add_parser('build', help='Add tile folders to the catalog.')
+    build.add_argument('-d', '--tar_directory', nargs='+', default=[], type=str, dest='tar_directory',
+                       help='Tile folder(s) to add.')
+    build.add_argument('--root', type=str, default=None,
+                       help='Add every tile folder directly under this folder.')
+    build.add_argument('-w', '--workers', type=int, default=None,
+                       help='Number of worker processes for metadata parsing [Default: CPU count]')
+
+    query = subparsers.add_parser('query', help='List matching scenes.')
+    query.add_argument('--tile', nargs='+', default=None, help='Tile(s), e.g. h003v010')
+    query.add_argument('--instrument', nargs='+', default=None, help='e.g. OLI_TIRS')
+    query.add_argument('--sensor', nargs='+', default=None, help='Last character of the spacecraft, e.g. 8')
+    query.add_argument('--max-cloud', type=float, default=None, dest='max_cloud',
+                       help='Only scenes with less cloud cover than this.')
+    query.add_argument('--month', nargs='+', type=int, default=None)
+    query.add_argument('--start', default=None, help='First acquisition date (YYYY-MM-DD)')
+    query.add_argument('--end', default=None, help='Last acquisition date (YYYY-MM-DD)')
+    query.add_argument('--status', nargs='+', default=None)
+    query.add_argument('--kind', default=None,
+                       help='Print the path of this file kind (e.g. SR_B5, BP, SR_NBR) instead of the scene ID.')
+    args = parser.parse_args()
+
+    with SceneCatalog(args.catalog) as catalog:
+        if args.command == 'build':
+            directories = [os.path.normpath(d) for d in args.tar_directory]
+            if args.root:
+                directories.extend(sorted(d for d in glob.glob(os.path.join(args.root, '*'))
+                                          if os.path.isdir(d)))
+            for tile_dir in directories:
+                scenes, files, errors = build_tile(catalog, tile_dir, args.workers)
+                print('Added {} scenes and {} files from {} ({} errors)'.format(scenes, files, tile_dir, len(errors)))
+        else:
+            scenes = catalog.query(tiles=args.tile, instrument=args.instrument, sensor=args.sensor,
+                                   max_cloud=args.max_cloud, months=args.month, start=args.start,
+                                   end=args.end, status=args.status, kind=args.kind)
+            for scene in scenes:
+                print(scene['file'] if args.kind else scene['scene_id'])
@@ -0,0 +1,198 @@
+#bulk metadata indexer used to generate stack_new.csv
+#
+#each ARD .xml is streamed with an incremental parser (namespaces stripped)
+#and only the tags needed for the stack are kept; parsing stops as soon as
+#all of them have been seen.  the .xml can come from the tile's metadata
+#folder or straight out of the .tar files without extracting them.  files are
+#parsed in parallel across a process pool and the table is built once from
+#columns, so a tile with thousands of scenes is indexed in seconds.
+#
+# python stack_index.py -d downloads/h003v010
+# python stack_index.py -d downloads/h003v010 --tars -w 16
+
+import os
+import glob
+import time
+import tarfile
+import argparse
+import xml.etree.ElementTree as ET
+from concurrent.futures import ProcessPoolExecutor
+
+import pandas as pd
+
+# tags read from each .xml, the first occurrence in the document wins
+TAGS = ('ARD_PRODUCT_ID', 'TILE_GRID_H', 'TILE_GRID_V', 'WRS_PATH', 'WRS_ROW',
+        'SPACECRAFT_ID', 'DATE_ACQUIRED', 'GEOMETRIC_RMSE_MODEL', 'CLOUD_COVER',
+        'SNOW_ICE_COVER', 'FILL', 'SENSOR_ID', 'DATE_PRODUCT_GENERATED')
+
+# some .xmls do not have these, the stack gets 'NA' instead
+OPTIONAL_TAGS = ('GEOMETRIC_RMSE_MODEL',)
+
+# stack_new.csv columns, in order (FILE is the index)
+COLUMNS = ('FILE', 'HH', 'VV', 'PATH', 'ROW', 'SENSOR', 'YEAR', 'MONTH', 'DAY',
+           'JULIAN', 'RMSE', 'CLOUD_COVER', 'SNOW_ICE', 'FILL', 'INSTRUMENT',
+           'ACQUISITION_DATE', 'PRODUCTION_DATE', 'OUTPUT')
+
+# files per task when parsing loose .xml files
+CHUNK_SIZE = 64
+
+
+def _local_name(tag):
+    return tag.rsplit('}', 1)[-1]
+
+
+def parse_metadata(source):
+    """
+    stream one .xml (path or file object) and return {tag: text} for TAGS.
+    raises KeyError if a required tag is missing.
+    """
+    if isinstance(source, str):
+        with open(source, 'rb') as f:
+            return parse_metadata(f)
+    values = {}
+    wanted = set(TAGS)
+    context = ET.iterparse(source, events=('end',))
+    for event, element in context:
+        name = _local_name(element.tag)
+        if name in wanted:
+            values[name] = (element.text or '').strip()
+            wanted.discard(name)
+            if not wanted:
+                break
+        element.clear()
+    missing = wanted.difference(OPTIONAL_TAGS)
+    if missing:
+        raise KeyError('missing {} in metadata'.format(', '.join(sorted(missing))))
+    return values
+
+
+def stack_row(values):
+    """one stack_new.csv row (tuple in COLUMNS order) from parse_metadata output"""
+    a_date = values['DATE_ACQUIRED']
+    rmse = values.get('GEOMETRIC_RMSE_MODEL')
+    return (values['ARD_PRODUCT_ID'],
+            values['TILE_GRID_H'],
+            values['TILE_GRID_V'],
+            values['WRS_PATH'],
+            values['WRS_ROW'],
+            values['SPACECRAFT_ID'][-1:],
+            a_date[0:4],
+            a_date[5:7],
+            a_date[8:],
+            time.strptime(a_date, '%Y-%m-%d').tm_yday,
+            float(rmse) if rmse else 'NA',
+            float(values['CLOUD_COVER']),
+            float(values['SNOW_ICE_COVER']),
+            float(values['FILL']),
+            values['SENSOR_ID'],
+            a_date,
+            values['DATE_PRODUCT_GENERATED'],
+            ###not sure exactly what the output column means but making it 1 for every row so it can be read by QA tool
+            1)
+
+
+def index_xml_files(xml_files):
+    """rows and errors for a list of loose .xml files"""
+    rows = []
+    errors = []
+    for xml in xml_files:
+        try:
+            rows.append((os.path.basename(xml), stack_row(parse_metadata(xml))))
+        except (ET.ParseError, KeyError, ValueError, OSError) as e:
+            errors.append('{}: {}'.format(xml, e))
+    return rows, errors
+
+
+def index_tar(in_tar):
+    """
+    rows and errors for the .xml members of one .tar.  the archive is read
+    with seeks, so the image members are skipped rather than read.
+    """
+    rows = []
+    errors = []
+    try:
+        with tarfile.open(in_tar) as tar:
+            for member in tar:
+                if not (member.isfile() and member.name.endswith('.xml')):
+                    continue
+                try:
+                    with tar.extractfile(member) as f:
+                        rows.append((os.path.basename(member.name), stack_row(parse_metadata(f))))
+                except (ET.ParseError, KeyError, ValueError) as e:
+                    errors.append('{}:{}: {}'.format(in_tar, member.name, e))
+    except (tarfile.TarError, OSError) as e:
+        errors.append('{}: {}'.format(in_tar, e))
+    return rows, errors
+
+
+def find_tile_tars(tile_dir):
+    """.tar files of a tile, whether organized yet or not"""
+    return sorted(glob.glob(os.path.join(tile_dir, '*.tar')) +
+                  glob.glob(os.path.join(tile_dir, 'tar_downloads', '*.tar')))
+
+
+def build_stack(xml_files=(), tars=(), workers=None):
+    """
+    index xml_files and the .xml members of tars in parallel.
+    returns (stack DataFrame indexed by FILE, sorted by ACQUISITION_DATE, errors)
+    """
+    xml_files = sorted(xml_files)
+    tasks = [(index_xml_files, xml_files[i:i + CHUNK_SIZE])
+             for i in range(0, len(xml_files), CHUNK_SIZE)]
+    tasks += [(index_tar, tar) for tar in tars]
+
+    if workers == 1 or len(tasks) <= 1:
+        results = [function(arg) for function, arg in tasks]
+    else:
+        with ProcessPoolExecutor(max_workers=workers) as executor:
+            futures = [executor.submit(function, arg) for function, arg in tasks]
+            results = [future.result() for future in futures]
+
+    #the same .xml can be both extracted and still inside its .tar, keep one
+    rows = {}
+    errors = []
+    for task_rows, task_errors in results:
+        for name, row in task_rows:
+            rows.setdefault(name, row)
+        errors.extend(task_errors)
+
+    #build the table once, from columns
+    rows = [rows[name] for name in sorted(rows)]
+    columns = list(zip(*rows)) if rows else [()] * len(COLUMNS)
+    stack = pd.DataFrame({name: list(values) for name, values in zip(COLUMNS, columns)},
+                         columns=list(COLUMNS))
+    stack = stack.set_index('FILE')
+    stack.sort_values(by='ACQUISITION_DATE', axis=0, inplace=True, kind='stable')
+    return stack, errors
+
+
+def write_stack_csv(tile_dir, from_tars=False, workers=None, out_csv=None):
+    """
+    write stack_new.csv for one tile from its metadata folder, or from the
+    .xml members of its .tar files.  returns the list of errors.
+    """
+    if from_tars:
+        stack, errors = build_stack(tars=find_tile_tars(tile_dir), workers=workers)
+    else:
+        xml_files = glob.glob(os.path.join(tile_dir, 'metadata', '*.xml'))
+        stack, errors = build_stack(xml_files=xml_files, workers=workers)
+    stack.to_csv(out_csv or os.path.join(tile_dir, 'stack_new.csv'))
+    for error in errors:
+        print('ERROR reading metadata', error)
+    return errors
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Generate stack_new.csv for one or many tiles.')
+    parser.add_argument('-d', '--tar_directory', nargs='+', required=True, type=str, dest='tar_directory',
+                        help='Tile folder(s) to index. (Required)')
+    parser.add_argument('--tars', action='store_true', dest='from_tars',
+                        help='Read the .xml straight out of the .tar files instead of the metadata folder.')
+    parser.add_argument('-w', '--workers', type=int, default=None,
+                        help='Number of worker processes [Default: CPU count]')
+    args = parser.parse_args()
+
+    for tile_dir in args.tar_directory:
+        start = time.time()
+        errors = write_stack_csv(os.path.normpath(tile_dir), args.from_tars, args.workers)
+        print('Wrote stack_new.csv for {} in {:.1f} s ({} errors)'.format(tile_dir, time.time() - start, len(errors)))
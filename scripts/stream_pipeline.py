@@ -0,0 +1,312 @@
+#streaming download -> extract -> NBR for ARD tiles
+#
+#every tar is handed on the moment its download completes (the .part ->
+#final rename in m2m_download.download_url) instead of after the whole batch:
+#
+#  download threads --> tar queue --> extract workers --> scene queue --> NBR workers
+#
+#both queues are bounded, so a slow stage holds back the one feeding it: a
+#full tar queue blocks the download thread that finished (and with it a
+#download slot), a full scene queue blocks extraction.  raw tar bytes are
+#bounded as well: each queued download reserves --tar-gb until it completes
+#(then its real size) and no new download is queued while the tars queued,
+#downloading or waiting for extraction add up to --max-tar-gb or the disk
+#has less than --min-free-gb free, so the raw tars on disk stay under about
+#--max-tar-gb plus one tar (with --delete-tars, which removes each tar once
+#it is extracted, as organize_one_tile.sh does with tar_downloads).  tars
+#already in the tile folders are fed in first.
+#
+# python stream_pipeline.py --root downloads --tiles 3,10 3,11 --dataset landsat_ard_tile_c2 --acq-date "2020-08-01,2020-08-31" --delete-tars --max-tar-gb 50
+# python stream_pipeline.py --root downloads --tile-file download_multiple_tiles.sh --extract-workers 8 --nbr-workers 24
+
+import os
+import glob
+import time
+import queue
+import shutil
+import argparse
+import threading
+from concurrent.futures import ProcessPoolExecutor
+
+import raster_io
+from calculate_nbr import process_scene, find_band_files
+from pipeline import test_tar, organize_tar
+from tar_extract import STAGE_BANDS
+
+QUEUE_SIZE = 16
+GB = 1024 ** 3
+# bytes reserved for a download until its real size is known (an ARD SR tile bundle is about 1 GB)
+TAR_SIZE = GB
+
+# end of a queue
+_DONE = None
+
+
+class DiskBudget(object):
+    """
+    raw tar bytes on disk or on their way, with a limit.  reserve() (the
+    download_files before_submit hook) blocks while they reach max_bytes or
+    the disk under path has less than min_free bytes free, then holds
+    estimate bytes for the download until it completes (hold() swaps in the
+    real size) or fails.  release() gives the bytes back after extraction.
+    """
+
+    def __init__(self, path, max_bytes=None, min_free=None, estimate=TAR_SIZE, poll=5.0):
+        self.path = path
+        self.max_bytes = max_bytes
+        self.min_free = min_free
+        self.estimate = estimate
+        self.poll = poll
+        self.pending = 0
+        self.peak = 0
+        self.waits = 0
+        # url or tar path -> bytes held for it
+        self.held = {}
+        self._cond = threading.Condition()
+
+    def _blocked(self):
+        if self.max_bytes is not None and self.pending >= self.max_bytes:
+            return True
+        return self.min_free is not None and shutil.disk_usage(self.path).free < self.min_free
+
+    def _hold(self, key, size, replaces=None):
+        self.pending += size - self.held.pop(key, 0) - self.held.pop(replaces, 0)
+        self.held[key] = size
+        self.peak = max(self.peak, self.pending)
+
+    def reserve(self, item):
+        """wait for room, then hold the estimated size for the download of item (url, directory, ...)"""
+        with self._cond:
+            if self._blocked():
+                self.waits += 1
+                print('Waiting for disk space ({:.1f} GB of tars pending)'.format(self.pending / GB))
+            while self._blocked():
+                # the free space also changes by itself (downloads in flight), so poll
+                self._cond.wait(self.poll)
+            self._hold(item[0], self.estimate)
+
+    def hold(self, key, size, replaces=None):
+        """hold size bytes for key, instead of what was held for it (and for replaces)"""
+        with self._cond:
+            self._hold(key, size, replaces)
+            self._cond.notify_all()
+
+    def release(self, key):
+        with self._cond:
+            self.pending -= self.held.pop(key, 0)
+            self._cond.notify_all()
+
+
+class StreamingPipeline(object):
+    """bounded queues and worker threads handing tars to extraction and scenes to NBR in worker processes"""
+
+    def __init__(self, extract_workers=4, nbr_workers=None, queue_size=QUEUE_SIZE, budget=None,
+                 delete_tars=False, test=True, extract_for=None):
+        self.extract_workers = extract_workers
+        self.nbr_workers = nbr_workers or os.cpu_count()
+        self.tars = queue.Queue(queue_size)
+        self.scenes = queue.Queue(queue_size)
+        self.budget = budget
+        self.delete_tars = delete_tars
+        self.test = test
+        self.extract_for = extract_for
+        self.published = set()
+        self.stats = dict(tars=0, extracted=0, scenes=0, nbr=0, errors=[],
+                          max_tar_queue=0, max_scene_queue=0, first_nbr_seconds=None)
+        self._lock = threading.Lock()
+        self.start = None
+
+    def publish(self, path, tile_dir, url=None):
+        """
+        queue a complete tar for extraction (blocks while the tar queue is
+        full).  the bytes reserved for its download (url) become its size.
+        """
+        with self._lock:
+            new = path not in self.published
+            self.published.add(path)
+            if new:
+                self.stats['tars'] += 1
+        if self.budget is not None:
+            try:
+                size = os.path.getsize(path) if new else 0
+            except OSError as e:
+                self._error(path, e)
+                new = False
+            if new:
+                self.budget.hold(path, size, replaces=url)
+            else:
+                self.budget.release(url)
+        if not new:
+            return
+        self.tars.put((path, tile_dir))
+        with self._lock:
+            self.stats['max_tar_queue'] = max(self.stats['max_tar_queue'], self.tars.qsize())
+
+    def on_download(self, download, item):
+        """m2m_download.download_files on_complete hook"""
+        if download['filename'].endswith('.tar'):
+            self.publish(download['path'], item[1], item[0])
+        elif self.budget is not None:
+            self.budget.release(item[0])
+
+    def on_failed(self, item, error):
+        """m2m_download.download_files on_failed hook"""
+        if self.budget is not None:
+            self.budget.release(item[0])
+
+    def _error(self, what, e):
+        message = '{}: {}: {}'.format(what, e.__class__.__name__, e)
+        print('ERROR', message)
+        with self._lock:
+            self.stats['errors'].append(message)
+
+    def _extract(self, executor):
+        while True:
+            work = self.tars.get()
+            if work is _DONE:
+                return
+            in_tar, tile_dir = work
+            try:
+                if self.test:
+                    executor.submit(test_tar, in_tar).result()
+                scene_dirs = executor.submit(organize_tar, in_tar, tile_dir, self.extract_for).result()
+                print('Extracted', in_tar)
+                with self._lock:
+                    self.stats['extracted'] += 1
+                if self.delete_tars:
+                    os.remove(os.path.join(tile_dir, 'tar_downloads', os.path.basename(in_tar)))
+            except Exception as e:
+                self._error(in_tar, e)
+                continue
+            finally:
+                if self.budget is not None:
+                    self.budget.release(in_tar)
+            for scene_dir in scene_dirs:
+                try:
+                    find_band_files(scene_dir)
+                except IndexError:
+                    continue  # no B5/B7 in this scene
+                self.scenes.put(scene_dir)
+                with self._lock:
+                    self.stats['scenes'] += 1
+                    self.stats['max_scene_queue'] = max(self.stats['max_scene_queue'], self.scenes.qsize())
+
+    def _nbr(self, executor):
+        while True:
+            scene_dir = self.scenes.get()
+            if scene_dir is _DONE:
+                return
+            try:
+                executor.submit(process_scene, scene_dir).result()
+            except Exception as e:
+                self._error(scene_dir, e)
+                continue
+            with self._lock:
+                self.stats['nbr'] += 1
+                if self.stats['first_nbr_seconds'] is None:
+                    self.stats['first_nbr_seconds'] = round(time.time() - self.start, 3)
+
+    def __enter__(self):
+        self.start = time.time()
+        self._extract_pool = ProcessPoolExecutor(self.extract_workers)
+        self._nbr_pool = ProcessPoolExecutor(self.nbr_workers, initializer=raster_io.configure,
+                                             initargs=raster_io.settings())
+        # one thread per worker process keeps every process busy
+        self._extractors = [threading.Thread(target=self._extract, args=(self._extract_pool,), daemon=True)
+                            for _ in range(self.extract_workers)]
+        self._computers = [threading.Thread(target=self._nbr, args=(self._nbr_pool,), daemon=True)
+                           for _ in range(self.nbr_workers)]
+        for thread in self._extractors + self._computers:
+            thread.start()
+        return self
+
+    def __exit__(self, *args):
+        """drain the queues once nothing more is published, stop the workers"""
+        for _ in self._extractors:
+            self.tars.put(_DONE)
+        for thread in self._extractors:
+            thread.join()
+        for _ in self._computers:
+            self.scenes.put(_DONE)
+        for thread in self._computers:
+            thread.join()
+        self._extract_pool.shutdown()
+        self._nbr_pool.shutdown()
+        self.stats['seconds'] = round(time.time() - self.start, 3)
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Download ARD tiles and extract and calculate the NBR of each tar as soon as it is downloaded.')
+    parser.add_argument('--root', required=True, help='Folder containing the tile folders (hHHHvVVV). (Required)')
+    parser.add_argument('--tiles', nargs='+', default=[], help='Tiles as h,v (e.g. 3,10 3,11)')
+    parser.add_argument('--tile-file', type=str, default=None, dest='tile_file',
+                        help='Text file of tiles, same format as m2m_download.py --tile-file.')
+    parser.add_argument('--extract-workers', type=int, default=4, dest='extract_workers',
+                        help='Extraction worker processes [Default: %(default)s]')
+    parser.add_argument('--nbr-workers', type=int, default=None, dest='nbr_workers',
+                        help='NBR worker processes [Default: CPU count]')
+    parser.add_argument('--queue-size', type=int, default=QUEUE_SIZE, dest='queue_size',
+                        help='Capacity of the tar and scene queues [Default: %(default)s]')
+    parser.add_argument('--max-tar-gb', type=float, default=None, dest='max_tar_gb',
+                        help='Hold back downloads while this many GB of tars are queued, downloading or waiting for extraction')
+    parser.add_argument('--tar-gb', type=float, default=TAR_SIZE / GB, dest='tar_gb',
+                        help='GB reserved for each download until its size is known [Default: %(default)s]')
+    parser.add_argument('--min-free-gb', type=float, default=None, dest='min_free_gb',
+                        help='Hold back downloads while the disk has less free space')
+    parser.add_argument('--delete-tars', action='store_true', dest='delete_tars',
+                        help='Remove each tar once it is extracted (instead of keeping it in tar_downloads).')
+    parser.add_argument('--extract-for', nargs='+', default=None, choices=sorted(STAGE_BANDS), dest='extract_for',
+                        help='Only extract the bands these stages read (plus metadata) [Default: every SR band]')
+    parser.add_argument('--no-test', action='store_false', dest='test',
+                        help='Do not verify each tar before extracting it.')
+    download = parser.add_argument_group('download arguments (see m2m_download.py)')
+    download.add_argument('--dataset', type=str, default='landsat_ard_tile_c2')
+    download.add_argument('--acq-date', type=str, dest='acq_date', default=None)
+    download.add_argument('--region', type=str, default='CU')
+    download.add_argument('--spacecraft', type=str, default=None)
+    download.add_argument('-cc', '--cloud-cover', type=int, dest='cloud_cover', default=None)
+    download.add_argument('-u', '--username', type=str, default=None)
+    download.add_argument('-tkn', '--token', type=str, default=None)
+    download.add_argument('-t', '--threads', type=int, default=12, help='Download threads [Default: %(default)s]')
+    raster_io.add_arguments(parser)
+    args = parser.parse_args()
+    raster_io.configure(args.output_format, args.compress, args.cache_mb)
+
+    from m2m_download import download_files, parse_tile, read_tile_list, tile_name
+    tiles = [parse_tile(t) for t in args.tiles]
+    if args.tile_file:
+        tiles.extend(read_tile_list(args.tile_file))
+    if not tiles:
+        parser.error('specify --tiles and/or --tile-file')
+
+    budget = DiskBudget(args.root,
+                        args.max_tar_gb * GB if args.max_tar_gb is not None else None,
+                        args.min_free_gb * GB if args.min_free_gb is not None else None,
+                        args.tar_gb * GB)
+    with StreamingPipeline(args.extract_workers, args.nbr_workers, args.queue_size, budget,
+                           args.delete_tars, args.test, args.extract_for) as stream:
+        # tars left by an earlier run first
+        for h, v in tiles:
+            tile_dir = os.path.join(args.root, tile_name(h, v))
+            for in_tar in sorted(glob.glob(os.path.join(tile_dir, '*.tar'))):
+                stream.publish(in_tar, tile_dir)
+        try:
+            # the thread engine runs on_complete in the download threads, so a full queue holds them back
+            download_files(args.root, tiles=tiles, dataset=args.dataset, acq_date=args.acq_date,
+                           region=args.region, spacecraft=args.spacecraft, cloud_cover=args.cloud_cover,
+                           username=args.username, token=args.token, threads=args.threads,
+                           engine='thread', on_complete=stream.on_download, before_submit=budget.reserve,
+                           on_failed=stream.on_failed)
+        except SystemExit:
+            # download_files exits when the search finds nothing
+            pass
+
+    stats = stream.stats
+    print('Downloaded/extracted {} of {} tars, NBR for {} of {} scenes in {:.1f} s'.format(
+        stats['extracted'], stats['tars'], stats['nbr'], stats['scenes'], stats['seconds']))
+    print('Largest queues: {} tars, {} scenes; peak pending tars {:.1f} GB, {} download waits for disk space'.format(
+        stats['max_tar_queue'], stats['max_scene_queue'], budget.peak / GB, budget.waits))
+    if stats['first_nbr_seconds'] is not None:
+        print('First NBR after {:.1f} s'.format(stats['first_nbr_seconds']))
+    if stats['errors']:
+        print('ERRORS:', stats['errors'])
@@ -0,0 +1,139 @@
+#shared extraction engine for the organize_C2_tar_download_* scripts
+#
+#a .tar is read once, front to back, as a stream.  each member name is matched
+#against a route table of (regex, destination folder) pairs; the first match
+#wins and the member is copied straight to its destination with large
+#buffered writes.  members that match no route are skipped without being
+#written anywhere.
+
+import os
+import re
+import shutil
+import tarfile
+
+BUFFER_SIZE = 8 * 1024 * 1024
+
+# route tables: (pattern, destination) where destination is a folder relative
+# to the tile folder, or a function of the regex match returning one
+
+# Burned Area products (organize_C2_tar_download_BP.py / _1.py)
+BA_PRODUCT_ROUTES = [
+    (r'BP\.TIF', 'scene_BP'),
+    (r'BC\.TIF', 'scene_BC'),
+    (r'\.png', 'scene_png'),
+    (r'\.xml', 'metadata'),
+    (r'BA\.json', 'BA_json'),
+    (r'BA_stac\.json', 'BA_stac_json'),
+]
+
+# bands each downstream stage reads.  organizers run with --extract-for only
+# extract the bands of the stages listed (plus the metadata) instead of all of
+# them; a new stage (another index) that needs other bands is added here
+STAGE_BANDS = {
+    'nbr': ('5', '7'),
+}
+
+
+def stage_bands(stages):
+    """sorted union of the bands read by stages, as in STAGE_BANDS"""
+    return sorted(set(band for stage in stages for band in STAGE_BANDS[stage]))
+
+
+def _band_class(bands):
+    return '[{}]'.format(''.join(bands)) if bands is not None else '[1-9]'
+
+
+def band_routes(bands=None):
+    """bands (all of 1 through 9 by default) into bands/band_N (organize_C2_tar_download_1.py)"""
+    return [
+        (r'B({})\.TIF'.format(_band_class(bands)), lambda m: os.path.join('bands', 'band_' + m.group(1))),
+    ]
+
+
+def ard_sr_routes(bands=None, metadata=False):
+    """
+    ARD surface reflectance bands (all of 1 through 9 by default) into one
+    folder per scene, named <tile>_<acquisition date>, and with metadata the
+    scene's .xml too (organize_C2_tar_download_ard.py)
+    """
+    routes = [
+        (r'LC0[8-9]_CU_(\d{{6}})_(\d{{8}})_\d{{8}}_\d{{2}}_SR_B({})'.format(_band_class(bands)),
+         lambda m: '{}_{}'.format(m.group(1), m.group(2))),
+    ]
+    if metadata:
+        routes.append((r'LC0[8-9]_CU_(\d{6})_(\d{8})_\d{8}_\d{2}\.xml$',
+                       lambda m: '{}_{}'.format(m.group(1), m.group(2))))
+    return routes
+
+
+BAND_ROUTES = band_routes()
+ARD_SR_ROUTES = ard_sr_routes()
+
+
+def compile_routes(routes):
+    """compile the patterns of a route table once"""
+    return [(re.compile(pattern) if isinstance(pattern, str) else pattern, destination)
+            for pattern, destination in routes]
+
+
+def route(name, routes):
+    """destination folder (relative) for a member name, or None to skip it"""
+    for pattern, destination in routes:
+        match = pattern.search(name)
+        if match:
+            return destination(match) if callable(destination) else destination
+    return None
+
+
+def _write_member(tar, member, dest, buffer_size):
+    os.makedirs(os.path.dirname(dest), exist_ok=True)
+    tmp = dest + '.extracting'
+    source = tar.extractfile(member)
+    with open(tmp, 'wb', buffering=buffer_size) as out:
+        shutil.copyfileobj(source, out, buffer_size)
+    os.replace(tmp, dest)
+    os.chmod(dest, member.mode & 0o777 | 0o600)
+    os.utime(dest, (member.mtime, member.mtime))
+
+
+def move_tar(in_tar, new_tar_folder):
+    """
+    move a processed .tar into new_tar_folder atomically (os.replace on the
+    same filesystem), so concurrent workers never see a half-moved file.
+    returns the new path.
+    """
+    os.makedirs(new_tar_folder, exist_ok=True)
+    dest = os.path.join(new_tar_folder, os.path.basename(in_tar))
+    try:
+        os.replace(in_tar, dest)
+    except OSError:
+        # different filesystem: copy next to the destination, then rename
+        tmp = dest + '.moving'
+        shutil.copyfile(in_tar, tmp)
+        os.replace(tmp, dest)
+        os.remove(in_tar)
+    return dest
+
+
+def extract_members(in_tar, out_dir, routes, buffer_size=BUFFER_SIZE):
+    """
+    extract the members of in_tar that match routes into out_dir in one
+    sequential pass over the archive.  returns the list of written paths.
+    raises tarfile.TarError/OSError if the archive can't be read.
+    """
+    routes = compile_routes(routes)
+    written = []
+    with tarfile.open(in_tar, mode='r|*', bufsize=buffer_size) as tar:
+        for member in tar:
+            if not member.isfile():
+                continue
+            folder = route(member.name, routes)
+            if folder is None:
+                continue  # skipped, the stream just moves past its data
+            if os.path.isabs(member.name) or '..' in member.name.split('/'):
+                print('Skipping unsafe member name:', member.name)
+                continue
+            dest = os.path.join(out_dir, folder, member.name)
+            _write_member(tar, member, dest, buffer_size)
+            written.append(dest)
+    return written
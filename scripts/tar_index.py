@@ -0,0 +1,95 @@
+#read the band files inside uncompressed .tar downloads without extracting them
+#
+#the members of a .tar are stored as-is, so each GeoTIFF is a contiguous byte
+#range of the archive that GDAL can open as /vsisubfile/<offset>_<size>,<tar>.
+#the member offsets are found once per tar, by walking its headers (seeking
+#past the data, so only a few KB are read), and kept in a <tar>.index.json
+#sidecar that is rebuilt whenever the tar's size or mtime change.
+#compressed tars (.tar.gz) have no usable byte offsets and raise ValueError.
+
+import os
+import re
+import json
+import tarfile
+
+INDEX_SUFFIX = '.index.json'
+
+# ARD surface reflectance band members (as tar_extract.ARD_SR_ROUTES)
+ARD_SR_BAND = re.compile(r'(LC0[8-9]_CU_(\d{6})_(\d{8})_\d{8}_\d{2})_SR_B([1-9])\.TIF$')
+
+
+def index_path(in_tar):
+    return in_tar + INDEX_SUFFIX
+
+
+def build_index(in_tar):
+    """{member name: [data offset, size]} of the regular files of an uncompressed tar"""
+    members = {}
+    try:
+        with tarfile.open(in_tar, mode='r:') as tar:
+            for member in tar:
+                if member.isfile():
+                    members[member.name] = [member.offset_data, member.size]
+    except tarfile.ReadError as e:
+        raise ValueError('{} is not an uncompressed tar: {}'.format(in_tar, e))
+    return members
+
+
+def load_index(in_tar, write=True):
+    """the member index of in_tar, from its sidecar if still current, otherwise built (and saved if write)"""
+    stat = os.stat(in_tar)
+    try:
+        with open(index_path(in_tar)) as f:
+            index = json.load(f)
+        if index['size'] == stat.st_size and index['mtime_ns'] == stat.st_mtime_ns:
+            return index['members']
+    except (OSError, ValueError, KeyError):
+        pass
+
+    members = build_index(in_tar)
+    if write:
+        tmp = index_path(in_tar) + '.part'
+        try:
+            with open(tmp, 'w') as f:
+                json.dump(dict(size=stat.st_size, mtime_ns=stat.st_mtime_ns, members=members), f)
+            os.replace(tmp, index_path(in_tar))
+        except OSError:
+            pass  # read-only archive folder: the index is just rebuilt next time
+    return members
+
+
+def vsi_path(in_tar, offset, size):
+    """GDAL path of a byte range of in_tar"""
+    return '/vsisubfile/{}_{},{}'.format(offset, size, os.path.abspath(in_tar))
+
+
+def member_path(in_tar, name, members=None):
+    """GDAL path of one member of in_tar"""
+    members = members if members is not None else load_index(in_tar)
+    offset, size = members[name]
+    return vsi_path(in_tar, offset, size)
+
+
+def real_path(path):
+    """(file on disk, byte offset) of a path that may be a /vsisubfile/ path"""
+    if path.startswith('/vsisubfile/'):
+        subfile, real = path[len('/vsisubfile/'):].split(',', 1)
+        return real, int(subfile.split('_')[0])
+    return path, 0
+
+
+def ard_scene_bands(in_tar, bands=None):
+    """
+    {product ID: (scene folder name, {band number: GDAL path})} of the SR
+    bands in an ARD tar, only the bands listed (e.g. ('5', '7')) if given
+    """
+    members = load_index(in_tar)
+    scenes = {}
+    for name in sorted(members):
+        match = ARD_SR_BAND.search(os.path.basename(name))
+        if not match or (bands is not None and match.group(4) not in bands):
+            continue
+        product_id, tile, date, band = match.groups()
+        folder, paths = scenes.setdefault(product_id, ('{}_{}'.format(tile, date), {}))
+        paths[band] = member_path(in_tar, name, members)
+    return scenes
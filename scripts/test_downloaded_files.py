@@ -1,20 +1,22 @@
-#script to test if .tar downloads can be opened
+#script to test if .tar downloads can be opened and read to the end
+#(see verify_tars.py to check many tiles at once in parallel)
 
 import os
 import argparse
 import tarfile
 import glob
 
+from verify_tars import verify_tar
+
 def tar_test(tar):
     
     print('Testing:', tar)
     
-    try:
-        tar_test = tarfile.open(tar, mode='r:*')
-    except:
-        print('ERROR opening:', tar)
-              
-    tar_test.close()
+    #stream every member and check the end-of-archive marker, not just the first header
+    report = verify_tar(tar)
+    if not report['ok']:
+        print('ERROR opening:', tar, report['errors'])
+        raise tarfile.TarError('; '.join(report['errors']))
 
 if __name__ == '__main__':
     #create command-line argument(s) - specify directory with .tar files to try opening
@@ -0,0 +1,206 @@
+#script to verify the integrity of downloaded .tar files for many tiles at once
+#
+#every member of every tar is streamed once: header checksums are validated
+#by tarfile, each member's payload is read to its full recorded size, and the
+#end-of-archive marker must follow the last member.  optionally the whole file
+#is hashed in the same pass and compared to the size/checksum recorded in the
+#download manifest at download time.  tars are verified in parallel across a
+#process pool and a JSON report is written.
+#
+# python verify_tars.py -d downloads/h003v010 downloads/h003v011 --hash -o report.json
+# python verify_tars.py --root downloads -w 32
+
+import os
+import sys
+import glob
+import json
+import time
+import hashlib
+import tarfile
+import argparse
+from concurrent.futures import ProcessPoolExecutor, as_completed
+
+from download_manifest import DownloadManifest, MANIFEST_NAME, CHECKSUM_ALGORITHM
+
+BLOCKSIZE = tarfile.BLOCKSIZE
+BUFFER_SIZE = 4 * 1024 * 1024
+COMPRESSED_MAGIC = (b'\x1f\x8b', b'BZh', b'\xfd7zXZ')
+
+
+class _HashingReader(object):
+    """file wrapper that hashes and counts every byte read through it"""
+
+    def __init__(self, raw, algorithm=None):
+        self.raw = raw
+        self.digest = hashlib.new(algorithm) if algorithm else None
+        self.bytes_read = 0
+
+    def read(self, size=-1):
+        data = self.raw.read(size)
+        if self.digest is not None:
+            self.digest.update(data)
+        self.bytes_read += len(data)
+        return data
+
+    def drain(self):
+        """read (and hash) whatever the tar reader did not consume"""
+        while self.read(BUFFER_SIZE):
+            pass
+
+
+def _check_end_of_archive(path, offset, size):
+    """the two zero blocks marking the end of archive must start at offset"""
+    if size < offset + 2 * BLOCKSIZE:
+        return 'missing end-of-archive marker after offset {} (file is {} bytes)'.format(offset, size)
+    with open(path, 'rb') as f:
+        f.seek(offset)
+        marker = f.read(2 * BLOCKSIZE)
+    if marker.count(0) != len(marker):
+        return 'invalid header or missing end-of-archive marker at offset {}'.format(offset)
+    return None
+
+
+def verify_tar(path, hash_payload=False, expected=None):
+    """
+    Stream every member of one tar and validate it.
+
+    expected: optional dict with 'size' and 'checksum' recorded at download
+    time (see download_manifest).  Returns a report dict; report['ok'] is
+    False if any error was found.
+    """
+    start = time.time()
+    report = dict(path=path, ok=False, members=0, payload_bytes=0,
+                  size=None, checksum=None, errors=[], seconds=None)
+    errors = report['errors']
+    try:
+        report['size'] = os.path.getsize(path)
+        with open(path, 'rb') as raw:
+            compressed = raw.read(6).startswith(COMPRESSED_MAGIC)
+            raw.seek(0)
+            reader = _HashingReader(raw, CHECKSUM_ALGORITHM if hash_payload else None)
+            with tarfile.open(fileobj=reader, mode='r|*', bufsize=BUFFER_SIZE) as tar:
+                for member in tar:
+                    report['members'] += 1
+                    if not member.isfile():
+                        continue
+                    f = tar.extractfile(member)
+                    read = 0
+                    while True:
+                        block = f.read(BUFFER_SIZE)
+                        if not block:
+                            break
+                        read += len(block)
+                    report['payload_bytes'] += read
+                    if read != member.size:
+                        errors.append('truncated member {} ({} of {} bytes)'.format(member.name, read, member.size))
+                end_offset = tar.offset
+            reader.drain()
+        if report['members'] == 0:
+            errors.append('no members')
+        if not compressed:
+            error = _check_end_of_archive(path, end_offset, report['size'])
+            if error:
+                errors.append(error)
+        if reader.digest is not None:
+            report['checksum'] = reader.digest.hexdigest()
+    except (tarfile.TarError, EOFError, OSError, ValueError) as e:
+        errors.append('{}: {}'.format(e.__class__.__name__, e))
+
+    if expected and not errors:
+        if expected.get('size') is not None and expected['size'] != report['size']:
+            errors.append('size {} does not match {} recorded at download'.format(report['size'], expected['size']))
+        if (report['checksum'] and expected.get('checksum') and
+                expected['checksum'] != report['checksum']):
+            errors.append('{} checksum does not match the one recorded at download'.format(CHECKSUM_ALGORITHM))
+
+    report['ok'] = not errors
+    report['seconds'] = round(time.time() - start, 3)
+    return report
+
+
+def find_tars(directories, include_organized=False):
+    """list the .tar files in each tile folder (and tar_downloads if asked)"""
+    tars = []
+    for tile_dir in directories:
+        tars.extend(glob.glob(os.path.join(tile_dir, '*.tar')))
+        if include_organized:
+            tars.extend(glob.glob(os.path.join(tile_dir, 'tar_downloads', '*.tar')))
+    return sorted(tars)
+
+
+def expected_from_manifests(tars):
+    """size/checksum recorded at download time for each tar, if any"""
+    expected = {}
+    manifests = {}
+    for tar in tars:
+        folder = os.path.dirname(os.path.abspath(tar))
+        if os.path.basename(folder) == 'tar_downloads':
+            folder = os.path.dirname(folder)
+        if folder not in manifests:
+            path = os.path.join(folder, MANIFEST_NAME)
+            manifests[folder] = DownloadManifest(folder) if os.path.exists(path) else None
+        if manifests[folder] is not None:
+            row = manifests[folder].lookup_filename(os.path.basename(tar))
+            if row:
+                expected[tar] = dict(size=row['size'], checksum=row['checksum'])
+    for manifest in manifests.values():
+        if manifest is not None:
+            manifest.close()
+    return expected
+
+
+def verify_many(tars, workers=None, hash_payload=False, use_manifest=True):
+    """verify tars across a process pool, returns the list of reports"""
+    expected = expected_from_manifests(tars) if use_manifest else {}
+    reports = []
+    with ProcessPoolExecutor(max_workers=workers) as executor:
+        futures = [executor.submit(verify_tar, tar, hash_payload, expected.get(tar))
+                   for tar in tars]
+        for future in as_completed(futures):
+            report = future.result()
+            print('{} {}'.format('OK   ' if report['ok'] else 'ERROR', report['path']))
+            for error in report['errors']:
+                print('      ', error)
+            reports.append(report)
+    return sorted(reports, key=lambda r: r['path'])
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Verify downloaded .tar files for one or many tiles.')
+    parser.add_argument('-d', '--tar_directory', nargs='+', default=[],
+                        help='Tile folder(s) where .tar files are located.', type=str, dest='tar_directory')
+    parser.add_argument('--root', type=str, default=None,
+                        help='Verify every tile folder directly under this folder.')
+    parser.add_argument('--include-organized', action='store_true',
+                        help='Also verify tars already moved to tar_downloads.')
+    parser.add_argument('--hash', action='store_true', dest='hash_payload',
+                        help='Hash each tar and compare with the download manifest.')
+    parser.add_argument('--no-manifest', action='store_false', dest='use_manifest',
+                        help='Do not compare with download_manifest.sqlite.')
+    parser.add_argument('-w', '--workers', type=int, default=None,
+                        help='Number of worker processes [Default: CPU count]')
+    parser.add_argument('-o', '--output', type=str, default=None,
+                        help='Path of the JSON report [Default: verify_report.json in the first folder]')
+    args = parser.parse_args()
+
+    directories = [os.path.normpath(d) for d in args.tar_directory]
+    if args.root:
+        directories.extend(sorted(d for d in glob.glob(os.path.join(args.root, '*'))
+                                  if os.path.isdir(d)))
+    if not directories:
+        parser.error('specify -d and/or --root')
+
+    tars = find_tars(directories, args.include_organized)
+    reports = verify_many(tars, args.workers, args.hash_payload, args.use_manifest)
+    failed = [r['path'] for r in reports if not r['ok']]
+
+    output = args.output or os.path.join(args.root or directories[0], 'verify_report.json')
+    with open(output, 'w') as f:
+        json.dump(dict(tars=len(reports), failed=failed, reports=reports), f, indent=2)
+
+    if len(failed) == 0:
+        print('No errors! ({} tars)'.format(len(reports)))
+    else:
+        print('Errors in the following .tar files:', failed)
+    print('Report written to', output)
+    sys.exit(1 if failed else 0)
@@ -0,0 +1,369 @@
+#watch ARD tile folders and process new acquisitions as they arrive
+#
+#a long-running loop that polls the tile folders every --interval seconds for
+#  new .tar files            -> extract_tar (organize_C2_tar_download_ard.py)
+#  scene folders without NBR -> process_scene (calculate_nbr.py)
+#  NBR without NBR_norm      -> the tile's mean/std images are updated and
+#                               the scene normalized (normalize_nbr.py), once
+#                               none of the tile's tars/scenes are in flight
+#each stage has its own queue and the stages share one process pool, later
+#stages first so scenes already in flight finish before new ones start.
+#files still being written are debounced: a tar or scene is only taken once
+#its size and mtime haven't changed for --settle seconds (.part files are
+#ignored).  everything is found again from the files on disk, so the watcher
+#can be stopped and restarted at any time.
+#
+#every --report seconds the queue depths, the per-stage wait/run times and
+#the scene-to-product latency are printed and written to watch_metrics.json.
+#
+# python watch.py --root downloads -w 16
+# python watch.py -d downloads/h003v010 downloads/h003v011 --interval 5 --settle 20
+# python watch.py --root downloads --once
+
+import os
+import re
+import glob
+import json
+import time
+import argparse
+from collections import deque
+from concurrent.futures import ProcessPoolExecutor, FIRST_COMPLETED, wait
+
+import raster_io
+from organize_C2_tar_download_ard import extract_tar, routes
+from tar_extract import STAGE_BANDS
+from calculate_nbr import process_scene, find_scene_dirs, find_band_files, nbr_output_file
+from scene_catalog import SceneCatalog, NBR, NORMALIZED
+
+STAGES = ('extract', 'nbr', 'normalize')
+METRICS_NAME = 'watch_metrics.json'
+LATENCY_SAMPLES = 1000
+
+# scene folder (<tile>_<acquisition date>) of an ARD product ID
+SCENE_FOLDER = re.compile(r'L[CETMO]0\d_CU_(\d{6})_(\d{8})_')
+
+
+def file_signature(paths):
+    """(path, size, mtime) of the files, or None if one has disappeared"""
+    try:
+        return tuple((path, os.path.getsize(path), os.path.getmtime(path)) for path in sorted(paths))
+    except OSError:
+        return None
+
+
+def norm_output_file(nbr_file):
+    return nbr_file.replace('_NBR.TIF', '_NBR_norm.TIF')
+
+
+def needs_nbr(scene_dir):
+    """band files of a scene folder whose NBR is missing or older than them, else None"""
+    try:
+        bands = find_band_files(scene_dir)
+    except IndexError:
+        return None
+    nbr_file = nbr_output_file(scene_dir, bands[0])
+    if os.path.exists(nbr_file) and os.path.getmtime(nbr_file) >= max(os.path.getmtime(b) for b in bands):
+        return None
+    return bands
+
+
+def extract_one(in_tar, tile_dir, extract_for=None):
+    """extract_tar (only the bands of the extract_for stages if given), returning the scene folders written"""
+    # the route tables hold functions that can't be pickled, so they are built here in the worker
+    extracted = extract_tar(in_tar, tile_dir, os.path.join(tile_dir, 'tar_downloads'), routes(extract_for))
+    if extracted is None:
+        raise ValueError('could not extract ' + in_tar)
+    return sorted(set(os.path.dirname(path) for path in extracted))
+
+
+def normalize_tile(tile_dir, nbr_files):
+    """update the tile's mean/std images with its NBR files and normalize nbr_files with them"""
+    from normalize_nbr import calculate_mean_and_std_nbr_image, normalize_nbr_file
+    mean_nbr_image, std_nbr_image = calculate_mean_and_std_nbr_image(tile_dir)
+    return [normalize_nbr_file(nbr_file, mean_nbr_image, std_nbr_image) for nbr_file in nbr_files]
+
+
+class StageMetrics(object):
+    """counters and recent wait/run times of one stage"""
+
+    def __init__(self):
+        self.done = 0
+        self.failed = 0
+        self.wait = deque(maxlen=LATENCY_SAMPLES)
+        self.run = deque(maxlen=LATENCY_SAMPLES)
+
+    def summary(self, queued, running):
+        return dict(queued=queued, running=running, done=self.done, failed=self.failed,
+                    wait=latency_summary(self.wait), run=latency_summary(self.run))
+
+
+def latency_summary(samples):
+    if not samples:
+        return None
+    ordered = sorted(samples)
+    return dict(mean=round(sum(ordered) / len(ordered), 3), p50=round(ordered[len(ordered) // 2], 3),
+                p90=round(ordered[int(len(ordered) * 0.9)], 3), max=round(ordered[-1], 3))
+
+
+class Watcher(object):
+    """poll tile folders, debounce, queue and run the stages, keep metrics"""
+
+    def __init__(self, tile_dirs, root=None, workers=None, settle=30.0, extract_for=None, catalog=None):
+        self.tile_dirs = list(tile_dirs)
+        self.root = root
+        self.workers = workers or os.cpu_count()
+        self.settle = settle
+        self.extract_for = extract_for
+        # scene_catalog.SceneCatalog the NBR and normalized products are recorded in
+        self.catalog = catalog
+        self.queues = {stage: deque() for stage in STAGES}
+        self.metrics = {stage: StageMetrics() for stage in STAGES}
+        self.end_to_end = deque(maxlen=LATENCY_SAMPLES)
+        self.running = {}
+        # key -> (signature, time first seen with it), for debouncing
+        self._seen = {}
+        # keys queued or running, and failed keys with the signature they failed with
+        self._active = set()
+        self._failed = {}
+        # tar or scene folder -> time it was first seen, for the scene-to-product latency
+        self._arrived = {}
+        self._busy_tiles = set()
+
+    def _settled(self, key, paths, now):
+        """True once the files of key have kept the same size and mtime for settle seconds"""
+        signature = file_signature(paths)
+        if signature is None or self._failed.get(key) == signature:
+            return False
+        seen = self._seen.get(key)
+        if seen is None or seen[0] != signature:
+            self._seen[key] = seen = (signature, now)
+        return now - seen[1] >= self.settle
+
+    def _queue(self, stage, key, args, paths, now):
+        self._active.add(key)
+        self.queues[stage].append((key, args, paths, now))
+
+    def scan(self):
+        """find new work on disk and queue the items that have settled"""
+        now = time.time()
+        if self.root:
+            # tile folders created after the start too
+            for tile_dir in sorted(glob.glob(os.path.join(self.root, 'h[0-9][0-9][0-9]v[0-9][0-9][0-9]'))):
+                if os.path.isdir(tile_dir) and tile_dir not in self.tile_dirs:
+                    self.tile_dirs.append(tile_dir)
+        # scene folders a queued or running tar is (or will be) extracting into
+        extracting = set()
+        for stage, key in self._active:
+            match = SCENE_FOLDER.match(os.path.basename(key)) if stage == 'extract' else None
+            if match:
+                extracting.add('{}_{}'.format(*match.groups()))
+        current = set()
+
+        for tile_dir in self.tile_dirs:
+            if not os.path.isdir(tile_dir):
+                continue
+            for in_tar in sorted(glob.glob(os.path.join(tile_dir, '*.tar'))):
+                key = ('extract', in_tar)
+                current.add(key)
+                if key not in self._active and self._settled(key, [in_tar], now):
+                    self._arrived.setdefault(in_tar, self._seen[key][1])
+                    self._queue('extract', key, (in_tar, tile_dir, self.extract_for), [in_tar], now)
+
+            for scene_dir in find_scene_dirs(tile_dir):
+                key = ('nbr', scene_dir)
+                if key in self._active or os.path.basename(scene_dir) in extracting:
+                    continue
+                bands = needs_nbr(scene_dir)
+                if bands:
+                    current.add(key)
+                    if self._settled(key, bands, now):
+                        self._arrived.setdefault(scene_dir, self._seen[key][1])
+                        self._queue('nbr', key, (scene_dir,), bands, now)
+
+            for nbr_file in glob.glob(os.path.join(tile_dir, '*', '*_NBR.TIF')):
+                key = ('normalize', nbr_file)
+                norm_file = norm_output_file(nbr_file)
+                if key in self._active or (os.path.exists(norm_file) and
+                                           os.path.getmtime(norm_file) >= os.path.getmtime(nbr_file)):
+                    continue
+                current.add(key)
+                if self._settled(key, [nbr_file], now):
+                    self._queue('normalize', key, (tile_dir, nbr_file), [nbr_file], now)
+
+        # forget files that went away or no longer need work
+        for key in list(self._seen):
+            if key not in current and key not in self._active:
+                del self._seen[key]
+
+    def _submit(self, executor, now):
+        # later stages first: finish the scenes in flight before starting new ones
+        while len(self.running) < self.workers:
+            if self._submit_normalize(executor, now):
+                continue
+            for stage, func in (('nbr', process_scene), ('extract', extract_one)):
+                if self.queues[stage]:
+                    key, args, paths, queued = self.queues[stage].popleft()
+                    self.running[executor.submit(func, *args)] = (stage, [key], args, [paths], queued, now)
+                    break
+            else:
+                return
+
+    def _submit_normalize(self, executor, now):
+        """
+        submit one normalize task for the first ready tile, with all its queued
+        NBR files.  a tile is ready when it isn't normalizing already and none
+        of its tars or scenes are queued or running for extract/nbr, so its
+        mean/std images take in every NBR file on the way
+        """
+        pending = set(os.path.dirname(path) for stage, path in self._active if stage != 'normalize')
+        tiles = [item[1][0] for item in self.queues['normalize']
+                 if item[1][0] not in self._busy_tiles and item[1][0] not in pending]
+        if not tiles:
+            return False
+        tile_dir = tiles[0]
+        items = [item for item in self.queues['normalize'] if item[1][0] == tile_dir]
+        for item in items:
+            self.queues['normalize'].remove(item)
+        self._busy_tiles.add(tile_dir)
+        nbr_files = [item[1][1] for item in items]
+        future = executor.submit(normalize_tile, tile_dir, nbr_files)
+        self.running[future] = ('normalize', [item[0] for item in items], (tile_dir, nbr_files),
+                                [item[2] for item in items], min(item[3] for item in items), now)
+        return True
+
+    def _finished(self, future, now):
+        stage, keys, args, paths, queued, started = self.running.pop(future)
+        metrics = self.metrics[stage]
+        metrics.wait.append(started - queued)
+        metrics.run.append(now - started)
+        for key in keys:
+            self._active.discard(key)
+            self._seen.pop(key, None)
+        if stage == 'normalize':
+            self._busy_tiles.discard(args[0])
+        try:
+            result = future.result()
+        except Exception as e:
+            print('ERROR {} {} - {}: {}'.format(stage, args[0], e.__class__.__name__, e))
+            metrics.failed += 1
+            # not retried until its files change
+            for key, key_paths in zip(keys, paths):
+                self._failed[key] = file_signature(key_paths)
+            return
+        metrics.done += 1
+
+        if stage == 'extract':
+            # the extracted scenes are complete, no need to debounce them
+            arrived = self._arrived.pop(args[0], now)
+            for scene_dir in result:
+                bands = needs_nbr(scene_dir)
+                if bands and ('nbr', scene_dir) not in self._active:
+                    self._arrived.setdefault(scene_dir, arrived)
+                    self._queue('nbr', ('nbr', scene_dir), (scene_dir,), bands, now)
+        elif stage == 'nbr':
+            if self.catalog is not None:
+                self.catalog.record([result], NBR)
+            key = ('normalize', result)
+            if key not in self._active:
+                self._queue('normalize', key, (os.path.dirname(args[0]), result), [result], now)
+        else:
+            for nbr_file in args[1]:
+                arrived = self._arrived.pop(os.path.dirname(nbr_file), None)
+                if arrived is not None:
+                    self.end_to_end.append(now - arrived)
+            if self.catalog is not None:
+                self.catalog.record(result + [os.path.join(args[0], name)
+                                              for name in ('mean_nbr_image.tif', 'std_nbr_image.tif')],
+                                    NORMALIZED, tile=os.path.basename(args[0]))
+            print('Normalized {} scenes of {}'.format(len(result), args[0]))
+
+    def metrics_summary(self):
+        running = {stage: 0 for stage in STAGES}
+        for task in self.running.values():
+            running[task[0]] += 1
+        return dict(time=time.strftime('%Y-%m-%dT%H:%M:%S'),
+                    stages={stage: self.metrics[stage].summary(len(self.queues[stage]), running[stage])
+                            for stage in STAGES},
+                    scene_to_product=latency_summary(self.end_to_end))
+
+    def idle(self):
+        """nothing queued, running or waiting to settle"""
+        return not self.running and not any(self.queues.values()) and \
+            all(key in self._failed for key in self._seen)
+
+    def run(self, interval=10.0, report=60.0, metrics_path=None, once=False):
+        """poll, dispatch and report until interrupted (or, with once, until the work on disk is done)"""
+        last_scan = last_report = 0
+        with ProcessPoolExecutor(max_workers=self.workers, initializer=raster_io.configure,
+                                 initargs=raster_io.settings()) as executor:
+            try:
+                while True:
+                    if time.time() - last_scan >= interval:
+                        self.scan()
+                        last_scan = time.time()
+                    self._submit(executor, time.time())
+                    if once and self.idle():
+                        break
+                    timeout = max(0.0, last_scan + interval - time.time())
+                    if self.running:
+                        done, _ = wait(self.running, timeout=timeout, return_when=FIRST_COMPLETED)
+                        for future in done:
+                            self._finished(future, time.time())
+                    else:
+                        time.sleep(timeout)
+                    if time.time() - last_report >= report:
+                        self.report(metrics_path)
+                        last_report = time.time()
+            except KeyboardInterrupt:
+                print('Stopping, waiting for the running tasks')
+        self.report(metrics_path)
+
+    def report(self, metrics_path=None):
+        """print the queue depths and latencies, and write them to metrics_path"""
+        summary = self.metrics_summary()
+        print(' | '.join('{}: {queued} queued, {running} running, {done} done, {failed} failed'.format(stage, **counts)
+                         for stage, counts in summary['stages'].items()))
+        if summary['scene_to_product']:
+            print('scene-to-product latency (s):', summary['scene_to_product'])
+        if metrics_path:
+            tmp = metrics_path + '.part'
+            with open(tmp, 'w') as f:
+                json.dump(summary, f, indent=2)
+            os.replace(tmp, metrics_path)
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Watch ARD tile folders and extract, calculate and normalize the NBR of new acquisitions.')
+    parser.add_argument('-d', '--tile_directory', nargs='+', default=[], type=str, dest='tile_directory',
+                        help='Tile folder(s) to watch.')
+    parser.add_argument('--root', type=str, default=None,
+                        help='Watch every tile folder (hHHHvVVV) in this folder, including ones created later.')
+    parser.add_argument('-w', '--workers', type=int, default=None,
+                        help='Number of worker processes [Default: CPU count]')
+    parser.add_argument('--interval', type=float, default=10.0,
+                        help='Seconds between scans [Default: %(default)s]')
+    parser.add_argument('--settle', type=float, default=30.0,
+                        help='Seconds a file must stay unchanged before it is processed [Default: %(default)s]')
+    parser.add_argument('--report', type=float, default=60.0,
+                        help='Seconds between metrics reports [Default: %(default)s]')
+    parser.add_argument('--metrics', type=str, default=None,
+                        help='Path of the metrics JSON [Default: %s in --root or the first folder]' % METRICS_NAME)
+    parser.add_argument('--extract-for', nargs='+', default=None, choices=sorted(STAGE_BANDS), dest='extract_for',
+                        help='Only extract the bands these stages read (plus metadata) [Default: every SR band]')
+    parser.add_argument('--once', action='store_true',
+                        help='Process what is on disk now and exit instead of watching.')
+    parser.add_argument('--catalog', type=str, default=None,
+                        help='Scene catalog (see scene_catalog.py) to record the NBR and normalized products in.')
+    raster_io.add_arguments(parser)
+    args = parser.parse_args()
+    raster_io.configure(args.output_format, args.compress, args.cache_mb)
+    if not args.tile_directory and not args.root:
+        parser.error('specify -d and/or --root')
+
+    catalog = SceneCatalog(args.catalog) if args.catalog else None
+    watcher = Watcher([os.path.normpath(d) for d in args.tile_directory], args.root, args.workers, args.settle,
+                      args.extract_for, catalog)
+    metrics_path = args.metrics or os.path.join(args.root or args.tile_directory[0], METRICS_NAME)
+    watcher.run(args.interval, args.report, metrics_path, args.once)
+    if catalog is not None:
+        catalog.close()